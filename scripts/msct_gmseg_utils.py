@@ -512,6 +512,21 @@ def apply_transfo(im_src, im_dest, warp, interp='spline', rm_tmp=True):
 
 
 # ------------------------------------------------------------------------------------------------------------------
+def sum_gm(list_of_slices, model_space=True):
+    """
+    Stack the manual GM segmentations of a list of slices, summed by slice (a slice can have several manual
+    segmentations), so that averages over any subset of slices can be computed with matrix products.
+    :param list_of_slices: list of Slice
+    :param model_space: use the segmentations in the model space
+    :return: data_sum_gm: array of shape (number of slices, nx, ny), nb_seg: number of segmentations of each slice
+    """
+    list_gm = [dic_slice.gm_seg_M if model_space else dic_slice.gm_seg for dic_slice in list_of_slices]
+    data_sum_gm = np.array([np.sum(gm, axis=0) for gm in list_gm])
+    nb_seg = np.array([len(gm) for gm in list_gm])
+
+    return data_sum_gm, nb_seg
+
+
 def average_gm_wm(list_of_slices, model_space=True, bin=False):
     # compute mean GM and WM image
     list_gm = []
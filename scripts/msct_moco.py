@@ -22,6 +22,8 @@
 from __future__ import absolute_import
 
 import sys, os, glob
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 import numpy as np
 import scipy.interpolate
@@ -119,9 +121,9 @@ def moco(param):
     # file_mat = tuple([[[] for i in range(nt)] for i in range(nz)])
     file_mat[:] = ''  # init
     file_data_splitZ_moco = []
-    sct.printv('\nRegister. Loop across Z (note: there is only one Z if orientation is axial')
-    for file in file_data_splitZ:
-        iz = file_data_splitZ.index(file)
+    list_file_data_splitZ_splitT = []
+    list_file_data_splitZ_splitT_moco = []
+    for iz, file in enumerate(file_data_splitZ):
         # Split data along T dimension
         # sct.printv('\nSplit data along T dimension.', verbose)
         im_z = Image(file)
@@ -131,43 +133,85 @@ def moco(param):
             im_zt.save(verbose=0)
             file_data_splitZ_splitT.append(im_zt.absolutepath)
         # file_data_splitT = file_data + '_T'
-
-        # Motion correction: initialization
-        index = np.arange(nt)
-        file_data_splitT_num = []
-        file_data_splitZ_splitT_moco = []
-        failed_transfo = [0 for i in range(nt)]
-
-        # Motion correction: Loop across T
-        for indice_index in tqdm(range(nt), unit='iter', unit_scale=False,
-                                 desc="Z=" + str(iz) + "/" + str(len(file_data_splitZ)-1), ascii=True, ncols=80):
-
-            # create indices and display stuff
-            it = index[indice_index]
+        list_file_data_splitZ_splitT.append(file_data_splitZ_splitT)
+        list_file_data_splitZ_splitT_moco.append([sct.add_suffix(f, '_moco') for f in file_data_splitZ_splitT])
+        for it in range(nt):
             file_mat[iz][it] = os.path.join(folder_mat, "mat.Z") + str(iz).zfill(4) + 'T' + str(it).zfill(4)
-            file_data_splitZ_splitT_moco.append(sct.add_suffix(file_data_splitZ_splitT[it], '_moco'))
-            # deal with masking
-            if not param.fname_mask == '':
-                input_mask = im_maskz_list[iz]
-            else:
-                input_mask = None
-            # run 3D registration
-            failed_transfo[it] = register(param, file_data_splitZ_splitT[it], file_target_splitZ[iz], file_mat[iz][it],
-                                          file_data_splitZ_splitT_moco[it], im_mask=input_mask)
 
+    # Motion correction. The first volumes of each Z are registered sequentially, because each of them updates the
+    # target (iterative averaging). The other registrations are independent: they are dispatched to a pool of jobs,
+    # each job running one ANTs registration at a time.
+    jobs = int(getattr(param, 'jobs', 1))
+    if jobs == 0:
+        jobs = cpu_count()
+    env = None
+    if jobs > 1 and 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' not in os.environ:
+        # share the available CPUs between concurrent ANTs processes
+        env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(max(1, cpu_count() // jobs)))
+    if param.iterAvg and not param.todo == 'apply':
+        nt_avg = min(10, nt)
+    else:
+        nt_avg = 0
+    failed_transfo = [[0 for it in range(nt)] for iz in range(len(file_data_splitZ))]
+
+    def register_volume(iz, it):
+        # deal with masking
+        if not param.fname_mask == '':
+            input_mask = im_maskz_list[iz]
+        else:
+            input_mask = None
+        # run 3D registration
+        failed_transfo[iz][it] = register(param, list_file_data_splitZ_splitT[iz][it], file_target_splitZ[iz],
+                                          file_mat[iz][it], list_file_data_splitZ_splitT_moco[iz][it],
+                                          im_mask=input_mask, env=env)
+
+    def register_volumes_avg(iz):
+        for it in range(nt_avg):
+            register_volume(iz, it)
             # average registered volume with target image
             # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-            if param.iterAvg and indice_index < 10 and failed_transfo[it] == 0 and not param.todo == 'apply':
+            if failed_transfo[iz][it] == 0:
                 im_targetz = Image(file_target_splitZ[iz])
                 data_targetz = im_targetz.data
-                data_mocoz = Image(file_data_splitZ_splitT_moco[it]).data
-                data_targetz = (data_targetz * (indice_index + 1) + data_mocoz) / (indice_index + 2)
+                data_mocoz = Image(list_file_data_splitZ_splitT_moco[iz][it]).data
+                data_targetz = (data_targetz * (it + 1) + data_mocoz) / (it + 2)
                 im_targetz.data = data_targetz
                 im_targetz.save(verbose=0)
+            pbar.update(1)
+
+    def register_volume_task(izt):
+        register_volume(*izt)
+        return izt
+
+    sct.printv('\nRegister. Loop across Z (note: there is only one Z if orientation is axial')
+    if jobs > 1:
+        sct.printv('Register volumes using ' + str(jobs) + ' parallel jobs...', verbose)
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        with tqdm(total=len(file_data_splitZ) * nt, unit='iter', unit_scale=False, ascii=True, ncols=80) as pbar:
+            list_izt = [(iz, it) for iz in range(len(file_data_splitZ)) for it in range(nt_avg, nt)]
+            if pool is not None:
+                pool.map(register_volumes_avg, range(len(file_data_splitZ)))
+                for _ in pool.imap_unordered(register_volume_task, list_izt):
+                    pbar.update(1)
+            else:
+                for iz in range(len(file_data_splitZ)):
+                    register_volumes_avg(iz)
+                for izt in list_izt:
+                    register_volume_task(izt)
+                    pbar.update(1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for iz, file in enumerate(file_data_splitZ):
+        file_data_splitZ_splitT = list_file_data_splitZ_splitT[iz]
+        file_data_splitZ_splitT_moco = list_file_data_splitZ_splitT_moco[iz]
 
         # Replace failed transformation with the closest good one
-        fT = [i for i, j in enumerate(failed_transfo) if j == 1]
-        gT = [i for i, j in enumerate(failed_transfo) if j == 0]
+        fT = [i for i, j in enumerate(failed_transfo[iz]) if j == 1]
+        gT = [i for i, j in enumerate(failed_transfo[iz]) if j == 0]
         for it in range(len(fT)):
             abs_dist = [np.abs(gT[i] - fT[it]) for i in range(len(gT))]
             if not abs_dist == []:
@@ -200,7 +244,38 @@ def moco(param):
     return file_mat
 
 
-def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
+def average_groups(im_data, group_indexes):
+    """
+    Average the volumes of a 4D image within groups. The volumes are read one at a time, in a single pass, so that
+    the time series is never duplicated in memory.
+    :param im_data: 4D Image
+    :param group_indexes: list of lists of volume indexes, one list per group
+    :return: 4D Image: mean of each group along the 4th dimension. If each group contains a single volume, the data
+    type of the input is kept, otherwise the means are in float32.
+    """
+    nx, ny, nz, nt = im_data.data.shape[:4]
+    group_of_volume = -np.ones(nt, dtype=int)
+    for i_group, index in enumerate(group_indexes):
+        group_of_volume[index] = i_group
+    no_averaging = all(len(index) == 1 for index in group_indexes)
+    data_mean = np.zeros((nx, ny, nz, len(group_indexes)), dtype=im_data.data.dtype if no_averaging else np.float64)
+    for it in np.nonzero(group_of_volume >= 0)[0]:
+        data_mean[..., group_of_volume[it]] += im_data.data[..., it]
+    if not no_averaging:
+        data_mean = (data_mean / [len(index) for index in group_indexes]).astype(np.float32)
+    return image_like(im_data, data_mean)
+
+
+def image_like(im_ref, data):
+    """
+    :return: Image with the header of im_ref (e.g. one or several volumes of a 4D image) and the given data
+    """
+    hdr = im_ref.hdr.copy()
+    hdr.set_data_dtype(data.dtype)
+    return Image(data, hdr=hdr)
+
+
+def register(param, file_src, file_dest, file_mat, file_out, im_mask=None, env=None):
     """
     Register two images by estimating slice-wise Tx and Ty transformations, which are regularized along Z. This function
     uses ANTs' isct_antsSliceRegularizedRegistration.
@@ -210,6 +285,7 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
     :param file_mat:
     :param file_out:
     :param im_mask: Image of mask, could be 2D or 3D
+    :param env: environment of the ANTs process
     :return:
     """
 
@@ -268,7 +344,7 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
                 cmd += ['--mask', im_mask.absolutepath]
         # run command
         if do_registration:
-            status, output = sct.run(cmd, verbose=0)
+            status, output = sct.run(cmd, verbose=0, env=env)
 
     elif param.todo == 'apply':
         sct_apply_transfo.main(args=['-i', file_src,
@@ -15,25 +15,38 @@
 from __future__ import absolute_import, division
 
 import gzip
+import json
 import os
 import pickle
 import shutil
 import sys
+import tempfile
 import time
 
 import numpy as np
 import pandas as pd
-from sklearn import decomposition, manifold
 
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, normalize_slice,
+from msct_gmseg_utils import (Slice, apply_transfo, average_gm_wm, normalize_slice,
                               pre_processing, register_data)
 from spinalcordtoolbox.image import Image
 from msct_parser import Parser
 from sct_utils import printv
 import sct_utils as sct
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 
+# Version of the binary model format, written in the model description file. The model arrays are saved as .npy files
+# (loaded as memory maps) in the model folder, see Model.save_model().
+MODEL_FORMAT_VERSION = 1
+MODEL_DESCRIPTION_FILE = 'model.json'
+# legacy model format: gzip-compressed pickles
+MODEL_PICKLE_FILES = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+
 def get_parser():
     # Initialize the parser
     parser = Parser(__file__)
@@ -46,8 +59,14 @@ def get_parser():
     parser.add_option(name="-path-data",
                       type_value="folder",
                       description="Path to the dataset",
-                      mandatory=True,
+                      mandatory=False,
                       example='my_data/')
+    parser.add_option(name="-convert",
+                      type_value="folder",
+                      description="Instead of computing a model, convert the model in this folder from the legacy model "
+                                  "format (gzip-compressed pickles) to the binary model format.",
+                      mandatory=False,
+                      example=ParamModel().path_model_to_load)
     parser.add_option(name="-o",
                       type_value="folder_creation",
                       description="Output folder",
@@ -181,6 +200,32 @@ class Param:
         self.rm_tmp = True
 
 
+class PCAModel:
+    """
+    PCA fitted to the model data, stored as plain arrays so that the model can be loaded without unpickling
+    sklearn objects. transform() is equivalent to sklearn.decomposition.PCA.transform().
+    """
+    def __init__(self, components, mean, explained_variance=None):
+        """
+        :param components: principal axes, array (n_components, n_features)
+        :param mean: mean of the data, array (n_features,)
+        :param explained_variance: variance of each component if the PCA is whitened, None otherwise
+        """
+        self.components = components
+        self.mean = mean
+        self.explained_variance = explained_variance
+
+    @classmethod
+    def from_sklearn(cls, pca):
+        return cls(pca.components_, pca.mean_, pca.explained_variance_ if pca.whiten else None)
+
+    def transform(self, data):
+        data_transformed = np.dot(data - self.mean, self.components.T)
+        if self.explained_variance is not None:
+            data_transformed /= np.sqrt(self.explained_variance)
+        return data_transformed
+
+
 class Model:
     def __init__(self, param_model=None, param_data=None, param=None):
         self.param_model = param_model if param_model is not None else ParamModel()
@@ -388,6 +433,8 @@ class Model:
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_reduced_space(self):
+        from sklearn import decomposition, manifold
+
         model = None
         model_data =  np.asarray([dic_slice.im_M.flatten() for dic_slice in self.slices])
 
@@ -395,6 +442,7 @@ class Model:
             # PCA
             model = decomposition.PCA(n_components=self.param_model.k_pca)
             self.fitted_data = model.fit_transform(model_data)
+            model = PCAModel.from_sklearn(model)
 
         if self.param_model.method == 'isomap':
             # ISOMAP
@@ -408,27 +456,56 @@ class Model:
         self.fitted_model = model
 
     # ------------------------------------------------------------------------------------------------------------------
-    def save_model(self):
-        curdir = os.getcwd()
-        os.chdir(self.param_model.new_model_dir)
-        # to save:
-        # - self.slices = dictionary
-        slices = self.slices
-        pickle.dump(slices, gzip.open('slices.pklz', 'wb'), protocol=2)
-
-        # - self.intensities = for normalization
-        intensities = self.intensities
-        pickle.dump(intensities, gzip.open('intensities.pklz', 'wb'), protocol=2)
+    def save_model(self, path_model=None):
+        """
+        Save the model in the binary model format:
+        - model.json: format version, reduced space method, PCA whitening, intensities for normalization
+        - im.npy, im_M.npy: dictionary images in the original and model space, float32 arrays (nb slices, nx, ny)
+        - gm_seg_M.npy, wm_seg_M.npy: manual segmentations in the model space of all the slices, float32 arrays (nb
+          segmentations, nx, ny), and nb_gm_seg.npy, nb_wm_seg.npy: number of segmentations of each slice
+        - levels.npy: vertebral level of each slice
+        - mean_image.npy: mean of the dictionary images
+        - fitted_data.npy: dictionary data fitted to the model (=eigen vectors or embedding vectors)
+        - pca_components.npy, pca_mean.npy, pca_explained_variance.npy: PCA reduced space, or fitted_model.pklz: pickled
+          isomap reduced space
+
+        :param path_model: model folder. Default: param_model.new_model_dir
+        """
+        if path_model is None:
+            path_model = self.param_model.new_model_dir
+        arrays = {'im': np.array([dic_slice.im for dic_slice in self.slices], dtype=np.float32),
+                  'im_M': np.array([dic_slice.im_M for dic_slice in self.slices], dtype=np.float32),
+                  'gm_seg_M': np.array([gm for dic_slice in self.slices for gm in dic_slice.gm_seg_M], dtype=np.float32),
+                  'wm_seg_M': np.array([wm for dic_slice in self.slices for wm in dic_slice.wm_seg_M], dtype=np.float32),
+                  'nb_gm_seg': np.array([len(dic_slice.gm_seg_M) for dic_slice in self.slices]),
+                  'nb_wm_seg': np.array([len(dic_slice.wm_seg_M) for dic_slice in self.slices]),
+                  'levels': np.array([dic_slice.level for dic_slice in self.slices], dtype=np.float64),
+                  'mean_image': np.asarray(self.mean_image, dtype=np.float64),
+                  'fitted_data': np.asarray(self.fitted_data)}
 
         # - reduced space (pca or isomap)
-        model = self.fitted_model
-        pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
+        description = {'format_version': MODEL_FORMAT_VERSION}
+        if isinstance(self.fitted_model, PCAModel):
+            description['method'] = 'pca'
+            description['whiten'] = self.fitted_model.explained_variance is not None
+            arrays['pca_components'] = self.fitted_model.components
+            arrays['pca_mean'] = self.fitted_model.mean
+            if description['whiten']:
+                arrays['pca_explained_variance'] = self.fitted_model.explained_variance
+        else:
+            description['method'] = 'isomap'
+            pickle.dump(self.fitted_model, gzip.open(os.path.join(path_model, MODEL_PICKLE_FILES['model']), 'wb'), protocol=2)
 
-        # - fitted data (=eigen vectors or embedding vectors )
-        data = self.fitted_data
-        pickle.dump(data, gzip.open('fitted_data.pklz', 'wb'), protocol=2)
+        # - self.intensities = for normalization
+        description['intensities'] = {'levels': self.intensities.index.tolist()}
+        for key in self.intensities.columns:
+            description['intensities'][key] = self.intensities[key].tolist()
 
-        os.chdir(curdir)
+        for name, data in arrays.items():
+            np.save(os.path.join(path_model, name + '.npy'), data)
+        # the description is written last, so that incomplete models are not loaded
+        with open(os.path.join(path_model, MODEL_DESCRIPTION_FILE), 'w') as f:
+            json.dump(description, f, indent=2)
 
     # ----------------------------------- END OF FUNCTIONS USED TO COMPUTE THE MODEL -----------------------------------
 
@@ -436,43 +513,101 @@ class Model:
     #                                       FUNCTIONS USED TO LOAD THE MODEL
     # ------------------------------------------------------------------------------------------------------------------
     def load_model(self):
-        path = os.path.abspath('.')
         printv('\nLoading model...', self.param.verbose, 'normal')
-        os.chdir(self.param_model.path_model_to_load)
+        path_model = self.param_model.path_model_to_load
+        if os.path.isfile(os.path.join(path_model, MODEL_DESCRIPTION_FILE)):
+            self.load_model_arrays(path_model)
+        else:
+            # legacy model: the model folder is not modified here, see convert_model()
+            self.load_model_pickles(path_model)
+            printv('  WARNING: The model is in the legacy model format, which is slower to load. To convert it, run:\n'
+                   '  msct_multiatlas_seg -convert ' + path_model, self.param.verbose, 'warning')
+
+        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
+        printv('  model: ' + self.param_model.method)
+        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
+        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
 
-        model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+    def model_error(self):
+        printv('ERROR: The GM segmentation model is not compatible with this version of the code.\n'
+               'To update the model, run the following lines:\n\n'
+               'cd ' + path_sct + '\n'
+               './install_sct -m -b\n', self.param.verbose, 'error')
+
+    def load_model_arrays(self, path_model):
+        """
+        Load a model saved in the binary model format (see save_model()). The arrays are memory-mapped, so that only
+        the data which is used is read.
+        """
+        with open(os.path.join(path_model, MODEL_DESCRIPTION_FILE)) as f:
+            description = json.load(f)
+        if description.get('format_version') != MODEL_FORMAT_VERSION:
+            self.model_error()
+
+        def load(name):
+            return np.load(os.path.join(path_model, name + '.npy'), mmap_mode='r')
+
+        # - self.slices = dictionary
+        levels = load('levels')
+        im, im_M, gm_seg_M, wm_seg_M = load('im'), load('im_M'), load('gm_seg_M'), load('wm_seg_M')
+        index_gm = np.concatenate(([0], np.cumsum(load('nb_gm_seg'))))
+        index_wm = np.concatenate(([0], np.cumsum(load('nb_wm_seg'))))
+        self.slices = [Slice(slice_id=i, im=im[i], im_m=im_M[i], gm_seg_m=list(gm_seg_M[index_gm[i]:index_gm[i + 1]]),
+                             wm_seg_m=list(wm_seg_M[index_wm[i]:index_wm[i + 1]]), level=float(levels[i]))
+                       for i in range(len(levels))]
+        self.mean_image = np.array(load('mean_image'))
+
+        # - self.intensities = for normalization
+        intensities = description['intensities']
+        levels_intensities = intensities.pop('levels')
+        self.intensities = pd.DataFrame({key: pd.Series(values, index=levels_intensities)
+                                         for key, values in intensities.items()})
+
+        # - reduced space (pca or isomap)
+        self.param_model.method = description['method']
+        if self.param_model.method == 'pca':
+            explained_variance = np.array(load('pca_explained_variance')) if description['whiten'] else None
+            self.fitted_model = PCAModel(np.array(load('pca_components')), np.array(load('pca_mean')), explained_variance)
+        else:
+            self.fitted_model = pickle.load(gzip.open(os.path.join(path_model, MODEL_PICKLE_FILES['model']), 'rb'))
+
+        # - fitted data (=eigen vectors or embedding vectors )
+        self.fitted_data = np.array(load('fitted_data'))
+
+    def load_model_pickles(self, path_model):
+        """
+        Load a model saved in the legacy model format (gzip-compressed pickles).
+        """
         correct_model = True
-        for fname in model_files.values():
-            if os.path.isfile(fname):
+        for fname in MODEL_PICKLE_FILES.values():
+            if os.path.isfile(os.path.join(path_model, fname)):
                 printv('  OK: ' + fname, self.param.verbose, 'normal')
             else:
                 printv('  MISSING FILE: ' + fname, self.param.verbose, 'warning')
                 correct_model = False
         if not correct_model:
-            path_script = os.path.dirname(__file__)
-            printv('ERROR: The GM segmentation model is not compatible with this version of the code.\n'
-                   'To update the model, run the following lines:\n\n'
-                   'cd ' + path_sct + '\n'
-                   './install_sct -m -b\n', self.param.verbose, 'error')
+            self.model_error()
+
+        def load(key):
+            return pickle.load(gzip.open(os.path.join(path_model, MODEL_PICKLE_FILES[key]), 'rb'))
 
         # - self.slices = dictionary
-        self.slices = pickle.load(gzip.open(model_files['slices'],  'rb'))
-        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
+        self.slices = load('slices')
         self.mean_image = np.mean([dic_slice.im for dic_slice in self.slices], axis=0)
 
         # - self.intensities = for normalization
-        self.intensities = pickle.load(gzip.open(model_files['intensity'], 'rb'))
+        self.intensities = load('intensity')
 
         # - reduced space (pca or isomap)
-        self.fitted_model = pickle.load(gzip.open(model_files['model'], 'rb'))
+        self.fitted_model = load('model')
+        if hasattr(self.fitted_model, 'components_'):
+            self.param_model.method = 'pca'
+            self.fitted_model = PCAModel.from_sklearn(self.fitted_model)
+        else:
+            self.param_model.method = 'isomap'
 
         # - fitted data (=eigen vectors or embedding vectors )
-        self.fitted_data = pickle.load(gzip.open(model_files['data'], 'rb'))
-
-        printv('  model: ' + self.param_model.method)
-        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
-        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
-        os.chdir(path)
+        self.fitted_data = load('data')
 
     # ------------------------------------------------------------------------------------------------------------------
     #                                                   UTILS FUNCTIONS
@@ -500,6 +635,44 @@ class Model:
         return gm_seg_model, wm_seg_model
 
 
+def convert_model(path_model, verbose=1):
+    """
+    Convert a model from the legacy model format (gzip-compressed pickles) to the binary model format, which
+    Model.load_model() loads faster.
+
+    The converted model is written into a temporary folder next to the model folder, then renamed into place (the
+    legacy files are kept in it), so that the files of the model folder are never rewritten while another process reads
+    them. Conversions of the same folder are serialized with a lock file.
+
+    :param path_model: model folder
+    :param verbose:
+    :return: True if the model was converted, False if it was already in the binary model format
+    """
+    path_model = os.path.abspath(path_model)
+    with open(path_model + '.lock', 'a') as f_lock:
+        if fcntl is not None:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+        if os.path.isfile(os.path.join(path_model, MODEL_DESCRIPTION_FILE)):
+            printv('Model already in the binary model format: ' + path_model, verbose, 'normal')
+            return False
+
+        model = Model(param=Param())
+        model.param.verbose = verbose
+        model.load_model_pickles(path_model)
+
+        path_tmp = tempfile.mkdtemp(prefix=os.path.basename(path_model) + '.', dir=os.path.dirname(path_model))
+        try:
+            path_model_new = os.path.join(path_tmp, 'model')
+            shutil.copytree(path_model, path_model_new)
+            model.save_model(path_model_new)
+            os.rename(path_model, os.path.join(path_tmp, 'legacy'))
+            os.rename(path_model_new, path_model)
+        finally:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+    printv('Model converted to the binary model format: ' + path_model, verbose, 'normal')
+    return True
+
+
 def main(args=None):
 
     if args is None:
@@ -514,6 +687,11 @@ def main(args=None):
     parser = get_parser()
     arguments = parser.parse(args)
 
+    if '-convert' in arguments:
+        convert_model(arguments['-convert'], verbose=int(arguments['-v']))
+        return
+    if '-path-data' not in arguments:
+        printv('ERROR: -path-data is required to compute a model.', 1, 'error')
     param_model.path_data = arguments['-path-data']
 
     if '-o' in arguments:
@@ -65,12 +65,80 @@ from __future__ import division, absolute_import
 
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 import sct_utils as sct
 
+
 class ReconstructionError(RuntimeError):
     pass
 
+
+def _inverse(values):
+    """Inverse of the values, 0 where the values are 0."""
+    with np.errstate(divide='ignore'):
+        return np.where(values != 0, 1 / values, 0.0)
+
+
+def basis_functions(knots, order, params):
+    """
+    Evaluate the B-spline basis functions and their derivatives, for all parameters at once, with the Cox-de Boor
+    recursion.
+
+    :param knots: knot vector, of length (number of functions + order)
+    :param order: order of the B-spline (degree + 1)
+    :param params: parameters at which the functions are evaluated
+    :return: basis, basis_deriv: arrays of shape (number of parameters, number of functions)
+    """
+    knots = np.asarray(knots, dtype=np.float64)
+    params = np.asarray(params, dtype=np.float64)[:, np.newaxis]
+    # order 1: indicator functions of the knot spans. The last non-empty span is closed, so that the end of the
+    # curve is defined.
+    basis = ((knots[:-1] <= params) & (params < knots[1:])).astype(np.float64)
+    last_span = np.flatnonzero(knots[:-1] < knots[1:])[-1]
+    basis[params[:, 0] == knots[last_span + 1], last_span] = 1.0
+    basis_deriv = np.zeros_like(basis)
+    for k in range(2, order + 1):
+        inv_left = _inverse(knots[k - 1:-1] - knots[:-k])
+        inv_right = _inverse(knots[k:] - knots[1:len(knots) - k + 1])
+        if k == order:
+            basis_deriv = k * (inv_left * basis[:, :-1] - inv_right * basis[:, 1:])
+        basis = (params - knots[:-k]) * inv_left * basis[:, :-1] + (knots[k:] - params) * inv_right * basis[:, 1:]
+    return basis, basis_deriv
+
+
+def average_over_slices(z, values):
+    """
+    Average values over the integer slices of their (sorted) coordinates z.
+
+    :param z: sorted coordinates, rounded to the nearest slice
+    :param values: array of shape (len(z), number of values)
+    :return: slices, values_mean: all slices between the first and the last one, and the averaged values. In order to
+    deal with missing slices (not perfect but works if "enough" points), each missing slice is set to the mean of the
+    previous slice and of the first point of the next slice.
+    """
+    z = np.round(z).astype(int)
+    index_slices = z - z[0]
+    nb_slices = index_slices[-1] + 1
+    count = np.bincount(index_slices, minlength=nb_slices)
+    values_mean = np.column_stack([np.bincount(index_slices, weights=values[:, i], minlength=nb_slices)
+                                   for i in range(values.shape[1])])
+    values_mean /= np.maximum(count, 1)[:, np.newaxis]
+
+    missing = np.flatnonzero(count == 0)
+    if len(missing):
+        present = np.flatnonzero(count)
+        index_next = np.searchsorted(present, missing)
+        slice_prev, slice_next = present[index_next - 1], present[index_next]
+        # last point of the previous slice, first point of the next slice
+        values_prev = values[np.searchsorted(index_slices, slice_prev, side='right') - 1]
+        values_next = values[np.searchsorted(index_slices, slice_next)]
+        weight_prev = 0.5 ** (missing - slice_prev)[:, np.newaxis]
+        values_mean[missing] = values_next + weight_prev * (values_prev - values_next)
+
+    return np.arange(z[0], z[-1] + 1), values_mean
+
+
 class NURBS():
     def __init__(self, degre=3, precision=1000, liste=None, sens=False, nbControl=None, verbose=1, tolerance=0.01, maxControlPoints=50, all_slices=True, twodim=False, weights=True):
         """
@@ -124,18 +192,14 @@ class NURBS():
                     sct.printv('ERROR : There are too few points to compute. The number of points of the curve must be strictly superior to degre +2 which is: ' + str(self.nbControle) + '. Either change degre to a lower value, either add points to the curve.', type="error")
 
                 # compute weights based on curve density
-                w = [1.0] * len(P_x)
+                if not twodim:
+                    data = np.column_stack((P_x, P_y, P_z)).astype(np.float64)
+                else:
+                    data = np.column_stack((P_x, P_y)).astype(np.float64)
+                w = np.ones(len(P_x))
                 if weights:
-                    if not twodim:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = np.sqrt((P_x[i - 1] - P_x[i])**2 + (P_y[i - 1] - P_y[i])**2 + (P_z[i - 1] - P_z[i])**2)
-                            dist_after = np.sqrt((P_x[i] - P_x[i + 1])**2 + (P_y[i] - P_y[i + 1])**2 + (P_z[i] - P_z[i + 1])**2)
-                            w[i] = (dist_before + dist_after) / 2.0
-                    else:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = np.sqrt((P_x[i - 1] - P_x[i])**2 + (P_y[i - 1] - P_y[i])**2)
-                            dist_after = np.sqrt((P_x[i] - P_x[i + 1])**2 + (P_y[i] - P_y[i + 1])**2)
-                            w[i] = (dist_before + dist_after) / 2.0
+                    distances = np.linalg.norm(np.diff(data, axis=0), axis=1)
+                    w[1:-1] = (distances[:-1] + distances[1:]) / 2.0
                     w[0], w[-1] = w[1], w[-2]
 
                 list_param_that_worked = []
@@ -159,25 +223,14 @@ class NURBS():
                             self.pointsControle = self.reconstructGlobalApproximation2D(P_x, P_y, self.degre, self.nbControle, w)
                             self.courbe2D, self.courbe2D_deriv = self.construct2D(self.pointsControle, self.degre, self.precision / 3)
 
-                        # compute error between the input data and the nurbs
-                        error_curve = 0.0
+                        # compute error between the input data and the nurbs: mean squared distance to the nearest
+                        # point of the curve
                         if not twodim:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe3D[0])):
-                                    dist = (self.courbe3D[0][k] - P_x[i])**2 + (self.courbe3D[1][k] - P_y[i])**2 + (self.courbe3D[2][k] - P_z[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
+                            curve = np.column_stack(self.courbe3D)
                         else:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe2D[0])):
-                                    dist = (self.courbe2D[0][k] - P_x[i])**2 + (self.courbe2D[1][k] - P_y[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
-                        error_curve /= float(len(P_x))
+                            curve = np.column_stack(self.courbe2D)
+                        min_dist, _ = cKDTree(curve).query(data)
+                        error_curve = np.mean(np.minimum(min_dist ** 2, 10000.0))
 
                         if verbose >= 1:
                             sct.printv('Error on approximation = ' + str(np.round(error_curve, 2)) + ' mm')
@@ -247,62 +300,22 @@ class NURBS():
     def getCourbe2D_deriv(self):
         return self.courbe2D_deriv
 
-    # Multiplie deux polynomes
-    def multipolynome(self, polyA, polyB):
-        result = []
-        for r in polyB:
-            temp = polyA * r[0]
-            result.append([temp, r[-1]])
-        return result
-
-    def N(self, i, k, x):
-        global Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(1), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp[i][k - 1] == -1:
-                    Nik_temp[i][k - 1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([1 / den_g, -x[i] / den_g]), Nik_temp[i][k - 1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp[i + 1][k - 1] == -1:
-                    Nik_temp[i + 1][k - 1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-1 / den_d, x[i + k] / den_d]), Nik_temp[i + 1][k - 1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def Np(self, i, k, x):
-        global Nik_temp_deriv, Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(0), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp_deriv[i][-1] == -1:
-                    Nik_temp_deriv[i][-1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([k / den_g]), Nik_temp_deriv[i][-1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp_deriv[i + 1][-1] == -1:
-                    Nik_temp_deriv[i + 1][-1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-k / den_d]), Nik_temp_deriv[i + 1][-1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def evaluateN(self, Ni, t, x):
-        result = 0
-        for Ni_temp in Ni:
-            if x[Ni_temp[-1] - 1] <= t <= x[Ni_temp[-1]]:
-                result += Ni_temp[0](t)
-        return result
+    def evaluate_curve(self, P, k, x, param):
+        """
+        Evaluate the B-spline curve and its derivative.
+
+        :param P: control points, array of shape (number of control points, dimension)
+        :param k: order of the B-spline
+        :param x: knot vector
+        :param param: parameters at which the curve is evaluated
+        :return: points, derivatives: arrays of shape (len(param), dimension)
+        """
+        P = np.asarray(P, dtype=np.float64)
+        basis, basis_deriv = basis_functions(x, k, param)
+        sum_den = basis.sum(axis=1)  # sum_den = 1 !
+        if np.any(sum_den <= 0.05):
+            raise ReconstructionError()
+        return basis.dot(P) / sum_den[:, np.newaxis], basis_deriv.dot(P)
 
     def calculX3D(self, P, k):
         n = len(P) - 1
@@ -343,367 +356,86 @@ class NURBS():
         return x
 
     def construct3D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
-        param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
+        param = np.linspace(x[0], x[-1], int(prec))
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
-
         if self.all_slices:
-            P_z = np.array([int(np.round(P_z[i])) for i in range(0, len(P_z))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_z), max(P_z) + 1, 1):
-                if i not in P_z:
-                    # sct.printv(' Missing z slice ')
-                    # sct.printv(i)
-                    P_z_temp = np.insert(P_z, np.where(P_z == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_z == i - 1)[-1][-1] + 1, (P_x[np.where(P_z == i - 1)[-1][-1]] + P_x[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_temp = np.insert(P_y, np.where(P_z == i - 1)[-1][-1] + 1, (P_y[np.where(P_z == i - 1)[-1][-1]] + P_y[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_z == i - 1)[-1][-1] + 1, (P_x_d[np.where(P_z == i - 1)[-1][-1]] + P_x_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_z == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_z == i - 1)[-1][-1]] + P_y_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_z_d_temp = np.insert(P_z_d, np.where(P_z == i - 1)[-1][-1] + 1, (P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
-
-            coord_mean = np.array([[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            P_z, values = average_over_slices(P_z, np.column_stack((P_x, P_y, P_x_d, P_y_d, P_z_d)))
+            P_z = P_z.astype(np.float64)
+            P_x, P_y, P_x_d, P_y_d, P_z_d = values.T
 
         return [P_x, P_y, P_z], [P_x_d, P_y_d, P_z_d]
 
     def construct2D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX2D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
-        param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y = [], []  # coord fitees
-        P_x_d, P_y_d = [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_den = 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_den_der = 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_y)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_y)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_y)]
-        P_y = np.sort(P_y)
+        param = np.linspace(x[0], x[-1], int(prec))
+        points, derivatives = self.evaluate_curve(P, k, x, param)
+        order = np.argsort(points[:, 1])
+        P_x, P_y = points[order].T
+        P_x_d, P_y_d = derivatives[order].T
 
         # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-
         if self.all_slices:
-            P_y = np.array([int(np.round(P_y[i])) for i in range(0, len(P_y))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_y), max(P_y) + 1, 1):
-                if i not in P_y:
-                    P_y_temp = np.insert(P_y, np.where(P_y == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_y == i - 1)[-1][-1] + 1, (P_x[np.where(P_y == i - 1)[-1][-1]] + P_x[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_y == i - 1)[-1][-1] + 1, (P_x_d[np.where(P_y == i - 1)[-1][-1]] + P_x_d[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_y == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_y == i - 1)[-1][-1]] + P_y_d[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_x_d, P_y_d = P_x_temp, P_y_temp, P_x_d_temp, P_y_d_temp
-
-            coord_mean = np.array([[np.mean(P_x[P_y == i]), i] for i in range(min(P_y), max(P_y) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_y == i]), np.mean(P_y_d[P_y == i])] for i in range(min(P_y), max(P_y) + 1, 1)])
-
-            P_y = coord_mean[:, :][:, 1]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
+            P_y, values = average_over_slices(P_y, np.column_stack((P_x, P_x_d, P_y_d)))
+            P_y = P_y.astype(np.float64)
+            P_x, P_x_d, P_y_d = values.T
 
         return [P_x, P_y], [P_x_d, P_y_d]
 
-    def Tk(self, k, Q, Nik, ubar, u):
-        return Q[k] - self.evaluateN(Nik[-1], ubar, u) * Q[-1] - self.evaluateN(Nik[0], ubar, u) * Q[0]
-
     def isXinY(self, y, x):
-        result = True
-        for i in range(0, len(y) - 1):
-            if y[i] - y[i + 1] != 0.0:
-                result_temp = False
-                for j in range(0, len(x)):
-                    if y[i] - y[i + 1] != 0.0 and y[i] <= x[j] <= y[i + 1]:
-                        result_temp = True
-                        break
-                result = result and result_temp
-        return result
+        """
+        :return: True if there is at least one value of x in each non-empty interval [y[i], y[i + 1]]
+        """
+        y, x = np.asarray(y), np.sort(x)
+        non_empty = y[:-1] != y[1:]
+        count = np.searchsorted(x, y[1:], side='right') - np.searchsorted(x, y[:-1], side='left')
+        return bool(np.all(count[non_empty] > 0))
 
     def reconstructGlobalApproximation(self, P_x, P_y, P_z, p, n, w):
         # p = degre de la NURBS
         # n = nombre de points de controle desires
         # w is the weigth on each point P
-        global Nik_temp
-        m = len(P_x)
-
-        # Calcul des chords
-        di = 0.0
-        for k in range(m - 1):
-            di += np.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2 + (P_z[k + 1] - P_z[k])**2)
-        ubar = [0]
-        for k in range(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(ubar[-1] + np.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2 + (P_z[k + 1] - P_z[k])**2) / di)  # centripetal method
-
-        # the knot vector should reflect the distribution of ubar
-        d = (m + 1) / (n - p + 1)
-        u_nonuniform = [0.0] * p
-        for j in range(n - p):
-            i = int((j + 1) * d)
-            alpha = (j + 1) * d - i
-            u_nonuniform.append((1 - alpha) * ubar[i - 1] + alpha * ubar[i])
-        u_nonuniform.extend([1.0] * p)
-
-        # the knot vector can also is uniformly distributed
-        u_uniform = [0.0] * p
-        for j in range(n - p):
-            u_uniform.append((float(j) + 1) / float(n - p))
-        u_uniform.extend([1.0] * p)
-
-        # The only condition for NURBS to work here is that there is at least one point P_.. in each knot space.
-        # The uniform knot vector does not ensure this condition while the nonuniform knot vector ensure it but lack of uniformity in case of variable density of points.
-        # We need a compromise between the two methods: the knot vector must be as uniform as possible, with at least one point between each pair of knots.
-        # New algo:
-        # knotVector = uniformKnotVector
-        # while isKnotSpaceEmpty:
-        #     knotVector += gamma * (nonuniformKnotVector - nonuniformKnotVector)
-        #     # where gamma is a ratio [0,1] multiplier of an integer: 1/gamma = int
-        u_uniform = np.array(u_uniform)
-        u_nonuniform = np.array(u_nonuniform)
-        u = np.array(u_uniform, copy=True)
-        gamma = 1.0 / 10.0
-        n_iter = 0
-        while not self.isXinY(y=u, x=ubar) and n_iter <= 10000:
-            u += gamma * (u_nonuniform - u_uniform)
-            n_iter += 1
-
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]  # noqa
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in range(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in range(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in range(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        Tz = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_z, Nik, ubar[k], u) / denU[k]
-            Tz.append(somme)
-        Tz = np.matrix(Tz)
-
-        P_xb = (R.T * W * R).I * Tx.T
-        P_yb = (R.T * W * R).I * Ty.T
-        P_zb = (R.T * W * R).I * Tz.T
-
-        # Modification of first and last control points
-        P_xb[0], P_yb[0], P_zb[0] = P_x[0], P_y[0], P_z[0]
-        P_xb[-1], P_yb[-1], P_zb[-1] = P_x[-1], P_y[-1], P_z[-1]
-
-        # At this point, we need to check if the control points are in a correct range or if there were instability.
-        # Typically, control points should be far from the data points. One way to do so is to ensure that the
-        from numpy import std
-        std_factor = 10.0
-        std_Px, std_Py, std_Pz, std_x, std_y, std_z = std(P_xb), std(P_yb), std(P_zb), std(np.array(P_x)), std(np.array(P_y)), std(np.array(P_z))
-        if std_x >= 0.1 and std_y >= 0.1 and std_z >= 0.1 and (std_Px > std_factor * std_x or std_Py > std_factor * std_y or std_Pz > std_factor * std_z):
-            raise ReconstructionError()
-
-        P = [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
-
-        return P
+        return self.reconstruct_global_approximation(np.column_stack((P_x, P_y, P_z)), p, n, w)
 
     def reconstructGlobalApproximation2D(self, P_x, P_y, p, n, w):
-        # p = degre de la NURBS
-        # n = nombre de points de controle desires
-        # w is the weigth on each point P
-        global Nik_temp
-        m = len(P_x)
+        return self.reconstruct_global_approximation(np.column_stack((P_x, P_y)), p, n, w)
 
-        # Calcul des chords
-        di = 0.0
-        for k in range(m - 1):
-            di += np.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2)
-        ubar = [0]
-        for k in range(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(ubar[-1] + np.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2) / di)  # centripetal method
+    def reconstruct_global_approximation(self, P, p, n, w):
+        """
+        Weighted least square approximation of the data points by a B-spline, whose first and last control points are
+        the first and last data points.
+
+        :param P: data points, array of shape (number of points, dimension)
+        :param p: order of the B-spline
+        :param n: number of control points
+        :param w: weight of each data point
+        :return: list of control points
+        """
+        P = np.asarray(P, dtype=np.float64)
+        m = len(P)
+        w = np.asarray(w, dtype=np.float64)
+
+        # Calcul des chords: centripetal method
+        chords = np.linalg.norm(np.diff(P, axis=0), axis=1)
+        ubar = np.concatenate(([0.0], np.cumsum(chords / chords.sum())))
 
         # the knot vector should reflect the distribution of ubar
         d = (m + 1) / (n - p + 1)
-        u_nonuniform = [0.0] * p
-        for j in range(n - p):
-            i = int((j + 1) * d)
-            alpha = (j + 1) * d - i
-            u_nonuniform.append((1 - alpha) * ubar[i - 1] + alpha * ubar[i])
-        u_nonuniform.extend([1.0] * p)
+        j = np.arange(1, n - p + 1)
+        i = (j * d).astype(int)
+        alpha = j * d - i
+        u_nonuniform = np.concatenate(([0.0] * p, (1 - alpha) * ubar[i - 1] + alpha * ubar[i], [1.0] * p))
 
         # the knot vector can also is uniformly distributed
-        u_uniform = [0.0] * p
-        for j in range(n - p):
-            u_uniform.append((float(j) + 1) / float(n - p))
-        u_uniform.extend([1.0] * p)
+        u_uniform = np.concatenate(([0.0] * p, j / (n - p), [1.0] * p))
 
         # The only condition for NURBS to work here is that there is at least one point P_.. in each knot space.
         # The uniform knot vector does not ensure this condition while the nonuniform knot vector ensure it but lack of uniformity in case of variable density of points.
@@ -713,8 +445,6 @@ class NURBS():
         # while isKnotSpaceEmpty:
         #     knotVector += gamma * (nonuniformKnotVector - nonuniformKnotVector)
         #     # where gamma is a ratio [0,1] multiplier of an integer: 1/gamma = int
-        u_uniform = np.array(u_uniform)
-        u_nonuniform = np.array(u_nonuniform)
         u = np.array(u_uniform, copy=True)
         gamma = 1.0 / 10.0
         n_iter = 0
@@ -722,71 +452,26 @@ class NURBS():
             u += gamma * (u_nonuniform - u_uniform)
             n_iter += 1
 
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]  # noqa
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in range(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in range(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in range(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        P_xb = (R.T * W * R).I * Tx.T
-        P_yb = (R.T * W * R).I * Ty.T
+        basis = basis_functions(u, p, ubar[:-1])[0]
+        R = basis[:, :-1] / basis.sum(axis=1)[:, np.newaxis]
+
+        # data points, minus the contribution of the first and last control points, weighted
+        T = w[:-1, np.newaxis] * (P[:-1] - np.outer(basis[:, -1], P[-1]) - np.outer(basis[:, 0], P[0]))
+        P_b = np.linalg.inv((R.T * w[:-1]).dot(R)).dot(R.T.dot(T))
 
         # Modification of first and last control points
-        P_xb[0], P_yb[0] = P_x[0], P_y[0]
-        P_xb[-1], P_yb[-1] = P_x[-1], P_y[-1]
+        P_b[0], P_b[-1] = P[0], P[-1]
 
         # At this point, we need to check if the control points are in a correct range or if there were instability.
         # Typically, control points should be far from the data points. One way to do so is to ensure that the
-        from numpy import std
         std_factor = 10.0
-        std_Px, std_Py, std_x, std_y = std(P_xb), std(P_yb), std(np.array(P_x)), std(np.array(P_y))
-        if std_x >= 0.1 and std_y >= 0.1 and (std_Px > std_factor * std_x or std_Py > std_factor * std_y):
+        std_P, std_data = np.std(P_b, axis=0), np.std(P, axis=0)
+        if np.all(std_data >= 0.1) and np.any(std_P > std_factor * std_data):
             raise ReconstructionError()
 
-        P = [[P_xb[i, 0], P_yb[i, 0]] for i in range(len(P_xb))]
-
-        return P
+        return P_b.tolist()
 
     def reconstructGlobalInterpolation(self, P_x, P_y, P_z, p):  # now in 3D
-        global Nik_temp
         n = 13
         l = len(P_x)
         newPx = P_x[::int(np.round(l / (n - 1)))]
@@ -812,22 +497,8 @@ class NURBS():
             u.append(sumU / p)
         u.extend([1] * p)
 
-        # Construction des fonctions basiques
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
         # Construction des matrices
-        M = []
-        for i in range(n):
-            ligneM = []
-            for j in range(n):
-                ligneM.append(self.evaluateN(Nik[j], ubar[i], u))
-            M.append(ligneM)
-        M = np.matrix(M)
+        M = np.matrix(basis_functions(u, p, ubar)[0])
 
         # Matrice des points interpoles
         Qx = np.matrix(newPx).T
@@ -841,141 +512,34 @@ class NURBS():
 
         return [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
 
-    def compute_curve_from_parametrization(self, P, k, x, Nik, Nikp, param):
-        n = len(P)  # Nombre de points de controle - 1
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
-
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
+    def compute_curve_from_parametrization(self, P, k, x, param):
+        points, derivatives = self.evaluate_curve(P, k, x, param)
+        order = np.argsort(points[:, 2])
+        P_x, P_y, P_z = points[order].T
+        P_x_d, P_y_d, P_z_d = derivatives[order].T
         return P_x, P_y, P_z, P_x_d, P_y_d, P_z_d
 
     def construct3D_uniform(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         # reparametrization of the curve
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
-        from msct_types import Centerline
-        centerline = Centerline(P_x, P_y, P_z, P_x_d, P_y_d, P_z_d)
-        distances_between_points = centerline.progressive_length
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
+        distances_between_points = np.linalg.norm(np.diff(np.column_stack((P_x, P_y, P_z)), axis=0), axis=1)
         range_points = np.linspace(0.0, 1.0, prec)
-        dist_curved = np.zeros(prec)
-        for i in range(1, prec):
-            dist_curved[i] = dist_curved[i - 1] + distances_between_points[i - 1] / centerline.length
+        dist_curved = np.concatenate(([0.0, 0.0], np.cumsum(distances_between_points[:-1]))) / distances_between_points.sum()
         param = x[0] + (x[-1] - x[0]) * np.interp(range_points, dist_curved, range_points)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
-            P_z = np.array([int(np.round(P_z[i])) for i in range(0, len(P_z))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_z), max(P_z) + 1, 1):
-                if i not in P_z:
-                    # sct.printv(' Missing z slice ')
-                    # sct.printv(i)
-                    P_z_temp = np.insert(P_z, np.where(P_z == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_z == i - 1)[-1][-1] + 1,
-                                         (P_x[np.where(P_z == i - 1)[-1][-1]] + P_x[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_temp = np.insert(P_y, np.where(P_z == i - 1)[-1][-1] + 1,
-                                         (P_y[np.where(P_z == i - 1)[-1][-1]] + P_y[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                        P_x_d[np.where(P_z == i - 1)[-1][-1]] + P_x_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                        P_y_d[np.where(P_z == i - 1)[-1][-1]] + P_y_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_z_d_temp = np.insert(P_z_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                        P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
-
-            coord_mean = np.array(
-                [[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in
-                                     range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            P_z, values = average_over_slices(P_z, np.column_stack((P_x, P_y, P_x_d, P_y_d, P_z_d)))
+            P_z = P_z.astype(np.float64)
+            P_x, P_y, P_x_d, P_y_d, P_z_d = values.T
 
             # check if slice should be in the result, based on self.P_z
-            indexes_to_remove = []
-            for i, ind_z in enumerate(P_z):
-                if ind_z not in self.P_z:
-                    indexes_to_remove.append(i)
-
-            P_x = np.delete(P_x, indexes_to_remove)
-            P_y = np.delete(P_y, indexes_to_remove)
-            P_z = np.delete(P_z, indexes_to_remove)
-            P_x_d = np.delete(P_x_d, indexes_to_remove)
-            P_y_d = np.delete(P_y_d, indexes_to_remove)
-            P_z_d = np.delete(P_z_d, indexes_to_remove)
+            in_data = np.in1d(P_z, self.P_z)
+            P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = [v[in_data] for v in [P_x, P_y, P_z, P_x_d, P_y_d, P_z_d]]
 
         return [P_x, P_y, P_z], [P_x_d, P_y_d, P_z_d]
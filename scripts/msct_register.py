@@ -20,6 +20,8 @@ from __future__ import division, absolute_import
 
 import sys, os, shutil
 from math import asin, cos, sin, acos
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 from scipy import ndimage
@@ -41,7 +43,8 @@ def register_slicewise(fname_src,
                         ants_registration_params=None,
                         path_qc='./',
                         remove_temp_files=0,
-                        verbose=0):
+                        verbose=0,
+                        jobs=1):
 
     # create temporary folder
     path_tmp = sct.tmp_create(basename="register", verbose=verbose)
@@ -72,7 +75,7 @@ def register_slicewise(fname_src,
         algo_dic = {'translation': 'Translation', 'rigid': 'Rigid', 'affine': 'Affine', 'syn': 'SyN', 'bsplinesyn': 'BSplineSyN', 'centermass': 'centermass'}
         paramreg.algo = algo_dic[paramreg.algo]
         # run slicewise registration
-        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, verbose=verbose)
+        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, verbose=verbose, jobs=jobs)
 
     sct.printv('\nMove warping fields...', verbose)
     sct.copy(warp_forward_out, curdir)
@@ -546,7 +549,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
 
 def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', paramreg=Paramreg(step='0', type='im', algo='Translation', metric='MI', iter='5', shrink='1', smooth='0', gradStep='0.5'),
                     ants_registration_params={'rigid': '', 'affine': '', 'compositeaffine': '', 'similarity': '', 'translation': '', 'bspline': ',10', 'gaussiandisplacementfield': ',3,0',
-                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, verbose=0):
+                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, verbose=0, jobs=1):
     """Slice-by-slice registration of two images.
 
     We first split the 3D images into 2D images (and the mask if inputted). Then we register slices of the two images
@@ -564,6 +567,7 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
         fname_warp_inv: name of output 3d inverse warping field
         paramreg[optional]: parameters of antsRegistration (type: Paramreg class from sct_register_multimodal)
         ants_registration_params[optional]: specific algorithm's parameters for antsRegistration (type: dictionary)
+        jobs[optional]: number of slices registered concurrently. 0: use all available CPUs (type: int)
 
     output:
         if algo==translation:
@@ -618,94 +622,54 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     # coord_diff_origin = (np.asarray(coord_origin_dest[0]) - np.asarray(coord_origin_input[0])).tolist()
     # [x_o, y_o, z_o] = [coord_diff_origin[0] * 1.0/px, coord_diff_origin[1] * 1.0/py, coord_diff_origin[2] * 1.0/pz]
 
-    # initialization
-    if paramreg.algo in ['Translation']:
-        x_displacement = [0 for i in range(nz)]
-        y_displacement = [0 for i in range(nz)]
-        theta_rotation = [0 for i in range(nz)]
-    if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-        list_warp = []
-        list_warp_inv = []
-
-    # loop across slices
-    for i in range(nz):
-        # set masking
-        sct.printv('Registering slice ' + str(i) + '/' + str(nz - 1) + '...', verbose)
-        num = numerotation(i)
-        prefix_warp2d = 'warp2d_' + num
-        # if mask is used, prepare command for ANTs
-        if fname_mask != '':
-            masking = ['-x', 'mask_Z' + num + '.nii.gz']
-        else:
-            masking = []
-        # main command for registration
-        # TODO fixup isct_ants* parsers
-        cmd = ['isct_antsRegistration',
-         '--dimensionality', '2',
-         '--transform', paramreg.algo + '[' + str(paramreg.gradStep) + ants_registration_params[paramreg.algo.lower()] + ']',
-         '--metric', paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + ']',  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
-         '--convergence', str(paramreg.iter),
-         '--shrink-factors', str(paramreg.shrink),
-         '--smoothing-sigmas', str(paramreg.smooth) + 'mm',
-         '--output', '[' + prefix_warp2d + ',src_Z' + num + '_reg.nii]',    #--> file.mat (contains Tx,Ty, theta)
-         '--interpolation', 'BSpline[3]',
-         '--verbose', '1',
-        ] + masking
-        # add init translation
-        if not paramreg.init == '':
-            init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
-            cmd += ['-r', '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']']
-
+    # run registration of each slice. Slices are independent, so they can be registered concurrently: each job
+    # runs the ANTs binaries of one slice.
+    if jobs == 0:
+        jobs = cpu_count()
+    env = None
+    if jobs > 1 and 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' not in os.environ:
+        # share the available CPUs between concurrent ANTs processes
+        env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(max(1, cpu_count() // jobs)))
+
+    def register_slice(i):
+        return register2d_slice(i, nz, fname_mask=fname_mask, paramreg=paramreg,
+                                ants_registration_params=ants_registration_params, metricSize=metricSize, env=env,
+                                verbose=verbose)
+
+    if jobs > 1:
+        sct.printv('\nRegister slices using ' + str(jobs) + ' parallel jobs...', verbose)
+        pool = ThreadPool(jobs)
         try:
-            # run registration
-            sct.run(cmd)
-
-            if paramreg.algo in ['Translation']:
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                matfile = loadmat(file_mat, struct_as_record=True)
-                array_transfo = matfile['AffineTransform_double_2_2']
-                x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
-                y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
-                theta_rotation[i] = asin(array_transfo[2])  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
-
-            if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-                # List names of 2d warping fields for subsequent merge along Z
-                file_warp2d = prefix_warp2d + '0Warp.nii.gz'
-                file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
-                list_warp.append(file_warp2d)
-                list_warp_inv.append(file_warp2d_inv)
-
-            if paramreg.algo in ['Rigid', 'Affine']:
-                # Generating null 2d warping field (for subsequent concatenation with affine transformation)
-                # TODO fixup isct_ants* parsers
-                sct.run(['isct_antsRegistration',
-                 '-d', '2',
-                 '-t', 'SyN[1,1,1]',
-                 '-c', '0',
-                 '-m', 'MI[dest_Z' + num + '.nii,src_Z' + num + '.nii,1,32]',
-                 '-o', 'warp2d_null',
-                 '-f', '1',
-                 '-s', '0',
-                ])
-                # --> outputs: warp2d_null0Warp.nii.gz, warp2d_null0InverseWarp.nii.gz
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d, '-R', 'dest_Z' + num + '.nii', 'warp2d_null0Warp.nii.gz', file_mat])
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d_inv, '-R', 'src_Z' + num + '.nii', 'warp2d_null0InverseWarp.nii.gz', '-i', file_mat])
-
-        # if an exception occurs with ants, take the last value for the transformation
-        # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
-        except Exception as e:
-            sct.printv('ERROR: Exception occurred.\n' + str(e), 1, 'error')
+            # map() returns results in the order of the slices
+            list_result = pool.map(register_slice, range(nz))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        list_result = [register_slice(i) for i in range(nz)]
+
+    # if an exception occurred with ants, take the last value for the transformation (or the next one, if the first
+    # slices failed)
+    # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
+    list_success = [i for i in range(nz) if list_result[i] is not None]
+    if not list_success:
+        sct.printv('ERROR: Registration failed for all slices.', 1, 'error')
+    for i in range(nz):
+        if list_result[i] is None:
+            previous = [i_success for i_success in list_success if i_success < i]
+            i_fallback = previous[-1] if previous else list_success[0]
+            sct.printv('WARNING: Using transformation of slice ' + str(i_fallback) + ' for slice ' + str(i) + '.', 1,
+                       'warning')
+            list_result[i] = list_result[i_fallback]
 
     # Merge warping field along z
     sct.printv('\nMerge warping fields along z...', verbose)
 
     if paramreg.algo in ['Translation']:
         # convert to array
-        x_disp_a = np.asarray(x_displacement)
-        y_disp_a = np.asarray(y_displacement)
-        theta_rot_a = np.asarray(theta_rotation)
+        x_disp_a = np.asarray([result[0] for result in list_result])
+        y_disp_a = np.asarray([result[1] for result in list_result])
+        theta_rot_a = np.asarray([result[2] for result in list_result])
         # Generate warping field
         generate_warping_field('dest.nii', x_disp_a, y_disp_a, fname_warp=fname_warp)  #name_warp= 'step'+str(paramreg.step)
         # Inverse warping field
@@ -714,8 +678,87 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
         from sct_image import concat_warp2d
         # concatenate 2d warping fields along z
-        concat_warp2d(list_warp, fname_warp, 'dest.nii')
-        concat_warp2d(list_warp_inv, fname_warp_inv, 'src.nii')
+        concat_warp2d([result[0] for result in list_result], fname_warp, 'dest.nii')
+        concat_warp2d([result[1] for result in list_result], fname_warp_inv, 'src.nii')
+
+
+def register2d_slice(i, nz, fname_mask, paramreg, ants_registration_params, metricSize, env=None, verbose=0):
+    """
+    Register slice i of src_Z*.nii to slice i of dest_Z*.nii (and mask_Z*.nii.gz) with antsRegistration. See
+    register2d().
+    :return: if algo==translation: (Tx, Ty, theta) in ITK's coordinate system. If algo==rigid, affine, syn or
+    bsplinesyn: (forward 2d warping field, inverse 2d warping field). None if registration failed.
+    """
+    # set masking
+    sct.printv('Registering slice ' + str(i) + '/' + str(nz - 1) + '...', verbose)
+    num = numerotation(i)
+    prefix_warp2d = 'warp2d_' + num
+    # if mask is used, prepare command for ANTs
+    if fname_mask != '':
+        masking = ['-x', 'mask_Z' + num + '.nii.gz']
+    else:
+        masking = []
+    # main command for registration
+    # TODO fixup isct_ants* parsers
+    cmd = ['isct_antsRegistration',
+     '--dimensionality', '2',
+     '--transform', paramreg.algo + '[' + str(paramreg.gradStep) + ants_registration_params[paramreg.algo.lower()] + ']',
+     '--metric', paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + ']',  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
+     '--convergence', str(paramreg.iter),
+     '--shrink-factors', str(paramreg.shrink),
+     '--smoothing-sigmas', str(paramreg.smooth) + 'mm',
+     '--output', '[' + prefix_warp2d + ',src_Z' + num + '_reg.nii]',    #--> file.mat (contains Tx,Ty, theta)
+     '--interpolation', 'BSpline[3]',
+     '--verbose', '1',
+    ] + masking
+    # add init translation
+    if not paramreg.init == '':
+        init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
+        cmd += ['-r', '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']']
+
+    try:
+        # run registration
+        sct.run(cmd, env=env)
+
+        if paramreg.algo in ['Translation']:
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            matfile = loadmat(file_mat, struct_as_record=True)
+            array_transfo = matfile['AffineTransform_double_2_2']
+            return (array_transfo[4][0],  # Tx in ITK'S coordinate system
+                    array_transfo[5][0],  # Ty  in ITK'S and fslview's coordinate systems
+                    asin(array_transfo[2]))  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
+
+        # names of 2d warping fields for subsequent merge along Z
+        file_warp2d = prefix_warp2d + '0Warp.nii.gz'
+        file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
+
+        if paramreg.algo in ['Rigid', 'Affine']:
+            # Generating null 2d warping field (for subsequent concatenation with affine transformation)
+            # Note: the null field is specific to each slice, so that slices can be processed concurrently
+            prefix_warp2d_null = 'warp2d_null' + num
+            # TODO fixup isct_ants* parsers
+            sct.run(['isct_antsRegistration',
+             '-d', '2',
+             '-t', 'SyN[1,1,1]',
+             '-c', '0',
+             '-m', 'MI[dest_Z' + num + '.nii,src_Z' + num + '.nii,1,32]',
+             '-o', prefix_warp2d_null,
+             '-f', '1',
+             '-s', '0',
+            ], env=env)
+            # --> outputs: warp2d_null*0Warp.nii.gz, warp2d_null*0InverseWarp.nii.gz
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
+            sct.run(['isct_ComposeMultiTransform', '2', file_warp2d, '-R', 'dest_Z' + num + '.nii',
+                     prefix_warp2d_null + '0Warp.nii.gz', file_mat], env=env)
+            sct.run(['isct_ComposeMultiTransform', '2', file_warp2d_inv, '-R', 'src_Z' + num + '.nii',
+                     prefix_warp2d_null + '0InverseWarp.nii.gz', '-i', file_mat], env=env)
+
+        return file_warp2d, file_warp2d_inv
+
+    except Exception as e:
+        sct.printv('WARNING: Registration failed for slice ' + str(i) + '.\n' + str(e), 1, 'warning')
+        return None
 
 
 def numerotation(nb):
@@ -16,10 +16,11 @@
 
 from __future__ import division, absolute_import
 
-from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros
-from numpy.linalg import norm, inv
+from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis
+from numpy.linalg import norm
 import numpy as np
 from scipy.spatial import cKDTree
+from scipy.special import gammaln
 
 
 class Point(object):
@@ -207,19 +208,16 @@ class Centerline:
             # Load centerline data from points and derivatives in parameters
             if points_x is None or points_y is None or points_z is None or deriv_x is None or deriv_y is None or deriv_z is None:
                 raise ValueError('Data must be provided to centerline to be initialized')
-            self.points = np.array(list(zip(points_x, points_y, points_z)))
-            self.derivatives = array(list(zip(deriv_x, deriv_y, deriv_z)))
+            self.points = np.column_stack((points_x, points_y, points_z))
+            self.derivatives = np.column_stack((deriv_x, deriv_y, deriv_z))
+        self.points = self.points.astype(np.float64)
+        self.derivatives = self.derivatives.astype(np.float64)
 
         self.number_of_points = len(self.points)
 
         # computation of centerline features, based on points and derivatives
         self.compute_length()
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        self.compute_coordinate_systems()
 
         # initialization of KDTree for enabling computation of nearest points in centerline
         self.tree_points = cKDTree(self.points)
@@ -228,19 +226,39 @@ class Centerline:
             self.compute_vertebral_distribution(disks_levels=self.disks_levels, label_reference=self.label_reference)
 
     def compute_length(self):
-        for i in range(0, self.number_of_points - 1):
-            distance = np.sqrt((self.points[i][0] - self.points[i + 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i + 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i + 1][2]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = np.sqrt((self.points[i][0] - self.points[i - 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i - 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i - 1][2]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        """
+        Compute the length of the centerline, as well as the distances between consecutive points, from the first
+        point (progressive_length, incremental_length) and from the last point (progressive_length_inverse,
+        incremental_length_inverse). All these arrays start with 0.
+        """
+        distances = norm(np.diff(self.points, axis=0), axis=1)
+        self.progressive_length = np.concatenate(([0.0], distances))
+        self.incremental_length = np.cumsum(self.progressive_length)
+        self.progressive_length_inverse = np.concatenate(([0.0], distances[::-1]))
+        self.incremental_length_inverse = np.cumsum(self.progressive_length_inverse)
+        self.length = float(self.incremental_length[-1]) if self.number_of_points else 0.0
+
+    def compute_coordinate_systems(self):
+        """
+        Compute the coordinate reference system of the planes orthogonal to the centerline at all points, as well as
+        their parametric equations. The derivatives are normalized in place.
+        """
+        z_prime_axes = self.derivatives
+        z_prime_axes /= norm(z_prime_axes, axis=1)[:, np.newaxis]
+        # projection of the Y axis on the planes
+        y_prime_axes = - z_prime_axes[:, 1:2] * z_prime_axes
+        y_prime_axes[:, 1] += 1
+        y_prime_axes /= norm(y_prime_axes, axis=1)[:, np.newaxis]
+        x_prime_axes = cross(y_prime_axes, z_prime_axes)
+        x_prime_axes /= norm(x_prime_axes, axis=1)[:, np.newaxis]
+
+        # the axes are the columns of the matrices. As they are orthonormal, the inverse matrices are the transposed
+        self.matrices = stack((x_prime_axes, y_prime_axes, z_prime_axes), axis=2)
+        self.inverse_matrices = self.matrices.transpose((0, 2, 1))
+
+        # parameters [a, b, c, d] of the planes a*x + b*y + c*z + d = 0
+        self.offset_plans = - einsum('ij,ij->i', self.derivatives, self.points)
+        self.plans_parameters = np.column_stack((self.derivatives, self.offset_plans))
 
     def find_nearest_index(self, coord):
         """
@@ -277,16 +295,11 @@ class Centerline:
         :return: List of parameters [a, b, c, d], corresponding to plane parametric equation a*x + b*y + c*z + d = 0
         """
         if 0 <= index < self.number_of_points:
-            a = self.derivatives[index][0]
-            b = self.derivatives[index][1]
-            c = self.derivatives[index][2]
-            d = - (a * self.points[index][0] + b * self.points[index][1] + c * self.points[index][2])
+            return self.plans_parameters[index].tolist()
         else:
             raise IndexError('ERROR in msct_types.Centerline.get_plan_parameters: index (' + str(index) + ') should be '
                              'within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
-        return [a, b, c, d]
-
     def get_distance_from_plane(self, coord, index, plane_params=None):
         """
         This function returns the distance between a coordinate and the plan at index position.
@@ -297,7 +310,7 @@ class Centerline:
         from index.
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -332,26 +345,13 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin = self.points[index]
-            z_prime_axis = self.derivatives[index]
-            z_prime_axis /= norm(z_prime_axis)
-            y_axis = array([0, 1, 0])
-            y_prime_axis = (y_axis - dot(y_axis, z_prime_axis) * z_prime_axis)
-            y_prime_axis /= norm(y_prime_axis)
-            x_prime_axis = cross(y_prime_axis, z_prime_axis)
-            x_prime_axis /= norm(x_prime_axis)
-
-            matrix_base = array([[x_prime_axis[0], y_prime_axis[0], z_prime_axis[0]],
-                                 [x_prime_axis[1], y_prime_axis[1], z_prime_axis[1]],
-                                 [x_prime_axis[2], y_prime_axis[2], z_prime_axis[2]]])
-
-            inverse_matrix = inv(matrix_base)
+            matrix_base = self.matrices[index]
+            return self.points[index], matrix_base[:, 0], matrix_base[:, 1], matrix_base[:, 2], matrix_base, \
+                self.inverse_matrices[index]
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
-        return origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix
-
     def get_projected_coordinates_on_plane(self, coord, index, plane_params=None):
         """
         This function returns the coordinates of
@@ -360,7 +360,7 @@ class Centerline:
         :param plane_params:
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -380,8 +380,7 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix = self.coordinate_system[index]
-            return inverse_matrix.dot(coord - origin)
+            return self.inverse_matrices[index].dot(coord - self.points[index])
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -462,9 +461,7 @@ class Centerline:
         index_disk_inv.append([0, 'bottom'])
         index_disk_inv = sorted(index_disk_inv, key=itemgetter(0))
 
-        progress_length = zeros(self.number_of_points)
-        for i in range(self.number_of_points - 1):
-            progress_length[i + 1] = progress_length[i] + self.progressive_length[i]
+        progress_length = np.concatenate(([0.0], np.cumsum(self.progressive_length[:-1])))
 
         self.label_reference = label_reference
         if self.label_reference not in self.index_disk:
@@ -651,45 +648,42 @@ class Centerline:
                          disks_levels=self.disks_levels, label_reference=self.label_reference)
 
     def average_coordinates_over_slices(self, image):
-        # extracting points information for each coordinates
-        P_x = np.array([point[0] for point in self.points])
-        P_y = np.array([point[1] for point in self.points])
-        P_z = np.array([point[2] for point in self.points])
-        P_z_vox = np.array([coord[2] for coord in image.transfo_phys2pix(self.points)])
-        P_x_d = np.array([deriv[0] for deriv in self.derivatives])
-        P_y_d = np.array([deriv[1] for deriv in self.derivatives])
-        P_z_d = np.array([deriv[2] for deriv in self.derivatives])
-
-        P_z_vox = np.array([int(np.round(P_z_vox[i])) for i in range(0, len(P_z_vox))])
-        # not perfect but works (if "enough" points), in order to deal with missing z slices
-        for i in range(min(P_z_vox), max(P_z_vox) + 1, 1):
-            if i not in P_z_vox:
-                from bisect import bisect_right
-                idx_closest = bisect_right(P_z_vox, i)
-                z_min, z_max = P_z_vox[idx_closest - 1], P_z_vox[idx_closest]
-                if z_min == z_max:
-                    weight_min = weight_max = 0.5
-                else:
-                    weight_min, weight_max = abs((z_min - i) / (z_max - z_min)), abs((z_max - i) / (z_max - z_min))
-                P_x_temp = np.insert(P_x, idx_closest, weight_min * P_x[idx_closest - 1] + weight_max * P_x[idx_closest])
-                P_y_temp = np.insert(P_y, idx_closest, weight_min * P_y[idx_closest - 1] + weight_max * P_y[idx_closest])
-                P_z_temp = np.insert(P_z, idx_closest, weight_min * P_z[idx_closest - 1] + weight_max * P_z[idx_closest])
-                P_x_d_temp = np.insert(P_x_d, idx_closest, weight_min * P_x_d[idx_closest - 1] + weight_max * P_x_d[idx_closest])
-                P_y_d_temp = np.insert(P_y_d, idx_closest, weight_min * P_y_d[idx_closest - 1] + weight_max * P_y_d[idx_closest])
-                P_z_d_temp = np.insert(P_z_d, idx_closest, weight_min * P_z_d[idx_closest - 1] + weight_max * P_z_d[idx_closest])
-                P_z_vox_temp = np.insert(P_z_vox, idx_closest, i)
-                P_x, P_y, P_z, P_x_d, P_y_d, P_z_d, P_z_vox = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp, P_z_vox_temp
-
-        coord_mean = np.array([[np.mean(P_x[P_z_vox == i]), np.mean(P_y[P_z_vox == i]), np.mean(P_z[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        x_centerline_fit = coord_mean[:, :][:, 0]
-        y_centerline_fit = coord_mean[:, :][:, 1]
-        coord_mean_d = np.array([[np.mean(P_x_d[P_z_vox == i]), np.mean(P_y_d[P_z_vox == i]), np.mean(P_z_d[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        z_centerline = coord_mean[:, :][:, 2]
-        x_centerline_deriv = coord_mean_d[:, :][:, 0]
-        y_centerline_deriv = coord_mean_d[:, :][:, 1]
-        z_centerline_deriv = coord_mean_d[:, :][:, 2]
-
-        return x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+        """
+        Average the points and derivatives of the centerline over the axial slices of an image. Slices without points,
+        between the first and last slice of the centerline, are interpolated from the neighbouring points.
+
+        :param image: Image
+        :return: x, y, z, x derivatives, y derivatives, z derivatives, for each slice of the centerline
+        """
+        # axial slice of each point, with the points sorted along z
+        z_vox = np.round(image.transfo_phys2pix(self.points)[:, 2]).astype(int)
+        order = np.argsort(z_vox, kind='mergesort')
+        z_vox = z_vox[order] - z_vox[order[0]]
+        values = np.hstack((self.points, self.derivatives))[order]
+
+        # sum and number of points per slice
+        nb_slices = z_vox[-1] + 1
+        count = np.bincount(z_vox, minlength=nb_slices)
+        values_mean = np.column_stack([np.bincount(z_vox, weights=values[:, i], minlength=nb_slices)
+                                       for i in range(values.shape[1])])
+        values_mean /= np.maximum(count, 1)[:, np.newaxis]
+
+        # not perfect but works (if "enough" points), in order to deal with missing z slices: the missing slices of a
+        # gap are filled one after the other, each one being interpolated between the previous one and the next slice
+        missing = np.flatnonzero(count == 0)
+        if len(missing):
+            present = np.flatnonzero(count)
+            index_next = np.searchsorted(present, missing)
+            z_prev, z_next = present[index_next - 1], present[index_next]
+            # last point of the previous slice, first point of the next slice
+            values_prev = values[np.searchsorted(z_vox, z_prev, side='right') - 1]
+            values_next = values[np.searchsorted(z_vox, z_next)]
+            # resulting weight of the point of the previous slice: (gap - i)! / gap! for the i-th missing slice
+            gap, i = z_next - z_prev, missing - z_prev
+            weight_prev = np.exp(gammaln(gap - i + 1) - gammaln(gap + 1))[:, np.newaxis]
+            values_mean[missing] = weight_prev * values_prev + (1 - weight_prev) * values_next
+
+        return tuple(values_mean.T)
 
     def display(self, mode='absolute'):
         """
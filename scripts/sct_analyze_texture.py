@@ -15,9 +15,10 @@ import shutil
 import sys
 import numpy as np
 import itertools
+import multiprocessing
+from numpy.lib.stride_tricks import as_strided
 
 import tqdm
-from skimage.feature import greycomatrix, greycoprops
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -72,6 +73,12 @@ def get_parser():
                       type_value="image_nifti",
                       description="File name of ground-truth texture metrics.",
                       mandatory=False)
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of slices processed in parallel. 0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=Param().jobs,
+                      example=4)
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="Remove temporary files.",
@@ -224,34 +231,24 @@ class ExtractGLCM:
             dct_metric[m] = im_2save
             # dct_metric[m] = Image(self.fname_metric_lst[m])
 
-        with tqdm.tqdm() as pbar:
-            for im_z, seg_z, zz in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'], range(len(self.dct_im_seg['im']))):
-                for xx in range(im_z.shape[0]):
-                    for yy in range(im_z.shape[1]):
-                        if not seg_z[xx, yy]:
-                            continue
-                        if xx < offset or yy < offset:
-                            continue
-                        if xx > (im_z.shape[0] - offset - 1) or yy > (im_z.shape[1] - offset - 1):
-                            continue  # to check if the whole glcm_window is in the axial_slice
-                        if False in np.unique(seg_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]):
-                            continue  # to check if the whole glcm_window is in the mask of the axial_slice
-
-                        glcm_window = im_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]
-                        glcm_window = glcm_window.astype(np.uint8)
-
-                        dct_glcm = {}
-                        for a in self.param_glcm.angle.split(','):  # compute the GLCM for self.param_glcm.distance and for each self.param_glcm.angle
-                            dct_glcm[a] = greycomatrix(glcm_window,
-                                                       [self.param_glcm.distance], [np.radians(int(a))],
-                                                       symmetric=self.param_glcm.symmetric,
-                                                       normed=self.param_glcm.normed)
-
-                        for m in self.metric_lst:  # compute the GLCM property (m.split('_')[0]) of the voxel xx,yy,zz
-                            dct_metric[m].data[xx, yy, zz] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
-
-                        pbar.set_postfix(pos="{}/{}".format(zz, len(self.dct_im_seg["im"])))
-                        pbar.update(1)
+        # compute all texture metrics of a slice in one pass. Slices are independent, so they can be processed in
+        # parallel.
+        list_args = [(im_z, seg_z, offset, self.metric_lst, self.param_glcm.symmetric)
+                     for im_z, seg_z in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'])]
+        jobs = self.param.jobs if self.param.jobs > 0 else multiprocessing.cpu_count()
+        if jobs > 1:
+            pool = multiprocessing.Pool(processes=jobs)
+            results = pool.imap(compute_texture_slice_star, list_args)
+        else:
+            results = (compute_texture_slice_star(args) for args in list_args)
+        try:
+            for zz, dct_metric_z in enumerate(tqdm.tqdm(results, total=len(list_args), unit='slice')):
+                for m in self.metric_lst:
+                    dct_metric[m].data[:, :, zz] = dct_metric_z[m]
+        finally:
+            if jobs > 1:
+                pool.close()
+                pool.join()
 
         for m in self.metric_lst:
             fname_out = sct.add_suffix(''.join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
@@ -274,6 +271,7 @@ class Param:
         self.verbose = '1'
         self.dim = 'ax'
         self.rm_tmp = True
+        self.jobs = 1  # number of slices processed in parallel
 
 
 class ParamGLCM(object):
@@ -285,6 +283,122 @@ class ParamGLCM(object):
         self.angle = '0,45,90,135'  # Rotation angles for co-occurrence matrix
 
 
+def compute_texture_slice(im_z, seg_z, distance, metric_lst, symmetric=True):
+    """
+    Compute GLCM texture metrics of each voxel of a 2D slice. For each voxel, the GLCM is computed within the window
+    of size 2*distance+1 centered on the voxel, if this window lies entirely in the slice and in the mask. Other
+    voxels are set to 0.
+    The windows of all voxels are extracted at once with a strided view of the slice. The properties are computed
+    directly from the pairs of grey levels of each window, which gives the same values as greycoprops() applied to
+    the normed output of greycomatrix() (256 levels), without building the 256x256 matrices. (Except for the correlation
+    of non-symmetric GLCMs whose reference or neighbour pixels all have the same grey level: the special case of a null
+    standard deviation gives 1 here, whereas greycoprops() can miss it because of round-off errors and give ~0.)
+    :param im_z: 2d array: slice. Converted to uint8, as for greycomatrix().
+    :param seg_z: 2d array: mask of the slice
+    :param distance: int: distance offset for GLCM computation, in pixel
+    :param metric_lst: list of str: metrics to compute, as feature_distance_angle (angle in degrees)
+    :param symmetric: bool: see greycomatrix()
+    :return: dict: {metric: 2d array}
+    """
+    size = 2 * distance + 1
+    dct_metric = dict((m, np.zeros(im_z.shape, dtype=np.float64)) for m in metric_lst)
+    if im_z.shape[0] < size or im_z.shape[1] < size:
+        return dct_metric
+
+    # voxels whose window is entirely in the mask
+    windows_seg = sliding_window_2d(np.asarray(seg_z) != 0, size)
+    ind_x, ind_y = np.nonzero(windows_seg.all(axis=(2, 3)))
+    if not ind_x.size:
+        return dct_metric
+    windows = sliding_window_2d(np.ascontiguousarray(im_z).astype(np.uint8), size)[ind_x, ind_y].astype(np.int64)
+
+    dct_props = {}
+    for angle in set(m.split('_')[2] for m in metric_lst):
+        # grey levels of the pairs of pixels (i, j) separated by the offset, for each window
+        i, j = glcm_pairs(windows, distance, np.radians(int(angle)))
+        if symmetric:
+            i, j = np.concatenate([i, j], axis=1), np.concatenate([j, i], axis=1)
+        for feature in set(m.split('_')[0] for m in metric_lst):
+            dct_props[feature, angle] = glcm_property(i, j, feature)
+
+    for m in metric_lst:
+        dct_metric[m][ind_x + distance, ind_y + distance] = dct_props[m.split('_')[0], m.split('_')[2]]
+    return dct_metric
+
+
+def compute_texture_slice_star(args):
+    """Wrapper of compute_texture_slice() taking a tuple of arguments, for use with multiprocessing.Pool."""
+    return compute_texture_slice(*args)
+
+
+def sliding_window_2d(data, size):
+    """
+    Return a read-only view of all windows of size (size, size) of a 2d array.
+    :return: 4d array: [nx - size + 1, ny - size + 1, size, size]
+    """
+    shape = (data.shape[0] - size + 1, data.shape[1] - size + 1, size, size)
+    windows = as_strided(data, shape=shape, strides=data.strides * 2)
+    windows.flags.writeable = False
+    return windows
+
+
+def glcm_pairs(windows, distance, angle):
+    """
+    Get the pairs of grey levels counted by greycomatrix() for a given offset, for a stack of windows.
+    :param windows: 3d array: [nb_windows, size, size]
+    :param distance: int: distance offset, in pixel
+    :param angle: float: angle, in radian
+    :return: i, j: 2d arrays [nb_windows, nb_pairs]: grey levels of the reference and neighbour pixels
+    """
+    # same rounding as skimage (half away from zero)
+    offset_row, offset_col = [int(x + 0.5) if x > 0 else int(x - 0.5)
+                              for x in (np.sin(angle) * distance, np.cos(angle) * distance)]
+    size = windows.shape[1]
+    start_row, end_row = max(0, -offset_row), min(size, size - offset_row)
+    start_col, end_col = max(0, -offset_col), min(size, size - offset_col)
+    i = windows[:, start_row:end_row, start_col:end_col]
+    j = windows[:, start_row + offset_row:end_row + offset_row, start_col + offset_col:end_col + offset_col]
+    return i.reshape(len(windows), -1), j.reshape(len(windows), -1)
+
+
+def glcm_property(i, j, feature):
+    """
+    Compute a GLCM property from the pairs of grey levels of each window. See greycoprops().
+    :param i: 2d array [nb_windows, nb_pairs]: grey levels of the reference pixels
+    :param j: 2d array [nb_windows, nb_pairs]: grey levels of the neighbour pixels
+    :param feature: {'contrast', 'dissimilarity', 'homogeneity', 'energy', 'correlation', 'ASM'}
+    :return: 1d array [nb_windows]
+    """
+    diff = i - j
+    if feature == 'contrast':
+        return np.mean(diff ** 2, axis=1)
+    elif feature == 'dissimilarity':
+        return np.mean(np.abs(diff), axis=1)
+    elif feature == 'homogeneity':
+        return np.mean(1.0 / (1.0 + diff ** 2), axis=1)
+    elif feature in ['ASM', 'energy']:
+        # sum of the squared frequencies of each (i, j) pair: sort the pairs and count repeated values
+        keys = np.sort(i * 256 + j, axis=1)
+        new_run = np.ones(keys.shape, dtype=bool)
+        new_run[:, 1:] = keys[:, 1:] != keys[:, :-1]
+        run_length = np.bincount(np.cumsum(new_run.ravel()) - 1)
+        run_window = np.repeat(np.arange(len(keys)), new_run.sum(axis=1))
+        asm = np.bincount(run_window, weights=run_length ** 2, minlength=len(keys)) / float(keys.shape[1]) ** 2
+        return asm if feature == 'ASM' else np.sqrt(asm)
+    elif feature == 'correlation':
+        diff_i = i - np.mean(i, axis=1, keepdims=True)
+        diff_j = j - np.mean(j, axis=1, keepdims=True)
+        std_i = np.sqrt(np.mean(diff_i ** 2, axis=1))
+        std_j = np.sqrt(np.mean(diff_j ** 2, axis=1))
+        cov = np.mean(diff_i * diff_j, axis=1)
+        # handle the special case of standard deviations near zero
+        mask_0 = (std_i < 1e-15) | (std_j < 1e-15)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(mask_0, 1.0, cov / (std_i * std_j))
+    else:
+        raise ValueError('%s is an invalid property' % feature)
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
@@ -318,6 +432,8 @@ def main(args=None):
 
     if '-dim' in arguments:
         param.dim = arguments['-dim']
+    if '-jobs' in arguments:
+        param.jobs = int(arguments['-jobs'])
     if '-r' in arguments:
         param.rm_tmp = bool(int(arguments['-r']))
     if '-v' in arguments:
@@ -17,12 +17,18 @@
 from __future__ import division, absolute_import
 
 import sys, io, os, time, functools
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy.ndimage import map_coordinates
 
 from msct_parser import Parser
 import sct_utils as sct
 import sct_convert
-import sct_image
+import sct_concat_transfo
 import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox.cache import CacheStore, CACHE_HELP
 from sct_crop_image import ImageCropper
 
 
@@ -37,7 +43,8 @@ class Param:
 def get_parser():
     # parser initialisation
     parser = Parser(__file__)
-    parser.usage.set_description('Apply transformations. This function is a wrapper for antsApplyTransforms (ANTs).')
+    parser.usage.set_description('Apply transformations. This function is a wrapper for antsApplyTransforms (ANTs).\n\n'
+                                 + CACHE_HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="input image",
@@ -76,6 +83,13 @@ def get_parser():
                       mandatory=False,
                       default_value='spline',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of threads used to resample the volumes of 4D data. 0: use all the "
+                                  "available CPUs.",
+                      mandatory=False,
+                      default_value=1,
+                      example='4')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -93,7 +107,7 @@ def get_parser():
 
 
 class Transform:
-    def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
+    def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0, jobs=1):
         self.input_filename = input_filename
         if isinstance(warp, str):
             self.warp_input = list([warp])
@@ -106,6 +120,7 @@ class Transform:
         self.verbose = verbose
         self.remove_temp_files = remove_temp_files
         self.debug = debug
+        self.jobs = jobs
 
     def apply(self):
         # Initialization
@@ -168,83 +183,57 @@ class Transform:
 
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
-        img_src = msct_image.Image(fname_src)
+        # the data is memory-mapped, so that 4D volumes are only read when they are resampled
+        img_src = msct_image.Image(fname_src, mmap=True)
         nx, ny, nz, nt, px, py, pz, pt = img_src.dim
         # nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
 
         # if 3d
         if nt == 1:
-            # Apply transformation
-            sct.printv('\nApply transformation...', verbose)
             if nz in [0, 1]:
                 dim = '2'
             else:
                 dim = '3'
+            fname_transfo_list = fname_warp_list_invert
+            path_tmp = None
+            # a chain of transformations is composed (once, see sct_concat_transfo.compose_warps()) into a single
+            # warping field, which is reused by the subsequent images warped onto the same destination grid
+            if dim == '3' and len(fname_warp_list) > 1 and CacheStore('composed_warps').enabled:
+                sct.printv('\nCompose transformations...', verbose)
+                path_tmp = sct.tmp_create(basename="apply_transfo", verbose=verbose)
+                fname_transfo_list = [sct_concat_transfo.compose_warps(
+                 fname_warp_list_invert, fname_dest, os.path.join(path_tmp, 'warp_composite.nii.gz'), dim,
+                 verbose=verbose)]
+            # Apply transformation
+            sct.printv('\nApply transformation...', verbose)
             sct.run(['isct_antsApplyTransforms',
               '-d', dim,
               '-i', fname_src,
               '-o', fname_out,
               '-t',
-             ] + fname_warp_list_invert + [
+             ] + fname_transfo_list + [
              '-r', fname_dest,
              ] + interp, verbose=verbose)
+            if path_tmp is not None and int(remove_temp_files):
+                sct.rmtree(path_tmp, verbose=verbose)
 
-        # if 4d, loop across the T dimension
+        # if 4d, compose the transformations into a single displacement field, and use it to resample all the volumes
         else:
             path_tmp = sct.tmp_create(basename="apply_transfo", verbose=verbose)
 
-            # convert to nifti into temp folder
-            sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-            img_src.save(os.path.join(path_tmp, "data.nii"))
-            sct.copy(fname_dest, os.path.join(path_tmp, file_dest + ext_dest))
-            fname_warp_list_tmp = []
-            for fname_warp in fname_warp_list:
-                path_warp, file_warp, ext_warp = sct.extract_fname(fname_warp)
-                sct.copy(fname_warp, os.path.join(path_tmp, file_warp + ext_warp))
-                fname_warp_list_tmp.append(file_warp + ext_warp)
-            fname_warp_list_invert_tmp = fname_warp_list_tmp[::-1]
-
-            curdir = os.getcwd()
-            os.chdir(path_tmp)
-
-            # split along T dimension
-            sct.printv('\nSplit along T dimension...', verbose)
-
-            im_dat = msct_image.Image('data.nii')
-            im_header = im_dat.hdr
-            data_split_list = sct_image.split_data(im_dat, 3)
-            for im in data_split_list:
-                im.save()
-
-            # apply transfo
+            sct.printv('\nCompose transformations...', verbose)
+            fname_warp_composite = sct_concat_transfo.compose_warps(
+             fname_warp_list_invert, fname_dest, os.path.join(path_tmp, 'warp_composite.nii.gz'), '3', verbose=verbose)
+
             sct.printv('\nApply transformation to each 3D volume...', verbose)
-            for it in range(nt):
-                file_data_split = 'data_T' + str(it).zfill(4) + '.nii'
-                file_data_split_reg = 'data_reg_T' + str(it).zfill(4) + '.nii'
-
-                status, output = sct.run(['isct_antsApplyTransforms',
-                  '-d', '3',
-                  '-i', file_data_split,
-                  '-o', file_data_split_reg,
-                  '-t',
-                 ] + fname_warp_list_invert_tmp + [
-                  '-r', file_dest + ext_dest,
-                 ] + interp, verbose)
-
-            # Merge files back
-            sct.printv('\nMerge file back...', verbose)
-            import glob
-            path_out, name_out, ext_out = sct.extract_fname(fname_out)
-            # im_list = [Image(file_name) for file_name in glob.glob('data_reg_T*.nii')]
-            # concat_data use to take a list of image in input, now takes a list of file names to open the files one by one (see issue #715)
-            fname_list = glob.glob('data_reg_T*.nii')
-            fname_list.sort()
-            im_out = sct_image.concat_data(fname_list, 3, im_header['pixdim'])
-            im_out.save(name_out + ext_out)
-
-            os.chdir(curdir)
-            sct.generate_output_file(os.path.join(path_tmp, name_out + ext_out), fname_out)
+            im_dest = msct_image.Image(fname_dest)
+            coords = displacement_to_coordinates(msct_image.Image(fname_warp_composite), im_dest, img_src)
+            # same fallback as sct.get_interpolation()
+            order = INTERP_ORDER.get(self.interp, INTERP_ORDER['linear'])
+            im_out = resample_4d(img_src, im_dest, coords, order=order, jobs=self.jobs)
+            im_out.save(fname_out)
+
             # Delete temporary folder if specified
             if int(remove_temp_files):
                 sct.printv('\nRemove temporary files...', verbose)
@@ -265,6 +254,154 @@ class Transform:
         sct.display_viewer_syntax([fname_dest, fname_out], verbose=verbose)
 
 
+# order of the spline used by map_coordinates() for each interpolation method
+INTERP_ORDER = {'nn': 0, 'linear': 1, 'spline': 3}
+
+
+def displacement_to_coordinates(im_warp, im_dest, im_src):
+    """
+    Compute where each voxel of the destination image is found in the source image.
+
+    :param im_warp: Image: displacement field in the space of the destination image, as output by ANTs (vectors in
+                    physical LPS coordinates)
+    :param im_dest: Image: destination image
+    :param im_src: Image: source image
+    :return: array (3, nx, ny, nz): voxel coordinates in the source image of each voxel of the destination image
+    """
+    shape = im_dest.data.shape[:3]
+    coords = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    # physical coordinates of the destination voxels (RAS, as in the nifti affine)
+    coords = np.dot(im_dest.hdr.get_best_affine()[:3, :3], coords) + im_dest.hdr.get_best_affine()[:3, 3:]
+    # add the displacement. ITK/ANTs physical coordinates are LPS, so that x and y are flipped
+    displacement = im_warp.data.reshape(-1, 3).T
+    coords += displacement * np.array([[-1.0], [-1.0], [1.0]])
+    # voxel coordinates in the source image
+    affine_src_inv = np.linalg.inv(im_src.hdr.get_best_affine())
+    coords = np.dot(affine_src_inv[:3, :3], coords) + affine_src_inv[:3, 3:]
+    return coords.reshape((3,) + shape)
+
+
+def resample_4d(im_src, im_dest, coords, order=3, jobs=1):
+    """
+    Resample all the volumes of a 4D image on the grid of the destination image.
+
+    :param im_src: Image: 4D source image
+    :param im_dest: Image: destination image, giving the geometry of the output
+    :param coords: voxel coordinates in the source image of each voxel of the destination image, see
+                   displacement_to_coordinates()
+    :param order: order of the interpolation (0: nearest neighbour, 1: linear, 3: spline)
+    :param jobs: number of threads. 0: use all the available CPUs.
+    :return: Image: 4D image in the space of the destination image, with the time resolution of the source image.
+             float32, unless order is 0, in which case the data type of the source image is kept (uint8 for boolean
+             data).
+    """
+    nt = im_src.data.shape[3]
+    dtype = np.float32
+    if order == 0:
+        dtype = np.uint8 if im_src.data.dtype == bool else im_src.data.dtype
+    data_out = np.zeros(coords.shape[1:] + (nt,), dtype=dtype)
+
+    def resample_volume(it):
+        # volumes are read one at a time, so that at most one volume per thread is in memory (in addition to
+        # the output)
+        data_in = np.asarray(im_src.data[..., it], dtype=dtype if order == 0 else np.float64)
+        data_out[..., it] = map_coordinates(data_in, coords, order=order, mode='constant', cval=0.0)
+
+    jobs = jobs if jobs > 0 else cpu_count()
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(resample_volume, range(nt))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for it in range(nt):
+            resample_volume(it)
+
+    hdr = im_dest.hdr.copy()
+    hdr.set_data_dtype(data_out.dtype)
+    hdr.set_data_shape(data_out.shape)
+    hdr.set_xyzt_units(*im_src.hdr.get_xyzt_units())
+    hdr.set_zooms(im_dest.hdr.get_zooms()[:3] + (im_src.hdr.get_zooms()[3],))
+    return msct_image.Image(data_out, hdr=hdr)
+
+
+def warp_list_invert(fname_warp_list):
+    """
+    :param fname_warp_list: list of transformations, in the order of the -w option (the first one is applied first),
+                            with '-' before the affine matrices to invert
+    :return: list of transformations in the order of isct_ComposeMultiTransform (the last one is applied first), with
+             '-i' before the affine matrices to invert
+    """
+    fname_warp_list_invert = []
+    for path_warp in reversed(fname_warp_list):
+        if path_warp.startswith('-'):
+            fname_warp_list_invert += ['-i', path_warp[1:]]
+        else:
+            fname_warp_list_invert += [path_warp]
+    return fname_warp_list_invert
+
+
+def apply_transfo(im_src, im_dest, fname_warp_list, interp='spline', jobs=1, verbose=0):
+    """
+    Warp an image onto the grid of a destination image, in-process: the transformations are composed into a single
+    displacement field on the destination grid (see sct_concat_transfo.compose_warps(), which is skipped if the only
+    transformation is already such a field), which is used to resample the image with scipy, as Transform.apply() does
+    for 4D images.
+
+    :param im_src: Image: 3D or 4D source image
+    :param im_dest: Image: destination image, giving the geometry of the output
+    :param fname_warp_list: list of transformations (file names), in the order of the -w option, with '-' before the
+                            affine matrices to invert
+    :param interp: 'nn', 'linear' or 'spline'
+    :param jobs: number of threads used to resample 4D images. 0: use all the available CPUs.
+    :return: Image: image in the space of the destination image. float32, unless interp is 'nn', in which case the
+             data type of the source image is kept (e.g. for labels), or uint8 for boolean data.
+    """
+    if isinstance(fname_warp_list, str):
+        fname_warp_list = [fname_warp_list]
+    fname_warp_list_invert = warp_list_invert(fname_warp_list)
+    shape_dest = im_dest.hdr.get_data_shape()[:3]
+
+    im_warp = None
+    if len(fname_warp_list_invert) == 1 and fname_warp_list_invert[0].endswith(('.nii', '.nii.gz')):
+        im_warp = msct_image.Image(fname_warp_list_invert[0], mmap=True)
+        if im_warp.hdr.get_data_shape()[:3] != shape_dest \
+         or not np.allclose(im_warp.hdr.get_best_affine(), im_dest.hdr.get_best_affine()):
+            im_warp = None
+    if im_warp is None:
+        path_tmp = sct.tmp_create(basename="apply_transfo", verbose=verbose)
+        fname_dest = im_dest.absolutepath
+        if fname_dest is None or not os.path.isfile(fname_dest):
+            fname_dest = os.path.join(path_tmp, 'dest.nii.gz')
+            im_dest.save(fname_dest, verbose=0)
+        # the composed field is read into memory, as its file is removed with the temporary folder
+        im_warp = msct_image.Image(sct_concat_transfo.compose_warps(
+         fname_warp_list_invert, fname_dest, os.path.join(path_tmp, 'warp_composite.nii.gz'), '3', verbose=verbose),
+         mmap=False)
+        sct.rmtree(path_tmp, verbose=verbose)
+
+    coords = displacement_to_coordinates(im_warp, im_dest, im_src)
+    # same fallback as sct.get_interpolation()
+    order = INTERP_ORDER.get(interp, INTERP_ORDER['linear'])
+    if im_src.data.ndim == 4:
+        return resample_4d(im_src, im_dest, coords, order=order, jobs=jobs)
+
+    if order == 0:
+        # boolean masks (e.g. from sct_maths.binarise_image()) are stored as uint8, as NIfTI has no boolean type
+        data_in = np.asarray(im_src.data)
+        data_out = map_coordinates(data_in.astype(np.uint8) if data_in.dtype == bool else data_in, coords,
+                                   order=order, mode='constant', cval=0)
+    else:
+        data_out = map_coordinates(np.asarray(im_src.data, dtype=np.float64), coords, order=order, output=np.float32,
+                                   mode='constant', cval=0.0)
+    hdr = im_dest.hdr.copy()
+    hdr.set_data_dtype(data_out.dtype)
+    hdr.set_data_shape(data_out.shape)
+    return msct_image.Image(data_out, hdr=hdr)
+
+
 # MAIN
 # ==========================================================================================
 def main(args=None):
@@ -292,6 +429,8 @@ def main(args=None):
         transform.remove_temp_files = int(arguments["-r"])
     if "-v" in arguments:
         transform.verbose = int(arguments["-v"])
+    if "-jobs" in arguments:
+        transform.jobs = arguments["-jobs"]
 
     transform.apply()
 
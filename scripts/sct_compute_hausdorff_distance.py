@@ -15,6 +15,7 @@ from __future__ import absolute_import, division
 import sys, io, os, time, shutil
 
 import numpy as np
+from scipy.ndimage import distance_transform_edt
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -54,112 +55,98 @@ class Thinning:
                 sct.printv('-- changing orientation ...')
                 self.image.change_orientation('IRP')
 
-            thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            # all slices are thinned at once
+            thinned_data = self.zhang_suen(self.image.data)
 
             self.thinned_image = msct_image.empty_like(self.image)
             self.thinned_image.data = thinned_data
             self.thinned_image.absolutepath = sct.add_suffix(self.image.absolutepath, "_thinned")
 
     # ------------------------------------------------------------------------------------------------------------------
-    def get_neighbours(self, x, y, image):
+    def get_neighbours(self, image):
         """
-        Return 8-neighbours of image point P1(x,y), in a clockwise order
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param x:
-        :param y:
-        :param image:
-        :return:
+        Return the 8-neighbours of all points P1(x,y) of the image, in a clockwise order
+        The neighbours of border points wrap around the image, as with negative indexing.
+        :param image: 2d array, or 3d array of 2d slices along the first axis
+        :return: list of arrays of the same shape as image: P2, P3, ..., P9
         """
-        # now = time.time()
-        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
-        neighbours = [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],     # P2,P3,P4,P5
-                      image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]    # P6,P7,P8,P9
-        # t = time.time() - now
-        # sct.printv('t neighbours: ', t)
-        return neighbours
+        axes = (image.ndim - 2, image.ndim - 1)
+        # neighbour (x + dx, y + dy) of each point
+        shifted = lambda dx, dy: np.roll(np.roll(image, -dx, axis=axes[0]), -dy, axis=axes[1])
+        return [shifted(-1, 0), shifted(-1, 1), shifted(0, 1), shifted(1, 1),     # P2,P3,P4,P5
+                shifted(1, 0), shifted(1, -1), shifted(0, -1), shifted(-1, -1)]  # P6,P7,P8,P9
 
     # ------------------------------------------------------------------------------------------------------------------
     def transitions(self, neighbours):
         """
-        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param neighbours:
-        :return:
+        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence, for each point
+        :param neighbours: list of arrays P2, P3, ..., P9
+        :return: array
         """
-        # now = time.time()
         n = neighbours + neighbours[0:1]      # P2, P3, ... , P8, P9, P2
-        s = np.sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
-        # t = time.time() - now
-        # sct.printv('t transitions sum: ', t)
-        return s
+        return sum(((n1 == 0) & (n2 == 1)).astype(int) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
 
     # ------------------------------------------------------------------------------------------------------------------
     def zhang_suen(self, image):
         """
         the Zhang-Suen Thinning Algorithm
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param image:
+        adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        Each sub-iteration is applied to all points of the image at once. If image is 3d, each slice along the first
+        axis is thinned independently.
+        :param image: 2d or 3d binary array
         :return:
         """
-        # now = time.time()
         image_thinned = image.copy()  # deepcopy to protect the original image
-        changing1 = changing2 = 1  # the points to be removed (set as 0)
+        # points that are never removed
+        max = image_thinned.shape[-2] - 1
+        pass_list = [1, max]
+        x, y = np.meshgrid(np.arange(image_thinned.shape[-2]), np.arange(image_thinned.shape[-1]), indexing='ij')
+        removable = ~np.in1d(x, pass_list).reshape(x.shape) & ~np.in1d(y, pass_list).reshape(y.shape)
+
+        changing1 = changing2 = True  # the points to be removed (set as 0)
         while changing1 or changing2:  # iterates until no further changes occur in the image
             # Step 1
-            changing1 = []
-            max = len(image_thinned) - 1
-            pass_list = [1, max]
-            # rows, columns = image_thinned.shape  # x for rows, y for columns
-
-            # for x in range(1, rows - 1):         # No. of  rows
-            # for y in range(1, columns - 1):  # No. of columns
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0: Point P1 in the object regions
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and    # Condition 1: 2<= N(P1) <= 6
-                        P2 * P4 * P6 == 0 and    # Condition 3
-                        P4 * P6 * P8 == 0 and   # Condition 4
-                        self.transitions(n) == 1):    # Condition 2: S(P1)=1
-                        changing1.append((x, y))
-            for x, y in changing1:
-                image_thinned[x][y] = 0
+            P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(image_thinned)
+            to_remove = ((image_thinned == 1) & removable &  # Condition 0: Point P1 in the object regions
+                         (2 <= sum(n)) & (sum(n) <= 6) &  # Condition 1: 2<= N(P1) <= 6
+                         (P2 * P4 * P6 == 0) &  # Condition 3
+                         (P4 * P6 * P8 == 0) &  # Condition 4
+                         (self.transitions(n) == 1))  # Condition 2: S(P1)=1
+            changing1 = to_remove.any()
+            image_thinned[to_remove] = 0
             # Step 2
-            changing2 = []
-
-            # for x in range(1, rows - 1):
-            # for y in range(1, columns - 1):
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and       # Condition 1
-                        P2 * P4 * P8 == 0 and       # Condition 3
-                        P2 * P6 * P8 == 0 and  # Condition 4
-                        self.transitions(n) == 1):    # Condition 2
-                        changing2.append((x, y))
-            for x, y in changing2:
-                image_thinned[x][y] = 0
-        # t = time.time() - now
-        # sct.printv('t thinning: ', t)
+            P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(image_thinned)
+            to_remove = ((image_thinned == 1) & removable &  # Condition 0
+                         (2 <= sum(n)) & (sum(n) <= 6) &  # Condition 1
+                         (P2 * P4 * P8 == 0) &  # Condition 3
+                         (P2 * P6 * P8 == 0) &  # Condition 4
+                         (self.transitions(n) == 1))  # Condition 2
+            changing2 = to_remove.any()
+            image_thinned[to_remove] = 0
         return image_thinned
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # HAUSDORFF'S DISTANCE -------------------------------------------------------------------------------------------------
 class HausdorffDistance:
-    def __init__(self, data1, data2, v=1):
+    def __init__(self, data1, data2, v=1, min_distances=None):
         """
         the hausdorff distance between two sets is the maximum of the distances from a point in any of the sets to the nearest point in the other set
+        :param min_distances: (min_distances_1, min_distances_2): distances already computed by relative_hausdorff_dist
         :return:
         """
-        # now = time.time()
-        sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
-        self.data1 = bin_data(data1)
-        self.data2 = bin_data(data2)
+        if min_distances is None:
+            sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
+            self.data1 = bin_data(data1)
+            self.data2 = bin_data(data2)
+            if not self.data1.any() or not self.data2.any():
+                sct.printv('Warning: an image is empty', v, 'warning')
+            min_distances = relative_hausdorff_dist(self.data1, self.data2), relative_hausdorff_dist(self.data2, self.data1)
+        else:
+            self.data1 = data1
+            self.data2 = data2
 
-        self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
-        self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
+        self.min_distances_1, self.min_distances_2 = min_distances
 
         # relatives hausdorff's distances in pixel
         self.h1 = np.max(self.min_distances_1)
@@ -167,31 +154,51 @@ class HausdorffDistance:
 
         # Hausdorff's distance in pixel
         self.H = max(self.h1, self.h2)
-        # t = time.time() - now
-        # sct.printv('Hausdorff dist time :', t)
 
     # ------------------------------------------------------------------------------------------------------------------
-    def relative_hausdorff_dist(self, dat1, dat2, v=1):
-        h = np.zeros(dat1.shape)
-        nz_coord_1 = non_zero_coord(dat1)
-        nz_coord_2 = non_zero_coord(dat2)
-        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0 :
-            for x1, y1 in nz_coord_1:
-                # for x1 in range(dat1.shape[0]):
-                # for y1 in range(dat1.shape[1]):
-                # if dat1[x1, y1] == 1:
-                d_p1_dat2 = []
-                p1 = np.asarray([x1, y1])
-                for x2, y2 in nz_coord_2:
-                    # for x2 in range(dat2.shape[0]):
-                    # for y2 in range(dat2.shape[1]):
-                    # if dat2[x2, y2] == 1:
-                    p2 = np.asarray([x2, y2])
-                    d_p1_dat2.append(np.linalg.norm(p1 - p2))  # Euclidean distance between p1 and p2
-                h[x1, y1] = min(d_p1_dat2)
-        else:
-            sct.printv('Warning: an image is empty', v, 'warning')
-        return h
+    @classmethod
+    def slicewise(cls, data1, data2, v=1):
+        """
+        Compute the 2D hausdorff distance between each pair of slices (along the first axis) of two volumes
+        :param data1: 3d array
+        :param data2: 3d array
+        :return: list of HausdorffDistance, one per slice
+        """
+        sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
+        data1, data2 = bin_data(data1), bin_data(data2)
+        for i in np.nonzero(~data1.any(axis=(1, 2)) | ~data2.any(axis=(1, 2)))[0]:
+            sct.printv('Warning: an image is empty (slice ' + str(i) + ')', v, 'warning')
+
+        min_distances_1 = relative_hausdorff_dist(data1, data2)
+        min_distances_2 = relative_hausdorff_dist(data2, data1)
+        return [cls(slice1, slice2, v, min_distances=(dist1, dist2))
+                for slice1, slice2, dist1, dist2 in zip(data1, data2, min_distances_1, min_distances_2)]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def relative_hausdorff_dist(dat1, dat2):
+    """
+    Compute the Euclidean distance (in pixel) from each nonzero point of dat1 to the nearest nonzero point of dat2,
+    using the distance transform of dat2. 3d arrays are processed as stacks of 2d slices along the first axis.
+    :param dat1: 2d or 3d binary array
+    :param dat2: 2d or 3d binary array, same shape as dat1
+    :return: array of the same shape as dat1, 0 outside of dat1 and where dat1 or dat2 is empty (in the 2d slice)
+    """
+    dat1, dat2 = np.asarray(dat1) > 0, np.asarray(dat2) > 0
+    h = np.zeros(dat1.shape)
+    if dat1.ndim == 2:
+        dat1, dat2, h_slices = dat1[np.newaxis], dat2[np.newaxis], h[np.newaxis]
+    else:
+        h_slices = h
+    # only consider the slices in which both images are nonzero
+    nz_slices = np.nonzero(dat1.any(axis=(1, 2)) & dat2.any(axis=(1, 2)))[0]
+    if nz_slices.size:
+        # the spacing between slices is larger than any in-slice distance, so that the nearest point is always found
+        # in the same slice, which allows to compute the distance transform of all the slices at once
+        spacing_slices = float(np.sum(dat1.shape[1:]))
+        dist = distance_transform_edt(~dat2[nz_slices], sampling=(spacing_slices, 1, 1))
+        h_slices[nz_slices] = np.where(dat1[nz_slices], dist, 0)
+    return h
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -297,9 +304,7 @@ class ComputeDistances:
         else:
             dat1 = bin_data(self.im1.data)
 
-        self.distances = []
-        for i, dat_slice in enumerate(dat1[:-1]):
-            self.distances.append(HausdorffDistance(bin_data(dat_slice), bin_data(dat1[i + 1]), self.param.verbose))
+        self.distances = HausdorffDistance.slicewise(dat1[:-1], dat1[1:], self.param.verbose)
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_2im_3d(self):
@@ -316,9 +321,7 @@ class ComputeDistances:
             dat1 = bin_data(self.im1.data)
             dat2 = bin_data(self.im2.data)
 
-        self.distances = []
-        for slice1, slice2 in zip(dat1, dat2):
-            self.distances.append(HausdorffDistance(slice1, slice2, self.param.verbose))
+        self.distances = HausdorffDistance.slicewise(dat1, dat2, self.param.verbose)
 
     # ------------------------------------------------------------------------------------------------------------------
     def show_results(self):
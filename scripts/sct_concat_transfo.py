@@ -19,7 +19,9 @@ import sys, io, os, getopt, functools
 
 import sct_utils as sct
 from msct_parser import Parser
+from sct_convert import convert
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CacheStore, cache_key, CACHE_HELP
 
 # DEFAULT PARAMETERS
 
@@ -31,9 +33,13 @@ class Param:
         self.fname_warp_final = 'warp_final.nii.gz'
 
 
+# initialize parameters
+param = Param()
+
+
 # main
 #=======================================================================================================================
-def main():
+def main(args=None):
 
     # Initialization
     fname_warp_list = ''  # list of warping fields
@@ -50,8 +56,10 @@ def main():
         verbose = 1
     else:
         # Check input parameters
+        if not args:
+            args = sys.argv[1:]
         parser = get_parser()
-        arguments = parser.parse(sys.argv[1:])
+        arguments = parser.parse(args)
 
         fname_dest = arguments['-d']
         fname_warp_list = arguments['-w']
@@ -100,12 +108,7 @@ def main():
     fname_warp_list_invert.reverse()
     fname_warp_list_invert = functools.reduce(lambda x,y: x+y, fname_warp_list_invert)
 
-    cmd = ['isct_ComposeMultiTransform', dimensionality, 'warp_final' + ext_out, '-R', fname_dest] + fname_warp_list_invert
-    status, output = sct.run(cmd, verbose=verbose)
-
-    # check if output was generated
-    if not os.path.isfile('warp_final' + ext_out):
-        sct.printv('ERROR: Warping field was not generated.\n' + output, 1, 'error')
+    compose_warps(fname_warp_list_invert, fname_dest, 'warp_final' + ext_out, dimensionality, verbose=verbose)
 
     # Generate output files
     sct.printv('\nGenerate output files...', verbose)
@@ -113,10 +116,48 @@ def main():
 
 
 # ==========================================================================================
+def compose_warps(fname_warp_list_invert, fname_dest, fname_out, dimensionality='3', verbose=1):
+    """
+    Compose transformations into a single warping field, defined on the grid of the destination image. Composed
+    warping fields are cached (see spinalcordtoolbox.cache), so that a chain of transformations is only composed once
+    for a given destination grid.
+
+    :param fname_warp_list_invert: list of transformations, in the order of isct_ComposeMultiTransform (i.e. the last
+                                   one is applied first), with '-i' before the affine matrices to invert
+    :param fname_dest: destination image
+    :param fname_out: output warping field
+    :param dimensionality: '2' or '3'
+    :return: fname_out
+    """
+    store = CacheStore('composed_warps')
+    key = cache_key(input_files=[f for f in fname_warp_list_invert if f != '-i'],
+                    input_geometries=[fname_dest],
+                    input_params={'dimensionality': dimensionality,
+                                  'inverse': [f == '-i' for f in fname_warp_list_invert]})
+    path_tmp = sct.tmp_create(basename="compose_warps", verbose=0)
+    file_warp = 'warp_composed.nii.gz'
+    if not store.get(key, [file_warp], path_out=path_tmp):
+        cmd = ['isct_ComposeMultiTransform', dimensionality, os.path.join(path_tmp, file_warp), '-R', fname_dest] \
+              + fname_warp_list_invert
+        status, output = sct.run(cmd, verbose=verbose)
+        # check if output was generated
+        if not os.path.isfile(os.path.join(path_tmp, file_warp)):
+            sct.printv('ERROR: Warping field was not generated.\n' + output, 1, 'error')
+        store.put(key, [file_warp], path_in=path_tmp)
+    if fname_out.endswith('.nii.gz'):
+        sct.copy(os.path.join(path_tmp, file_warp), fname_out, verbose=0)
+    else:
+        # keep the 5D shape of the warping field
+        convert(os.path.join(path_tmp, file_warp), fname_out, squeeze_data=False, verbose=0)
+    sct.rmtree(path_tmp, verbose=0)
+    return fname_out
+
+
 def get_parser():
     # Initialize the parser
     parser = Parser(__file__)
-    parser.usage.set_description('Concatenate transformations. This function is a wrapper for isct_ComposeMultiTransform (ANTs). N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.')
+    parser.usage.set_description('Concatenate transformations. This function is a wrapper for isct_ComposeMultiTransform (ANTs). N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.\n\n'
+                                 + CACHE_HELP)
     parser.add_option(name="-d",
                       type_value="file",
                       description="Destination image.",
@@ -147,7 +188,5 @@ def get_parser():
 #=======================================================================================================================
 if __name__ == "__main__":
     sct.init_sct()
-    # initialize parameters
-    param = Param()
     # call main function
     main()
@@ -31,6 +31,8 @@ from sct_deepseg_sc import find_centerline, crop_image_around_centerline, uncrop
 
 import spinalcordtoolbox.resample.nipy_resample
 from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_ctr
+from spinalcordtoolbox.deepseg_sc.sliding_window import predict_sliding_window
+from spinalcordtoolbox.model_registry import get_model
 
 BATCH_SIZE = 4
 
@@ -153,32 +155,17 @@ def segment_3d(model_fname, contrast_type, fname_in, fname_out):
                     't2s': {'size': (48, 48, 48), 'mean': 1011.31, 'std': 678.985}}
 
     # load 3d model
-    seg_model = load_trained_model(model_fname)
+    seg_model = get_model(('deepseg_lesion_3d', model_fname), lambda: load_trained_model(model_fname))
 
     im = Image(fname_in)
 
     out = msct_image.zeros_like(im, dtype=np.uint8)
 
-    # segment the spinal cord
-    z_patch_size = dct_patch_3d[contrast_type]['size'][2]
-    z_step_keep = list(range(0, im.data.shape[2], z_patch_size))
-    for zz in z_step_keep:
-        if zz == z_step_keep[-1]:  # deal with instances where the im.data.shape[2] % patch_size_z != 0
-            patch_im = np.zeros(dct_patch_3d[contrast_type]['size'])
-            z_patch_extracted = im.data.shape[2] - zz
-            patch_im[:, :, :z_patch_extracted] = im.data[:, :, zz:]
-        else:
-            z_patch_extracted = z_patch_size
-            patch_im = im.data[:, :, zz:z_patch_size + zz]
-
-        if np.any(patch_im):  # Check if the patch is (not) empty, which could occur after a brain detection.
-            patch_norm = _normalize_data(patch_im, dct_patch_3d[contrast_type]['mean'], dct_patch_3d[contrast_type]['std'])
-            patch_pred_proba = seg_model.predict(np.expand_dims(np.expand_dims(patch_norm, 0), 0), batch_size=BATCH_SIZE)
-            pred_seg_th = (patch_pred_proba > 0.1).astype(int)[0, 0, :, :, :]
-            if zz == z_step_keep[-1]:
-                out.data[:, :, zz:] = pred_seg_th[:, :, :z_patch_extracted]
-            else:
-                out.data[:, :, zz:z_patch_size + zz] = pred_seg_th
+    # segment the lesions
+    mean, std = dct_patch_3d[contrast_type]['mean'], dct_patch_3d[contrast_type]['std']
+    pred_proba = predict_sliding_window(seg_model, im.data, dct_patch_3d[contrast_type]['size'],
+                                        batch_size=BATCH_SIZE, preprocess=lambda x: _normalize_data(x, mean, std))
+    out.data = (pred_proba > 0.1).astype(np.uint8)
 
     out.save(fname_out)
 
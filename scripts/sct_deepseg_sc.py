@@ -16,6 +16,7 @@ from __future__ import division, absolute_import
 
 import os
 import sys
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy.ndimage.measurements import center_of_mass, label
 from scipy.ndimage.morphology import binary_fill_holes
@@ -32,9 +33,14 @@ from spinalcordtoolbox.process_seg import extract_centerline
 
 import spinalcordtoolbox.resample.nipy_resample
 from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_seg, nn_architecture_ctr
+from spinalcordtoolbox.deepseg_sc.sliding_window import predict_sliding_window
+from spinalcordtoolbox.model_registry import get_model
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 BATCH_SIZE = 4
+# maximum number of axial slices segmented by a single call to the 2D model, and memory (in MB) they can use
+BATCH_SIZE_SLICES = 64
+BATCH_MAX_MEMORY = 1024
 
 
 def get_parser():
@@ -261,12 +267,12 @@ def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_
     """Scan the entire axial slice to detect the centerline."""
     z_slice_out = np.zeros(z_out_dim)
     sum_lst = []
-    # loop across all the non-overlapping blocks of a cross-sectional slice
+    # all the non-overlapping blocks of a cross-sectional slice are predicted in a single batch
+    blocks_nn = np.expand_dims(np.stack([z_slice[coord[0]:coord[2], coord[1]:coord[3]] for coord in coord_lst]), -1)
+    blocks_nn_norm = _normalize_data(blocks_nn, mean_train, std_train)
+    blocks_pred = model.predict(blocks_nn_norm, batch_size=len(coord_lst))
     for idx, coord in enumerate(coord_lst):
-        block = z_slice[coord[0]:coord[2], coord[1]:coord[3]]
-        block_nn = np.expand_dims(np.expand_dims(block, 0), -1)
-        block_nn_norm = _normalize_data(block_nn, mean_train, std_train)
-        block_pred = model.predict(block_nn_norm, batch_size=BATCH_SIZE)
+        block_pred = blocks_pred[idx:idx + 1]
 
         if coord[2] > z_out_dim[0]:
             x_end = patch_shape[0] - (coord[2] - z_out_dim[0])
@@ -450,18 +456,9 @@ def find_centerline(algo, image_fname, path_sct, contrast_type, brain_bool, fold
 
         # load model
         ctr_model_fname = os.path.join(path_sct, 'data', 'deepseg_sc_models', '{}_ctr.h5'.format(contrast_type))
-        ctr_model = nn_architecture_ctr(height=dct_patch_ctr[contrast_type]['size'][0],
-                                        width=dct_patch_ctr[contrast_type]['size'][1],
-                                        channels=1,
-                                        classes=1,
-                                        features=dct_params_ctr[contrast_type]['features'],
-                                        depth=2,
-                                        temperature=1.0,
-                                        padding='same',
-                                        batchnorm=True,
-                                        dropout=0.0,
-                                        dilation_layers=dct_params_ctr[contrast_type]['dilation_layers'])
-        ctr_model.load_weights(ctr_model_fname)
+        ctr_model = get_model(('deepseg_sc_ctr', ctr_model_fname, contrast_type),
+                              lambda: load_ctr_model(ctr_model_fname, dct_patch_ctr[contrast_type]['size'],
+                                                     dct_params_ctr[contrast_type]))
 
         sct.log.info("Resample the image to 0.5 mm isotropic resolution...")
         fname_res = sct.add_suffix(image_fname, '_resampled')
@@ -523,6 +520,23 @@ def find_centerline(algo, image_fname, path_sct, contrast_type, brain_bool, fold
     return fname_res, centerline_filename
 
 
+def load_ctr_model(model_fname, patch_size, params):
+    """Load the model used to detect the centerline (see find_centerline())."""
+    ctr_model = nn_architecture_ctr(height=patch_size[0],
+                                    width=patch_size[1],
+                                    channels=1,
+                                    classes=1,
+                                    features=params['features'],
+                                    depth=2,
+                                    temperature=1.0,
+                                    padding='same',
+                                    batchnorm=True,
+                                    dropout=0.0,
+                                    dilation_layers=params['dilation_layers'])
+    ctr_model.load_weights(model_fname)
+    return ctr_model
+
+
 def _normalize_data(data, mean, std):
     """Util function to normalized data based on learned mean and std."""
     data -= mean
@@ -530,8 +544,31 @@ def _normalize_data(data, mean, std):
     return data
 
 
-def segment_2d(model_fname, contrast_type, input_size, im_in):
-    """Segment data using 2D convolutions."""
+def _prefetch(func, list_args):
+    """Yield func(*args) for each args in list_args. The next result is computed in a background thread while the
+    current one is being used."""
+    pool = ThreadPool(1)
+    try:
+        result = pool.apply_async(func, list_args[0]) if list_args else None
+        for i in range(len(list_args)):
+            current = result.get()
+            if i + 1 < len(list_args):
+                result = pool.apply_async(func, list_args[i + 1])
+            yield current
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_batch_size(slice_shape, features, batch_size=BATCH_SIZE_SLICES, max_memory=BATCH_MAX_MEMORY):
+    """Number of slices per batch, so that the activations of the first layers (which are the largest ones) fit
+    within max_memory MB."""
+    memory_slice = 4 * int(np.prod(slice_shape)) * features * 4  # float32, ~4 feature maps at full resolution
+    return int(max(1, min(batch_size, max_memory * 1024 ** 2 // memory_slice)))
+
+
+def load_seg_model_2d(model_fname, contrast_type, input_size):
+    """Load the model used by segment_2d()."""
     seg_model = nn_architecture_seg(height=input_size[0],
                                     width=input_size[1],
                                     depth=2 if contrast_type != 't2' else 3,
@@ -539,20 +576,47 @@ def segment_2d(model_fname, contrast_type, input_size, im_in):
                                     batchnorm=False,
                                     dropout=0.0)
     seg_model.load_weights(model_fname)
+    return seg_model
+
+
+def segment_2d(model_fname, contrast_type, input_size, im_in, seg_model=None, batch_size=BATCH_SIZE_SLICES,
+               max_memory=BATCH_MAX_MEMORY):
+    """Segment data using 2D convolutions.
+    The axial slices are segmented by batches, which are prepared while the previous batch is being segmented.
+    :param seg_model: model already loaded with load_seg_model_2d(). If None, it is taken from the model registry.
+    :param batch_size: maximum number of slices per batch
+    :param max_memory: maximum memory used by a batch, in MB
+    """
+    if seg_model is None:
+        seg_model = get_model(('deepseg_sc_2d', model_fname, contrast_type, tuple(input_size)),
+                              lambda: load_seg_model_2d(model_fname, contrast_type, input_size))
 
     seg_crop = msct_image.zeros_like(im_in, dtype=np.uint8)
 
     data_norm = im_in.data
-    x_cOm, y_cOm = None, None
-    for zz in range(im_in.dim[2]):
-        pred_seg = seg_model.predict(np.expand_dims(np.expand_dims(data_norm[:, :, zz], -1), 0), batch_size=BATCH_SIZE)[0, :, :, 0]
-        pred_seg_th = (pred_seg > 0.5).astype(int)
-        pred_seg_pp = post_processing_slice_wise(pred_seg_th, x_cOm, y_cOm)
-        seg_crop.data[:, :, zz] = pred_seg_pp
+    nz = im_in.dim[2]
+    batch_size = _get_batch_size(data_norm.shape[:2], 32, batch_size, max_memory)
+
+    def prepare_batch(z_start, z_stop):
+        # slices along the first axis, with a channel axis
+        return np.expand_dims(np.ascontiguousarray(np.moveaxis(data_norm[:, :, z_start:z_stop], -1, 0)), -1)
 
-        if 1 in pred_seg_pp:
-            x_cOm, y_cOm = center_of_mass(pred_seg_pp)
-            x_cOm, y_cOm = np.round(x_cOm), np.round(y_cOm)
+    list_z_start = list(range(0, nz, batch_size))
+    list_batches = _prefetch(prepare_batch, [(z_start, min(z_start + batch_size, nz)) for z_start in list_z_start])
+
+    x_cOm, y_cOm = None, None
+    for z_start, batch in zip(list_z_start, list_batches):
+        pred_batch = seg_model.predict(batch, batch_size=len(batch))
+        for i_slice in range(len(batch)):
+            zz = z_start + i_slice
+            pred_seg = pred_batch[i_slice, :, :, 0]
+            pred_seg_th = (pred_seg > 0.5).astype(int)
+            pred_seg_pp = post_processing_slice_wise(pred_seg_th, x_cOm, y_cOm)
+            seg_crop.data[:, :, zz] = pred_seg_pp
+
+            if 1 in pred_seg_pp:
+                x_cOm, y_cOm = center_of_mass(pred_seg_pp)
+                x_cOm, y_cOm = np.round(x_cOm), np.round(y_cOm)
 
     return seg_crop.data
 
@@ -597,45 +661,35 @@ def segment_3d(model_fname, contrast_type, im_in):
                         't2s': {'size': (96, 96, 48), 'mean': 87.0212, 'std': 64.425},
                         't1': {'size': (64, 64, 48), 'mean': 88.5001, 'std': 66.275}}
     # load 3d model
-    seg_model = load_trained_model(model_fname)
+    seg_model = get_model(('deepseg_sc_3d', model_fname), lambda: load_trained_model(model_fname))
 
     out = msct_image.zeros_like(im_in, dtype=np.uint8)
 
     # segment the spinal cord
-    z_patch_size = dct_patch_sc_3d[contrast_type]['size'][2]
-    z_step_keep = list(range(0, im_in.data.shape[2], z_patch_size))
-    for zz in z_step_keep:
-        if zz == z_step_keep[-1]:  # deal with instances where the im.data.shape[2] % patch_size_z != 0
-            patch_im = np.zeros(dct_patch_sc_3d[contrast_type]['size'])
-            z_patch_extracted = im_in.data.shape[2] - zz
-            patch_im[:, :, :z_patch_extracted] = im_in.data[:, :, zz:]
-        else:
-            z_patch_extracted = z_patch_size
-            patch_im = im_in.data[:, :, zz:z_patch_size + zz]
-
-        if np.any(patch_im):  # Check if the patch is (not) empty, which could occur after a brain detection.
-            patch_norm = _normalize_data(patch_im, dct_patch_sc_3d[contrast_type]['mean'], dct_patch_sc_3d[contrast_type]['std'])
-            patch_pred_proba = seg_model.predict(np.expand_dims(np.expand_dims(patch_norm, 0), 0), batch_size=BATCH_SIZE)
-            pred_seg_th = (patch_pred_proba > 0.5).astype(int)[0, 0, :, :, :]
-
-            x_cOm, y_cOm = None, None
-            for zz_pp in range(z_patch_size):
-                pred_seg_pp = post_processing_slice_wise(pred_seg_th[:, :, zz_pp], x_cOm, y_cOm)
-                pred_seg_th[:, :, zz_pp] = pred_seg_pp
-                x_cOm, y_cOm = center_of_mass(pred_seg_pp)
-                x_cOm, y_cOm = np.round(x_cOm), np.round(y_cOm)
+    mean, std = dct_patch_sc_3d[contrast_type]['mean'], dct_patch_sc_3d[contrast_type]['std']
+    pred_proba = predict_sliding_window(seg_model, im_in.data, dct_patch_sc_3d[contrast_type]['size'],
+                                        batch_size=BATCH_SIZE, preprocess=lambda x: _normalize_data(x, mean, std))
+    pred_seg_th = (pred_proba > 0.5).astype(int)
 
-            if zz == z_step_keep[-1]:
-                out.data[:, :, zz:] = pred_seg_th[:, :, :z_patch_extracted]
-            else:
-                out.data[:, :, zz:z_patch_size + zz] = pred_seg_th
+    x_cOm, y_cOm = None, None
+    for zz in range(pred_seg_th.shape[2]):
+        pred_seg_pp = post_processing_slice_wise(pred_seg_th[:, :, zz], x_cOm, y_cOm)
+        out.data[:, :, zz] = pred_seg_pp
+        x_cOm, y_cOm = center_of_mass(pred_seg_pp)
+        x_cOm, y_cOm = np.round(x_cOm), np.round(y_cOm)
 
     return out
 
 
 def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_file=None, brain_bool=True,
                                  kernel_size='2d', remove_temp_files=1, verbose=1):
-    """Pipeline."""
+    """Pipeline.
+
+    The intermediate files are written in a temporary folder created for each call, so that several images can be
+    segmented in the same process (see deep_segmentation_spinalcord_batch()).
+    :return: segmentation (in the orientation of im_image), image resampled in RPI, and segmentation resampled in RPI
+             (in memory: this last image is not saved)
+    """
     path_script = os.path.dirname(__file__)
     path_sct = os.path.dirname(path_script)
 
@@ -759,7 +813,17 @@ def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_fi
         tmp_folder.cleanup()
 
     # reorient to initial orientation
-    return im_image_res_seg_downsamp_postproc.change_orientation(original_orientation), im_nii, seg_uncrop_nii.change_orientation('RPI').save('image_in_RPI_resampled_seg.nii.gz')
+    return im_image_res_seg_downsamp_postproc.change_orientation(original_orientation), im_nii, seg_uncrop_nii.change_orientation('RPI')
+
+
+def deep_segmentation_spinalcord_batch(list_im_image, contrast_type, **kwargs):
+    """Segment several images with the same models, which are only loaded once (see
+    spinalcordtoolbox.model_registry).
+    :param list_im_image: list of Image
+    :param kwargs: see deep_segmentation_spinalcord()
+    :return: list of the outputs of deep_segmentation_spinalcord(), one per image
+    """
+    return [deep_segmentation_spinalcord(im_image, contrast_type, **kwargs) for im_image in list_im_image]
 
 
 def generate_qc(im_image, im_seg, args, path_qc):
@@ -34,7 +34,6 @@ from __future__ import division, absolute_import
 
 import sys, os, time, math
 import importlib
-from tqdm import tqdm
 import numpy as np
 
 import sct_utils as sct
@@ -42,7 +41,6 @@ import msct_moco as moco
 import sct_dmri_separate_b0_and_dwi
 from sct_convert import convert
 from spinalcordtoolbox.image import Image
-from sct_image import split_data, concat_data
 from msct_parser import Parser
 
 
@@ -78,6 +76,7 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterAvg = 1  # iteratively average target image for more robust moco
+        self.jobs = 1  # number of volumes registered in parallel
         self.is_sagittal = False  # if True, then split along Z (right-left) and register each 2D slice (vs. 3D volume)
 # Note: this feature is currently ONLY supported by sct_fmri_moco (not here).
 
@@ -182,6 +181,12 @@ def get_parser():
                       mandatory=False,
                       default_value='./',
                       example='dmri_moco_results/')
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of volumes registered in parallel. 0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=param_default.jobs,
+                      example=4)
     parser.usage.addSection('MISC')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
@@ -240,6 +245,8 @@ def main(args=None):
         param.interp = arguments['-x']
     if '-ofolder' in arguments:
         path_out = arguments['-ofolder']
+    if '-jobs' in arguments:
+        param.jobs = arguments['-jobs']
     if '-r' in arguments:
         param.remove_temp_files = int(arguments['-r'])
     if '-v' in arguments:
@@ -331,7 +338,8 @@ def dmri_moco(param):
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    im_data = Image(file_data + ext_data)
+    # the data is memory-mapped, so that volumes are only read when they are used
+    im_data = Image(file_data + ext_data, mmap=True)
     nx, ny, nz, nt, px, py, pz, pt = im_data.dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), param.verbose)
 
@@ -345,25 +353,11 @@ def dmri_moco(param):
 
     # Prepare NIFTI (mean/groups...)
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
-
     # Merge b=0 images
     sct.printv('\nMerge b=0...', param.verbose)
-    im_b0_list = []
-    for it in range(nb_b0):
-        im_b0_list.append(im_data_split_list[index_b0[it]])
-    im_b0_out = concat_data(im_b0_list, 3).save(file_b0 + ext_data)
+    moco.image_like(im_data, im_data.data[..., index_b0]).save(file_b0 + ext_data)
     sct.printv(('  File created: ' + file_b0), param.verbose)
 
-    # Average b=0 images
-    sct.printv('\nAverage b=0...', param.verbose)
-    file_b0_mean = file_b0 + '_mean'
-    sct.run(['sct_maths', '-i', file_b0 + ext_data, '-o', file_b0_mean + ext_data, '-mean', 't'], param.verbose)
-
     # Number of DWI groups
     nb_groups = int(math.floor(nb_dwi / param.group_size))
 
@@ -378,34 +372,21 @@ def dmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_dwi[len(index_dwi) - nb_remaining:len(index_dwi)])
 
-    # DWI groups
-    file_dwi_mean = []
-    for iGroup in tqdm(range(nb_groups), unit='iter', unit_scale=False, desc="Merge within groups", ascii=True, ncols=80):
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
-        # Merge DW Images
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
-        im_dwi_list = []
-        for it in range(nb_dwi_i):
-            im_dwi_list.append(im_data_split_list[index_dwi_i[it]])
-        im_dwi_out = concat_data(im_dwi_list, 3).save(file_dwi_merge_i + ext_data)
-        # Average DW Images
-        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
-        sct.run(["sct_maths", "-i", file_dwi_merge_i + ext_data, "-o", file_dwi_mean[iGroup] + ext_data, "-mean", "t"], 0)
-
-    # Merge DWI groups means
-    sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    im_dw_list = []
-    for iGroup in range(nb_groups):
-        im_dw_list.append(file_dwi_mean[iGroup] + ext_data)
-    im_dw_out = concat_data(im_dw_list, 3).save(file_dwi_group + ext_data)
+    # Average DW images within groups, and merge the groups means. The output 4D volume will be used for motion
+    # correction.
+    sct.printv('\nAverage DW images within groups...', param.verbose)
+    im_dw_out = moco.average_groups(im_data, group_indexes).save(file_dwi_group + ext_data)
 
-    # Average DW Images
-    # TODO: USEFULL ???
-    sct.printv('\nAveraging all DW images...', param.verbose)
-    sct.run(["sct_maths", "-i", file_dwi_group + ext_data, "-o", file_dwi_group + '_mean' + ext_data, "-mean", "t"], param.verbose)
+    # Save the images used as target for registration: the b=0 image before the first DWI (or the first b=0) and the
+    # mean of the first DWI group
+    if index_dwi[0] != 0:
+        index_b0_target = index_b0[index_dwi[0] - 1]
+    else:
+        index_b0_target = index_b0[0]
+    file_b0_target = file_data + '_T' + str(index_b0_target).zfill(4)
+    moco.image_like(im_data, im_data.data[..., index_b0_target]).save(file_b0_target + ext_data)
+    file_dwi_mean = [file_dwi + '_mean_' + str(0)]
+    moco.image_like(im_dw_out, im_dw_out.data[..., 0]).save(file_dwi_mean[0] + ext_data)
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -430,14 +411,9 @@ def dmri_moco(param):
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco = param
     param_moco.file_data = 'b0'
-    # identify target image
-    if index_dwi[0] != 0:
-        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
-        # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0] - 1]).zfill(4)
-    else:
-        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+    # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
+    # it is the target image for registration of all b=0. Otherwise, the target b=0 is the first b=0 from the index_b0.
+    param_moco.file_target = file_b0_target
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
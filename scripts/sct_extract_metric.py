@@ -26,7 +26,8 @@ import numpy as np
 
 from spinalcordtoolbox.metadata import read_label_file
 from spinalcordtoolbox.utils import parse_num_list
-from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metric, save_as_csv, Metric, LabelStruc
+from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metrics, save_as_csv, Metric, LabelStruc
+from spinalcordtoolbox.template import get_vert_level_index
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
 from msct_parser import Parser
@@ -320,9 +321,9 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
     labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
     # Load vertebral levels
     if vertebral_levels:
-        im_vertebral_labeling = Image(fname_vertebral_labeling).change_orientation("RPI")
+        vert_level_index = get_vert_level_index(fname_vertebral_labeling)
     else:
-        im_vertebral_labeling = None
+        vert_level_index = None
 
         # Get dimensions of data and labels
     nx, ny, nz = data.data.shape
@@ -332,13 +333,15 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
     if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
         sct.printv('\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.', 1, type='error')
 
+    # Run the estimation for all labels at once
+    sct.printv('\nEstimate metric within labels...', verbose)
+    agg_metrics = extract_metrics([data], labels=labels, slices=slices, levels=levels, perslice=perslice,
+                                  perlevel=perlevel, vert_level=vert_level_index, method=method,
+                                  label_struc=label_struc, ids_label=labels_id_user, indiv_labels_ids=indiv_labels_ids)
+
     for id_label in labels_id_user:
         sct.printv('Estimation for label: '+label_struc[id_label].name, verbose)
-        agg_metric = extract_metric(data, labels=labels, slices=slices, levels=levels, perslice=perslice,
-                                    perlevel=perlevel, vert_level=im_vertebral_labeling, method=method,
-                                    label_struc=label_struc, id_label=id_label, indiv_labels_ids=indiv_labels_ids)
-
-        save_as_csv(agg_metric, fname_output, fname_in=fname_data, append=append)
+        save_as_csv(agg_metrics[id_label], fname_output, fname_in=fname_data, append=append)
         append = True  # when looping across labels, need to append results in the same file
     sct.printv('\nFile created: ' + fname_output, verbose=1, type='info')
 
@@ -17,14 +17,12 @@ import sys
 import os
 import time
 import math
-from tqdm import tqdm
 import numpy as np
 import sct_utils as sct
 import msct_moco as moco
 import sct_maths
 from sct_convert import convert
 from spinalcordtoolbox.image import Image
-from sct_image import split_data, concat_data
 from msct_parser import Parser
 
 
@@ -62,6 +60,7 @@ class Param:
         self.iterAvg = 1  # iteratively average target image for more robust moco
         self.num_target = '0'
         self.is_sagittal = False  # if True, then split along Z (right-left) and register each 2D slice (vs. 3D volume)
+        self.jobs = 1  # number of volumes registered in parallel
 
     # update constructor with user's parameters
     def update(self, param_user):
@@ -132,6 +131,12 @@ def get_parser():
                       mandatory=False,
                       default_value='linear',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of volumes registered in parallel. 0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=param_default.jobs,
+                      example=4)
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -178,6 +183,8 @@ def main(args=None):
         param.interp = arguments['-x']
     if '-ofolder' in arguments:
         path_out = arguments['-ofolder']
+    if '-jobs' in arguments:
+        param.jobs = arguments['-jobs']
     if '-r' in arguments:
         param.remove_temp_files = int(arguments['-r'])
     if '-v' in arguments:
@@ -245,7 +252,8 @@ def fmri_moco(param):
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    im_data = Image(file_data + '.nii')
+    # the data is memory-mapped, so that volumes are only read when they are used
+    im_data = Image(file_data + ext_data, mmap=True)
     nx, ny, nz, nt, px, py, pz, pt = im_data.dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
 
@@ -266,13 +274,6 @@ def fmri_moco(param):
         sct.printv('For sagittal data group_size should be one for more robustness. Forcing group_size=1.', 1, 'warning')
         param.group_size = 1
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data = Image(file_data + ext_data)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
-
     # assign an index to each volume
     index_fmri = list(range(0, nt))
 
@@ -290,43 +291,15 @@ def fmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_fmri[len(index_fmri) - nb_remaining:len(index_fmri)])
 
-    # groups
-    for iGroup in tqdm(range(nb_groups), unit='iter', unit_scale=False, desc="Merge within groups", ascii=True, ncols=80):
-        # get index
-        index_fmri_i = group_indexes[iGroup]
-        nt_i = len(index_fmri_i)
-
-        # Merge Images
-        file_data_merge_i = file_data + '_' + str(iGroup)
-        # cmd = fsloutput + 'fslmerge -t ' + file_data_merge_i
-        # for it in range(nt_i):
-        #     cmd = cmd + ' ' + file_data + '_T' + str(index_fmri_i[it]).zfill(4)
-
-        im_fmri_list = []
-        for it in range(nt_i):
-            im_fmri_list.append(im_data_split_list[index_fmri_i[it]])
-        im_fmri_concat = concat_data(im_fmri_list, 3, squeeze_data=True).save(file_data_merge_i + ext_data)
-
-        file_data_mean = file_data + '_mean_' + str(iGroup)
-        if param.group_size == 1:
-            # copy to new file name instead of averaging (faster)
-            # note: this is a bandage. Ideally we should skip this entire for loop if g=1
-            sct.copy(file_data_merge_i + '.nii', file_data_mean + '.nii')
-        else:
-            # Average Images
-            sct.run(['sct_maths', '-i', file_data_merge_i + '.nii', '-o', file_data_mean + '.nii', '-mean', 't'], verbose=0)
-        # if not average_data_across_dimension(file_data_merge_i+'.nii', file_data_mean+'.nii', 3):
-        #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-        # cmd = fsloutput + 'fslmaths ' + file_data_merge_i + ' -Tmean ' + file_data_mean
-        # sct.run(cmd, param.verbose)
-
-    # Merge groups means. The output 4D volume will be used for motion correction.
-    sct.printv('\nMerging volumes...', param.verbose)
+    # Average images within groups, and merge the groups means. The output 4D volume will be used for motion
+    # correction. If group_size=1, the volumes are simply copied.
+    sct.printv('\nAverage volumes within groups...', param.verbose)
     file_data_groups_means_merge = 'fmri_averaged_groups'
-    im_mean_list = []
-    for iGroup in range(nb_groups):
-        im_mean_list.append(Image(file_data + '_mean_' + str(iGroup) + ext_data))
-    im_mean_concat = concat_data(im_mean_list, 3).save(file_data_groups_means_merge + ext_data)
+    im_mean_concat = moco.average_groups(im_data, group_indexes).save(file_data_groups_means_merge + ext_data)
+
+    # Save the groups means used as target for registration
+    for iGroup in sorted(set([0, int(param.num_target)])):
+        moco.image_like(im_mean_concat, im_mean_concat.data[..., iGroup]).save(file_data + '_mean_' + str(iGroup) + ext_data)
 
     # Estimate moco
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
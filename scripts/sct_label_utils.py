@@ -128,9 +128,10 @@ class ProcessLabels(object):
         if type_process == 'create-viewer':
             self.output_image = self.launch_sagittal_viewer(self.value)
 
+        if change_orientation and getattr(self, 'output_image', None) is not None:
+            self.output_image.change_orientation(input_orientation)
+
         if self.fname_output is not None:
-            if change_orientation:
-                self.output_image.change_orientation(input_orientation)
             self.output_image.absolutepath = self.fname_output
             if type_process == 'vert-continuous':
                 self.output_image.save(dtype='float32')
@@ -611,6 +612,21 @@ class ProcessLabels(object):
         return output
 
 
+def process_labels(im_label, type_process, im_ref=None, **kwargs):
+    """
+    Image-level entry point, used by the other sct_* tools instead of calling main() through files.
+
+    :param im_label: Image: input labels (not modified)
+    :param type_process: process of ProcessLabels.process(), e.g. 'add', 'create', 'remove', 'vert-body'
+    :param im_ref: Image: reference image of the process, if any (e.g. labels to keep for 'remove')
+    :param kwargs: other parameters of ProcessLabels (e.g. value, coordinates, vertebral_levels)
+    :return: Image: output labels, in the orientation of im_label. main() saves it with dtype='minimize_int'.
+    """
+    processor = ProcessLabels(im_label, fname_ref=im_ref, **kwargs)
+    processor.process(type_process)
+    return processor.output_image
+
+
 def get_parser():
     # initialize default param
     param_default = Param()
@@ -18,16 +18,21 @@ from __future__ import division, absolute_import
 import sys, os
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import sct_maths
+import sct_apply_transfo
+import sct_straighten_spinalcord
 import scipy.ndimage.measurements
 from scipy.ndimage.filters import gaussian_filter
 
-from sct_maths import mutual_information
+from sct_maths import mutual_information_batch
 from msct_parser import Parser
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CACHE_HELP
 import sct_utils as sct
 from spinalcordtoolbox.metadata import get_file_label
+from spinalcordtoolbox.resample.nipy_resample import resample_file
 from spinalcordtoolbox.vertebrae.detect_c2c3 import detect_c2c3
 
 # get path of SCT
@@ -78,7 +83,8 @@ def get_parser():
     parser.usage.set_description('''This function takes an anatomical image and its cord segmentation (binary file), and outputs the cord segmentation labeled with vertebral level. The algorithm requires an initialization (first disc) and then performs a disc search in the superior, then inferior direction, using template disc matching based on mutual information score. The automatic method uses the module implemented in "spinalcordtoolbox/vertebrae/detect_c2c3.py" to detect the C2-C3 disc.
     Tips: To run the function with init txt file that includes flags -initz/-initcenter:
     sct_label_vertebrae -i t2.nii.gz -s t2_seg_manual.nii.gz  "$(< init_label_vertebrae.txt)"
-    ''')
+
+    ''' + CACHE_HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="input image.",
@@ -244,7 +250,7 @@ def main(args=None):
         # subtract "1" to label value because due to legacy, in this code the disc C2-C3 has value "2", whereas in the
         # recent version of SCT it is defined as "3". Therefore, when asking the user to define a label, we point to the
         # new definition of labels (i.e., C2-C3 = 3).
-        sct_label_utils.main(['-i', fname_initlabel, '-add', '-1', '-o', fname_labelz])
+        sct_label_utils.process_labels(Image(fname_initlabel), 'add', value=-1).save(fname_labelz, dtype='minimize_int')
     else:
         # automatically finds C2-C3 disc
         im_data = Image('data.nii')
@@ -260,65 +266,67 @@ def main(args=None):
         im_label_c2c3.save(fname_labelz)
 
     # dilate label so it is not lost when applying warping
-    sct_maths.main(['-i', fname_labelz, '-dilate', '3', '-o', fname_labelz])
+    sct_maths.dilate_image(Image(fname_labelz), [3]).save(fname_labelz)
 
     # Straighten spinal cord
     sct.printv('\nStraighten spinal cord...', verbose)
-    # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-    cache_sig = sct.cache_signature(
-     input_files=[fname_in, fname_seg],
-    )
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, "warp_curve2straight.nii.gz")) and os.path.isfile(os.path.join(curdir, "warp_straight2curve.nii.gz")) and os.path.isfile(os.path.join(curdir, "straight_ref.nii.gz")):
-        # if they exist, copy them into current folder
+    # reuse the warping fields if this segmentation was already straightened with the same parameters
+    straightening_cache = sct_straighten_spinalcord.get_straightening_cache()
+    cache_key = sct_straighten_spinalcord.straightening_cache_key('segmentation.nii.gz', 'data.nii')
+    if straightening_cache.get(cache_key, sct_straighten_spinalcord.STRAIGHTENING_CACHE_FILES):
         sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, "warp_curve2straight.nii.gz"), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, "warp_straight2curve.nii.gz"), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, "straight_ref.nii.gz"), 'straight_ref.nii.gz')
         # apply straightening
-        s, o = sct.run(['sct_apply_transfo', '-i', 'data.nii', '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'data_straight.nii'])
+        sct_apply_transfo.apply_transfo(Image('data.nii'), Image('straight_ref.nii.gz'),
+                                        ['warp_curve2straight.nii.gz']).save('data_straight.nii')
     else:
-        cmd = ['sct_straighten_spinalcord', '-i', 'data.nii', '-s', 'segmentation.nii.gz', '-r', str(remove_temp_files)]
+        args_straighten = ['-i', 'data.nii', '-s', 'segmentation.nii.gz', '-r', str(remove_temp_files)]
         if param.path_qc is not None and os.environ.get("SCT_RECURSIVE_QC", None) == "1":
-            cmd += ['-qc', param.path_qc]
-        s, o = sct.run(cmd)
-        sct.cache_save(cachefile, cache_sig)
+            args_straighten += ['-qc', param.path_qc]
+        sct_straighten_spinalcord.main(args=args_straighten)
+        straightening_cache.put(cache_key, sct_straighten_spinalcord.STRAIGHTENING_CACHE_FILES)
 
     # resample to 0.5mm isotropic to match template resolution
     sct.printv('\nResample to 0.5mm isotropic...', verbose)
-    s, o = sct.run(['sct_resample', '-i', 'data_straight.nii', '-mm', '0.5x0.5x0.5', '-x', 'linear', '-o', 'data_straightr.nii'], verbose=verbose)
+    resample_file('data_straight.nii', 'data_straightr.nii', '0.5x0.5x0.5', 'mm', 'linear', verbose=0)
 
     # Apply straightening to segmentation
     # N.B. Output is RPI
     sct.printv('\nApply straightening to segmentation...', verbose)
-    s, o = sct.run(['sct_apply_transfo', '-i', 'segmentation.nii.gz', '-d', 'data_straightr.nii', '-w', 'warp_curve2straight.nii.gz', '-o', 'segmentation_straight.nii.gz', '-x', 'linear'], verbose)
+    im_straightr = Image('data_straightr.nii')
+    im_seg = Image('segmentation.nii.gz')
+    im_seg_straight = sct_apply_transfo.apply_transfo(im_seg, im_straightr, ['warp_curve2straight.nii.gz'], interp='linear')
     # Threshold segmentation at 0.5
-    sct.run(['sct_maths', '-i', 'segmentation_straight.nii.gz', '-thr', '0.5', '-o', 'segmentation_straight.nii.gz'], verbose)
+    sct_maths.threshold_image(im_seg_straight, 0.5).save('segmentation_straight.nii.gz')
 
     # Apply straightening to z-label
     sct.printv('\nAnd apply straightening to label...', verbose)
-    sct.run(['sct_apply_transfo', '-i', file_labelz, '-d', 'data_straightr.nii', '-w', 'warp_curve2straight.nii.gz', '-o', 'labelz_straight.nii.gz', '-x', 'nn'], verbose)
+    im_labelz_straight = sct_apply_transfo.apply_transfo(Image(file_labelz), im_straightr, ['warp_curve2straight.nii.gz'],
+                                                         interp='nn')
     # get z value and disk value to initialize labeling
     sct.printv('\nGet z and disc values from straight label...', verbose)
-    init_disc = get_z_and_disc_values_from_label('labelz_straight.nii.gz')
+    init_disc = get_z_and_disc_values_from_label(im_labelz_straight)
     sct.printv('.. ' + str(init_disc), verbose)
 
     # denoise data
     if denoise:
         sct.printv('\nDenoise data...', verbose)
-        sct.run(['sct_maths', '-i', 'data_straightr.nii', '-denoise', 'h=0.05', '-o', 'data_straightr.nii'], verbose)
+        im_straightr = sct_maths.denoise_image(im_straightr)
 
     # apply laplacian filtering
     if laplacian:
         sct.printv('\nApply Laplacian filter...', verbose)
-        sct.run(['sct_maths', '-i', 'data_straightr.nii', '-laplacian', '1', '-o', 'data_straightr.nii'], verbose)
+        im_straightr = sct_maths.laplacian_image(im_straightr, [1])
+
+    if denoise or laplacian:
+        im_straightr.save('data_straightr.nii')
 
     # detect vertebral levels on straight spinal cord
     vertebral_detection('data_straightr.nii', 'segmentation_straight.nii.gz', contrast, param, init_disc=init_disc, verbose=verbose, path_template=path_template, path_output=path_output)
 
     # un-straighten labeled spinal cord
     sct.printv('\nUn-straighten labeling...', verbose)
-    sct.run(['sct_apply_transfo', '-i', 'segmentation_straight_labeled.nii.gz', '-d', 'segmentation.nii.gz', '-w', 'warp_straight2curve.nii.gz', '-o', 'segmentation_labeled.nii.gz', '-x', 'nn'], verbose)
+    sct_apply_transfo.apply_transfo(Image('segmentation_straight_labeled.nii.gz'), im_seg, ['warp_straight2curve.nii.gz'],
+                                    interp='nn').save('segmentation_labeled.nii.gz')
 
     # Clean labeled segmentation
     sct.printv('\nClean labeled segmentation (correct interpolation errors)...', verbose)
@@ -633,7 +641,7 @@ def create_label_z(fname_seg, z, value, fname_labelz='labelz.nii.gz'):
 def get_z_and_disc_values_from_label(fname_label):
     """
     Find z-value and label-value based on labeled image in RPI orientation
-    :param fname_label: image in RPI orientation that contains label
+    :param fname_label: image (file name or Image) in RPI orientation that contains label
     :return: [z_label, value_label] int list
     """
     nii = Image(fname_label)
@@ -655,17 +663,16 @@ def clean_labeled_segmentation(fname_labeled_seg, fname_seg, fname_labeled_seg_n
     :param fname_labeled_seg_new: output
     :return: none
     """
+    im_labeled_seg = Image(fname_labeled_seg)
+    im_seg = Image(fname_seg)
     # remove voxels in segmentation_labeled that are not in segmentation
-    sct.run(['sct_maths', '-i', fname_labeled_seg, '-mul', fname_seg, '-o', 'segmentation_labeled_mul.nii.gz'])
+    im_label = sct_maths.multiply_images(im_labeled_seg, im_seg)
     # add voxels in segmentation that are not in segmentation_labeled
-    sct.run(['sct_maths', '-i', fname_labeled_seg, '-dilate', '2', '-o', 'segmentation_labeled_dilate.nii.gz'])  # dilate labeled segmentation
-    data_label_dilate = Image('segmentation_labeled_dilate.nii.gz').data
-    sct.run(['sct_maths', '-i', 'segmentation_labeled_mul.nii.gz', '-bin', '0', '-o', 'segmentation_labeled_mul_bin.nii.gz'])
-    data_label_bin = Image('segmentation_labeled_mul_bin.nii.gz').data
-    data_seg = Image(fname_seg).data
+    data_label_dilate = sct_maths.dilate_image(im_labeled_seg, [2]).data  # dilate labeled segmentation
+    data_label_bin = sct_maths.binarise_image(im_label, 0).data
+    data_seg = im_seg.data
     data_diff = data_seg - data_label_bin
     ind_nonzero = np.where(data_diff)
-    im_label = Image('segmentation_labeled_mul.nii.gz')
     for i_vox in range(len(ind_nonzero[0])):
         # assign closest label value for this voxel
         ix, iy, iz = ind_nonzero[0][i_vox], ind_nonzero[1][i_vox], ind_nonzero[2][i_vox]
@@ -675,6 +682,50 @@ def clean_labeled_segmentation(fname_labeled_seg, fname_seg, fname_labeled_seg_n
     im_label.save()
 
 
+def get_shifted_chunks(src, x, xsize, y, yshift, ysize, z, zsize, zrange):
+    """
+    Get the chunks of src compared to the template pattern by compute_corr_3d(), for each z shift.
+    Chunks extending towards the top part of the image are padded with zeros. They are taken from a strided view of the
+    (padded) image, so that no data is copied.
+    :param src: 3d source data
+    :param zrange: list of z shifts
+    :return: list of 3d arrays, one per z shift
+    """
+    nz = src.shape[2]
+    zlength = 2 * zsize + 1
+    data_xy = src[x - xsize: x + xsize + 1, y + yshift - ysize: y + yshift + ysize + 1, :]
+    padding_size = max(0, z + max(zrange) + zsize + 1 - nz)
+    if padding_size:
+        data_xy = np.pad(data_xy, ((0, 0), (0, 0), (0, padding_size)), 'constant', constant_values=0)
+    # view of all the chunks of length zlength along z: chunks[:, :, i, :] = data_xy[:, :, i:i + zlength]
+    nb_chunks = max(0, data_xy.shape[2] - zlength + 1)
+    chunks = as_strided(data_xy, shape=data_xy.shape[:2] + (nb_chunks, zlength),
+                        strides=data_xy.strides + (data_xy.strides[2],), writeable=False)
+
+    list_chunks = []
+    for iz in zrange:
+        z_start = z + iz - zsize
+        if 0 <= z_start < nb_chunks:
+            list_chunks.append(chunks[:, :, z_start, :])
+        # chunks starting below the image (only if the image is smaller than the chunk, or near its bottom part) are
+        # cropped and padded with zeros as follows
+        elif z + iz + zsize + 1 > nz:
+            padding_size = z + iz + zsize + 1 - nz
+            data_chunk3d = src[x - xsize: x + xsize + 1,
+                               y + yshift - ysize: y + yshift + ysize + 1,
+                               z + iz - zsize: z + iz + zsize + 1 - padding_size]
+            list_chunks.append(np.pad(data_chunk3d, ((0, 0), (0, 0), (0, padding_size)), 'constant',
+                                      constant_values=0))
+        else:
+            padding_size = abs(iz - zsize)
+            data_chunk3d = src[x - xsize: x + xsize + 1,
+                               y + yshift - ysize: y + yshift + ysize + 1,
+                               z + iz - zsize + padding_size: z + iz + zsize + 1]
+            list_chunks.append(np.pad(data_chunk3d, ((0, 0), (0, 0), (padding_size, 0)), 'constant',
+                                      constant_values=0))
+    return list_chunks
+
+
 def compute_corr_3d(src, target, x, xshift, xsize, y, yshift, ysize, z, zshift, zsize, xtarget, ytarget, ztarget, zrange, verbose, save_suffix, gaussian_std, path_output):
     """
     Find z that maximizes correlation between src and target 3d data.
@@ -710,42 +761,16 @@ def compute_corr_3d(src, target, x, xshift, xsize, y, yshift, ysize, z, zshift,
     # initializations
     I_corr = np.zeros(len(zrange))
     allzeros = 0
-    # current_z = 0
-    ind_I = 0
-    # loop across range of z defined by src
-    for iz in zrange:
-        # if pattern extends towards the top part of the image, then crop and pad with zeros
-        if z + iz + zsize + 1 > nz:
-            # sct.printv('iz='+str(iz)+': padding on top')
-            padding_size = z + iz + zsize + 1 - nz
-            data_chunk3d = src[x - xsize: x + xsize + 1,
-                               y + yshift - ysize: y + yshift + ysize + 1,
-                               z + iz - zsize: z + iz + zsize + 1 - padding_size]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (0, padding_size)), 'constant',
-                                  constant_values=0)
-        # if pattern extends towards bottom part of the image, then crop and pad with zeros
-        elif z + iz - zsize < 0:
-            # sct.printv('iz='+str(iz)+': padding at bottom')
-            padding_size = abs(iz - zsize)
-            data_chunk3d = src[x - xsize: x + xsize + 1,
-                               y + yshift - ysize: y + yshift + ysize + 1,
-                               z + iz - zsize + padding_size: z + iz + zsize + 1]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (padding_size, 0)), 'constant',
-                                  constant_values=0)
-        else:
-            data_chunk3d = src[x - xsize: x + xsize + 1,
-                               y + yshift - ysize: y + yshift + ysize + 1,
-                               z + iz - zsize: z + iz + zsize + 1]
-
-        # convert subject pattern to 1d
-        data_chunk1d = data_chunk3d.ravel()
-        # check if data_chunk1d contains at least one non-zero value
-        if (data_chunk1d.size == pattern1d.size) and np.any(data_chunk1d):
-            I_corr[ind_I] = mutual_information(data_chunk1d, pattern1d, nbins=16, normalized=False)
-        else:
-            allzeros = 1
-        ind_I = ind_I + 1
-    # ind_y = ind_y + 1
+    # get the subject patterns for the whole range of z defined by src, and convert them to 1d
+    data_chunks1d = [data_chunk3d.ravel() for data_chunk3d in get_shifted_chunks(src, x, xsize, y, yshift, ysize, z, zsize, zrange)]
+    # only keep the patterns which contain at least one non-zero value
+    ind_valid = [ind_I for ind_I, data_chunk1d in enumerate(data_chunks1d)
+                 if (data_chunk1d.size == pattern1d.size) and np.any(data_chunk1d)]
+    if len(ind_valid) < len(zrange):
+        allzeros = 1
+    if ind_valid:
+        # compute the mutual information for all the z at once
+        I_corr[ind_valid] = mutual_information_batch(np.stack([data_chunks1d[i] for i in ind_valid]), pattern1d, nbins=16)
     if allzeros:
         sct.printv('.. WARNING: Data contained zero. We probably hit the edge of the image.', verbose)
 
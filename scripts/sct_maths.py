@@ -543,6 +543,59 @@ def laplacian(data, sigmas):
     # return laplace(data.astype(float))
 
 
+# Image-level entry points, used by the other sct_* tools instead of calling main() through files
+# ==========================================================================================
+def image_like(im_in, data):
+    """
+    :param im_in: Image
+    :param data: array
+    :return: Image with the data and the header of im_in, as written by main()
+    """
+    return Image(data, hdr=im_in.hdr.copy())
+
+
+def threshold_image(im_in, thr_value):
+    """Same as -thr"""
+    return image_like(im_in, threshold(np.array(im_in.data), thr_value))
+
+
+def binarise_image(im_in, bin_thr=0):
+    """Same as -bin"""
+    return image_like(im_in, binarise(im_in.data, bin_thr=bin_thr))
+
+
+def dilate_image(im_in, radius):
+    """Same as -dilate. radius: list of int, see dilate()"""
+    return image_like(im_in, dilate(im_in.data, radius))
+
+
+def multiply_images(im_in, im_in2):
+    """Same as -mul, with an image"""
+    return image_like(im_in, np.prod(concatenate_along_4th_dimension(im_in.data, im_in2.data), axis=3))
+
+
+def smooth_image(im_in, sigmas):
+    """Same as -smooth. sigmas: list of Gaussian kernel SD in mm, one for all the dimensions or one per dimension"""
+    return image_like(im_in, smooth(im_in.data, _sigmas_in_voxels(im_in, sigmas)))
+
+
+def laplacian_image(im_in, sigmas):
+    """Same as -laplacian. sigmas: see smooth_image()"""
+    return image_like(im_in, laplacian(im_in.data, _sigmas_in_voxels(im_in, sigmas)))
+
+
+def denoise_image(im_in, patch_radius=1, block_radius=5):
+    """Same as -denoise"""
+    return image_like(im_in, denoise_nlmeans(im_in.data, patch_radius=patch_radius, block_radius=block_radius))
+
+
+def _sigmas_in_voxels(im_in, sigmas):
+    if len(sigmas) == 1:
+        sigmas = [sigmas[0] for i in range(len(im_in.data.shape))]
+    # adjust sigma based on voxel size
+    return [sigmas[i] / im_in.dim[i + 4] for i in range(3)]
+
+
 def compute_similarity(data1, data2, fname_out='', metric='', verbose=1):
     '''
     Compute a similarity metric between two images data
@@ -619,6 +672,53 @@ def mutual_information(x, y, nbins=32, normalized=False):
     return mi
 
 
+def mutual_information_batch(x, y, nbins=32):
+    """
+    Compute the mutual information between each row of x and y, in a single pass. This gives the same result as
+    mutual_information(x[i], y, nbins) for each row i, without computing each joint histogram separately.
+    :param x: 2D numpy.array: one flatten image per row
+    :param y: 1D numpy.array : flatten data from an image
+    :param nbins: number of bins of the joint histograms
+    :return: 1D numpy.array: mutual information of each row
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    nb_rows = x.shape[0]
+    ind_x = _histogram_bin_indexes(x, nbins)
+    ind_y = _histogram_bin_indexes(y[np.newaxis, :], nbins)[0]
+    # joint histograms of all the rows
+    ind_xy = (np.arange(nb_rows)[:, np.newaxis] * nbins + ind_x) * nbins + ind_y
+    c_xy = np.bincount(ind_xy.ravel(), minlength=nb_rows * nbins * nbins).reshape(nb_rows, nbins, nbins)
+    c_xy = c_xy.astype(np.float64)
+    # mutual information from the contingency matrices, as sklearn.metrics.mutual_info_score()
+    total = c_xy.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    pi = c_xy.sum(axis=2)[:, :, np.newaxis]
+    pj = c_xy.sum(axis=1)[:, np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi = c_xy / total * (np.log(c_xy) - np.log(total) - np.log(pi * pj) + 2 * np.log(total))
+    mi[c_xy == 0] = 0
+    mi[np.abs(mi) < np.finfo(np.float64).eps] = 0
+    return np.clip(mi.sum(axis=(1, 2)), 0, None)
+
+
+def _histogram_bin_indexes(x, nbins):
+    """
+    Index of the bin of each value of each row of x, with the bins that numpy.histogram2d() uses for this row (nbins
+    equal bins between the min and max of the row).
+    :return: numpy.array of int, of the shape of x
+    """
+    first, last = x.min(axis=1), x.max(axis=1)
+    same = first == last
+    first, last = np.where(same, first - 0.5, first), np.where(same, last + 0.5, last)
+    # same computation as numpy.linspace(first, last, nbins + 1)
+    edges = np.arange(nbins + 1)[np.newaxis, :] * ((last - first) / nbins)[:, np.newaxis] + first[:, np.newaxis]
+    edges[:, -1] = last
+    ind = (x[:, :, np.newaxis] >= edges[:, np.newaxis, :]).sum(axis=2) - 1
+    # values on the rightmost edge are in the last bin
+    ind[x == last[:, np.newaxis]] = nbins - 1
+    return ind
+
+
 def correlation(x, y, type='pearson'):
     """
     Compute pearson or spearman correlation coeff
@@ -27,6 +27,7 @@ from spinalcordtoolbox import process_seg
 from spinalcordtoolbox.aggregate_slicewise import aggregate_per_slice_or_level, save_as_csv, func_wa, func_std, \
     merge_dict
 from spinalcordtoolbox.utils import parse_num_list
+from spinalcordtoolbox.template import get_vert_level_index
 
 
 class Param:
@@ -217,6 +218,8 @@ def main(args):
     # update fields
     param.verbose = verbose
     metrics_agg = {}
+    # index the vertebral labeling once for all metrics
+    vert_level = get_vert_level_index(fname_vert_levels) if vert_levels else None
     if not file_out:
         file_out = name_process + '.csv'
 
@@ -234,7 +237,7 @@ def main(args):
         for key in metrics:
             metrics_agg[key] = aggregate_per_slice_or_level(metrics[key], slices=parse_num_list(slices),
                                                             levels=parse_num_list(vert_levels), perslice=perslice,
-                                                            perlevel=perlevel, vert_level=fname_vert_levels,
+                                                            perlevel=perlevel, vert_level=vert_level,
                                                             group_funcs=group_funcs)
         metrics_agg_merged = merge_dict(metrics_agg)
         save_as_csv(metrics_agg_merged, file_out, fname_in=fname_segmentation, append=append)
@@ -255,7 +258,7 @@ def main(args):
         for key in metrics:
             metrics_agg[key] = aggregate_per_slice_or_level(metrics[key], slices=parse_num_list(slices),
                                                             levels=parse_num_list(vert_levels), perslice=perslice,
-                                                            perlevel=perlevel, vert_level=fname_vert_levels,
+                                                            perlevel=perlevel, vert_level=vert_level,
                                                             group_funcs=group_funcs)
         metrics_agg_merged = merge_dict(metrics_agg)
         save_as_csv(metrics_agg_merged, file_out, fname_in=fname_segmentation, append=append)
@@ -183,6 +183,13 @@ def get_parser(paramreg=None):
                       type_value="image_nifti",
                       description="File name of ground-truth registered data (nifti).",
                       mandatory=False)
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of slices registered in parallel with slicewise=1 and ANTs algorithms. "
+                                  "0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=Param().jobs,
+                      example='8')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -208,6 +215,7 @@ class Param:
         self.outSuffix = "_reg"
         self.padding = 5
         self.path_qc = os.path.join(os.path.abspath(os.curdir), "qc")
+        self.jobs = 1  # number of slices registered concurrently (slicewise=1 with ANTs algorithms)
 
 
 # Parameters for registration
@@ -354,6 +362,7 @@ def main(args=None):
     interp = arguments['-x']
     remove_temp_files = int(arguments['-r'])
     verbose = int(arguments['-v'])
+    param.jobs = int(arguments['-jobs'])
 
     # sct.printv(arguments)
     sct.printv('\nInput parameters:')
@@ -706,7 +715,8 @@ def register(src, dest, paramreg, param, i_step_str):
                                ants_registration_params=ants_registration_params,
                                path_qc=param.path_qc,
                                remove_temp_files=param.remove_temp_files,
-                               verbose=param.verbose)
+                               verbose=param.verbose,
+                               jobs=getattr(param, 'jobs', 1))
 
     # slice-wise transfo
     elif paramreg.steps[i_step_str].algo in ['centermass', 'centermassrot', 'columnwise']:
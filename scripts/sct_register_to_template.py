@@ -23,12 +23,17 @@ import numpy as np
 import sct_utils as sct
 import sct_label_utils
 import sct_convert
+import sct_maths
+import sct_apply_transfo
+import sct_concat_transfo
 from spinalcordtoolbox.metadata import get_file_label
 from sct_utils import add_suffix
 from sct_register_multimodal import Paramreg, ParamregMultiStep, register
 from msct_parser import Parser
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CACHE_HELP
+from spinalcordtoolbox.resample.nipy_resample import resample_file
 from sct_straighten_spinalcord import smooth_centerline
 
 # get path of the toolbox
@@ -50,6 +55,7 @@ class Param:
         self.path_qc = None
         self.zsubsample = '0.25'
         self.param_straighten = ''
+        self.jobs = 1  # number of slices registered concurrently (slicewise=1 with ANTs algorithms)
 
 
 # get default parameters
@@ -82,7 +88,8 @@ def get_parser():
                                  'If only one label is provided, a simple translation will be applied between the subject label and the template label. No scaling will be performed. \n\n'
                                  'If two labels are provided, a linear transformation (translation + rotation + superior-inferior linear scaling) will be applied. The strategy here is to defined labels that cover the region of interest. For example, if you are interested in studying C2 to C6 levels, then provide one label at C2 and another at C6. However, note that if the two labels are very far apart (e.g. C2 and T12), there might be a mis-alignment of discs because a subject''s intervertebral discs distance might differ from that of the template.\n\n'
                                  'If more than two labels (only with the parameter "-disc") are used, a non-linear registration will be applied to align the each intervertebral disc between the subject and the template, as described in sct_straighten_spinalcord. This the most accurate and preferred method. This feature does not work with the parameter "-ref subject".\n\n'
-                                 'More information about label creation can be found at https://www.slideshare.net/neuropoly/sct-course-20190121/42'
+                                 'More information about label creation can be found at https://www.slideshare.net/neuropoly/sct-course-20190121/42\n\n'
+                                 + CACHE_HELP
       )
     parser.add_option(name="-i",
                       type_value="file",
@@ -155,6 +162,13 @@ def get_parser():
                       type_value="image_nifti",
                       description="File name of ground-truth template cord segmentation (binary nifti).",
                       mandatory=False)
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of slices registered in parallel with slicewise=1 and ANTs algorithms. "
+                                  "0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=param.jobs,
+                      example='8')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -207,6 +221,7 @@ def main(args=None):
     remove_temp_files = int(arguments['-r'])
     verbose = int(arguments['-v'])
     param.verbose = verbose  # TODO: not clean, unify verbose or param.verbose in code, but not both
+    param.jobs = int(arguments['-jobs'])
     # if '-straighten-fitting' in arguments:
     param.straighten_fitting = arguments['-straighten-fitting']
     # if '-cpu-nb' in arguments:
@@ -297,7 +312,8 @@ def main(args=None):
     if label_type == 'body':
         sct.printv('\nGenerate labels from template vertebral labeling', verbose)
         ftmp_template_label_, ftmp_template_label = ftmp_template_label, sct.add_suffix(ftmp_template_label, "_body")
-        sct_label_utils.main(args=['-i', ftmp_template_label_, '-vert-body', '0', '-o', ftmp_template_label])
+        sct_label_utils.process_labels(Image(ftmp_template_label_), 'vert-body', vertebral_levels=[0]) \
+         .save(ftmp_template_label, dtype='minimize_int')
 
     # check if provided labels are available in the template
     sct.printv('\nCheck if provided labels are available in the template', verbose)
@@ -322,7 +338,7 @@ def main(args=None):
     # binarize segmentation (in case it has values below 0 caused by manual editing)
     sct.printv('\nBinarize segmentation', verbose)
     ftmp_seg_, ftmp_seg = ftmp_seg, sct.add_suffix(ftmp_seg, "_bin")
-    sct.run(['sct_maths', '-i', ftmp_seg_, '-bin', '0.5', '-o', ftmp_seg])
+    sct_maths.binarise_image(Image(ftmp_seg_), 0.5).save(ftmp_seg)
 
 
     # Switch between modes: subject->template or template->subject
@@ -330,9 +346,9 @@ def main(args=None):
 
         # resample data to 1mm isotropic
         sct.printv('\nResample data to 1mm isotropic...', verbose)
-        sct.run(['sct_resample', '-i', ftmp_data, '-mm', '1.0x1.0x1.0', '-x', 'linear', '-o', add_suffix(ftmp_data, '_1mm')])
+        resample_file(ftmp_data, add_suffix(ftmp_data, '_1mm'), '1.0x1.0x1.0', 'mm', 'linear', verbose=0)
         ftmp_data = add_suffix(ftmp_data, '_1mm')
-        sct.run(['sct_resample', '-i', ftmp_seg, '-mm', '1.0x1.0x1.0', '-x', 'linear', '-o', add_suffix(ftmp_seg, '_1mm')])
+        resample_file(ftmp_seg, add_suffix(ftmp_seg, '_1mm'), '1.0x1.0x1.0', 'mm', 'linear', verbose=0)
         ftmp_seg = add_suffix(ftmp_seg, '_1mm')
         # N.B. resampling of labels is more complicated, because they are single-point labels, therefore resampling
         # with nearest neighbour can make them disappear.
@@ -381,31 +397,22 @@ def main(args=None):
         # straighten segmentation
         sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
 
-        # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-        fn_warp_curve2straight = os.path.join(curdir, "warp_curve2straight.nii.gz")
-        fn_warp_straight2curve = os.path.join(curdir, "warp_straight2curve.nii.gz")
-        fn_straight_ref = os.path.join(curdir, "straight_ref.nii.gz")
-
-        cache_input_files=[ftmp_seg]
+        # reuse the warping fields if this segmentation was already straightened with the same parameters
+        from sct_straighten_spinalcord import SpinalCordStraightener, STRAIGHTENING_CACHE_FILES, \
+            get_straightening_cache, straightening_cache_key
+        straightening_cache = get_straightening_cache()
         if vertebral_alignment:
-            cache_input_files += [
-             ftmp_template_seg,
-             ftmp_label,
-             ftmp_template_label,
-            ]
-        cache_sig = sct.cache_signature(
-         input_files=cache_input_files,
-        )
-        cachefile = os.path.join(curdir, "straightening.cache")
-        if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(fn_warp_curve2straight) and os.path.isfile(fn_warp_straight2curve) and os.path.isfile(fn_straight_ref):
+            cache_key = straightening_cache_key(ftmp_seg, ftmp_seg, fname_centerline_ref=ftmp_template_seg,
+                                                fname_discs_input=ftmp_label, fname_discs_ref=ftmp_template_label,
+                                                algo_fitting=param.straighten_fitting)
+        else:
+            cache_key = straightening_cache_key(ftmp_seg, ftmp_seg, algo_fitting=param.straighten_fitting)
+        if straightening_cache.get(cache_key, STRAIGHTENING_CACHE_FILES):
             sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-            sct.copy(fn_warp_curve2straight, 'warp_curve2straight.nii.gz')
-            sct.copy(fn_warp_straight2curve, 'warp_straight2curve.nii.gz')
-            sct.copy(fn_straight_ref, 'straight_ref.nii.gz')
             # apply straightening
-            sct.run(['sct_apply_transfo', '-i', ftmp_seg, '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', add_suffix(ftmp_seg, '_straight')])
+            sct_apply_transfo.apply_transfo(Image(ftmp_seg), Image('straight_ref.nii.gz'), ['warp_curve2straight.nii.gz']) \
+             .save(add_suffix(ftmp_seg, '_straight'))
         else:
-            from sct_straighten_spinalcord import SpinalCordStraightener
             sc_straight = SpinalCordStraightener(ftmp_seg, ftmp_seg)
             sc_straight.algo_fitting = param.straighten_fitting
             sc_straight.output_filename = add_suffix(ftmp_seg, '_straight')
@@ -421,11 +428,11 @@ def main(args=None):
                 sc_straight.discs_ref_filename = ftmp_template_label
 
             sc_straight.straighten()
-            sct.cache_save(cachefile, cache_sig)
+            straightening_cache.put(cache_key, STRAIGHTENING_CACHE_FILES)
 
         # N.B. DO NOT UPDATE VARIABLE ftmp_seg BECAUSE TEMPORARY USED LATER
         # re-define warping field using non-cropped space (to avoid issue #367)
-        s, o = sct.run(['sct_concat_transfo', '-w', 'warp_straight2curve.nii.gz', '-d', ftmp_data, '-o', 'warp_straight2curve.nii.gz'])
+        sct_concat_transfo.main(args=['-w', 'warp_straight2curve.nii.gz', '-d', ftmp_data, '-o', 'warp_straight2curve.nii.gz'])
 
         if vertebral_alignment:
             sct.copy('warp_curve2straight.nii.gz', 'warp_curve2straightAffine.nii.gz')
@@ -434,16 +441,19 @@ def main(args=None):
             # --------------------------------------------------------------------------------
             # Remove unused label on template. Keep only label present in the input label image
             sct.printv('\nRemove unused label on template. Keep only label present in the input label image...', verbose)
-            sct.run(['sct_label_utils', '-i', ftmp_template_label, '-o', ftmp_template_label, '-remove', ftmp_label])
+            sct_label_utils.process_labels(Image(ftmp_template_label), 'remove', im_ref=Image(ftmp_label)) \
+             .save(ftmp_template_label, dtype='minimize_int')
 
             # Dilating the input label so they can be straighten without losing them
             sct.printv('\nDilating input labels using 3vox ball radius')
-            sct.run(['sct_maths', '-i', ftmp_label, '-o', add_suffix(ftmp_label, '_dilate'), '-dilate', '3'])
+            im_label_dilate = sct_maths.dilate_image(Image(ftmp_label), [3])
             ftmp_label = add_suffix(ftmp_label, '_dilate')
 
             # Apply straightening to labels
             sct.printv('\nApply straightening to labels...', verbose)
-            sct.run(['sct_apply_transfo', '-i', ftmp_label, '-o', add_suffix(ftmp_label, '_straight'), '-d', add_suffix(ftmp_seg, '_straight'), '-w', 'warp_curve2straight.nii.gz', '-x', 'nn'])
+            sct_apply_transfo.apply_transfo(im_label_dilate, Image(add_suffix(ftmp_seg, '_straight')),
+                                            ['warp_curve2straight.nii.gz'], interp='nn') \
+             .save(add_suffix(ftmp_label, '_straight'))
             ftmp_label = add_suffix(ftmp_label, '_straight')
 
             # Compute rigid transformation straight landmarks --> template landmarks
@@ -456,13 +466,17 @@ def main(args=None):
 
             # Concatenate transformations: curve --> straight --> affine
             sct.printv('\nConcatenate transformations: curve --> straight --> affine...', verbose)
-            sct.run(['sct_concat_transfo', '-w', 'warp_curve2straight.nii.gz,straight2templateAffine.txt', '-d', 'template.nii', '-o', 'warp_curve2straightAffine.nii.gz'])
+            sct_concat_transfo.main(args=['-w', 'warp_curve2straight.nii.gz,straight2templateAffine.txt', '-d', 'template.nii', '-o', 'warp_curve2straightAffine.nii.gz'])
 
         # Apply transformation
         sct.printv('\nApply transformation...', verbose)
-        sct.run(['sct_apply_transfo', '-i', ftmp_data, '-o', add_suffix(ftmp_data, '_straightAffine'), '-d', ftmp_template, '-w', 'warp_curve2straightAffine.nii.gz'])
+        im_template = Image(ftmp_template)
+        sct_apply_transfo.apply_transfo(Image(ftmp_data), im_template, ['warp_curve2straightAffine.nii.gz']) \
+         .save(add_suffix(ftmp_data, '_straightAffine'))
         ftmp_data = add_suffix(ftmp_data, '_straightAffine')
-        sct.run(['sct_apply_transfo', '-i', ftmp_seg, '-o', add_suffix(ftmp_seg, '_straightAffine'), '-d', ftmp_template, '-w', 'warp_curve2straightAffine.nii.gz', '-x', 'linear'])
+        sct_apply_transfo.apply_transfo(Image(ftmp_seg), im_template, ['warp_curve2straightAffine.nii.gz'],
+                                        interp='linear') \
+         .save(add_suffix(ftmp_seg, '_straightAffine'))
         ftmp_seg = add_suffix(ftmp_seg, '_straightAffine')
 
         """
@@ -503,13 +517,13 @@ def main(args=None):
         # sub-sample in z-direction
         # TODO: refactor to use python module instead of doing i/o
         sct.printv('\nSub-sample in z-direction (for faster processing)...', verbose)
-        sct.run(['sct_resample', '-i', ftmp_template, '-o', add_suffix(ftmp_template, '_sub'), '-f', '1x1x' + zsubsample], verbose)
+        resample_file(ftmp_template, add_suffix(ftmp_template, '_sub'), '1x1x' + zsubsample, 'factor', 'linear', verbose=0)
         ftmp_template = add_suffix(ftmp_template, '_sub')
-        sct.run(['sct_resample', '-i', ftmp_template_seg, '-o', add_suffix(ftmp_template_seg, '_sub'), '-f', '1x1x' + zsubsample], verbose)
+        resample_file(ftmp_template_seg, add_suffix(ftmp_template_seg, '_sub'), '1x1x' + zsubsample, 'factor', 'linear', verbose=0)
         ftmp_template_seg = add_suffix(ftmp_template_seg, '_sub')
-        sct.run(['sct_resample', '-i', ftmp_data, '-o', add_suffix(ftmp_data, '_sub'), '-f', '1x1x' + zsubsample], verbose)
+        resample_file(ftmp_data, add_suffix(ftmp_data, '_sub'), '1x1x' + zsubsample, 'factor', 'linear', verbose=0)
         ftmp_data = add_suffix(ftmp_data, '_sub')
-        sct.run(['sct_resample', '-i', ftmp_seg, '-o', add_suffix(ftmp_seg, '_sub'), '-f', '1x1x' + zsubsample], verbose)
+        resample_file(ftmp_seg, add_suffix(ftmp_seg, '_sub'), '1x1x' + zsubsample, 'factor', 'linear', verbose=0)
         ftmp_seg = add_suffix(ftmp_seg, '_sub')
 
         # Registration straight spinal cord to template
@@ -535,7 +549,8 @@ def main(args=None):
             if i_step > 1:
                 # sct.run('sct_apply_transfo -i '+src+' -d '+dest+' -w '+','.join(warp_forward)+' -o '+sct.add_suffix(src, '_reg')+' -x '+interp_step, verbose)
                 # apply transformation from previous step, to use as new src for registration
-                sct.run(['sct_apply_transfo', '-i', src, '-d', dest, '-w', ','.join(warp_forward), '-o', add_suffix(src, '_regStep' + str(i_step - 1)), '-x', interp_step], verbose)
+                sct_apply_transfo.apply_transfo(Image(src), Image(dest), warp_forward, interp=interp_step) \
+                 .save(add_suffix(src, '_regStep' + str(i_step - 1)))
                 src = add_suffix(src, '_regStep' + str(i_step - 1))
             # register src --> dest
             # TODO: display param for debugging
@@ -545,15 +560,15 @@ def main(args=None):
 
         # Concatenate transformations:
         sct.printv('\nConcatenate transformations: anat --> template...', verbose)
-        sct.run(['sct_concat_transfo', '-w', 'warp_curve2straightAffine.nii.gz,' + ','.join(warp_forward), '-d', 'template.nii', '-o', 'warp_anat2template.nii.gz'], verbose)
+        sct_concat_transfo.main(args=['-w', 'warp_curve2straightAffine.nii.gz,' + ','.join(warp_forward), '-d', 'template.nii', '-o', 'warp_anat2template.nii.gz'])
         # sct.run('sct_concat_transfo -w warp_curve2straight.nii.gz,straight2templateAffine.txt,'+','.join(warp_forward)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
         sct.printv('\nConcatenate transformations: template --> anat...', verbose)
         warp_inverse.reverse()
 
         if vertebral_alignment:
-            sct.run(['sct_concat_transfo', '-w', ','.join(warp_inverse) + ',warp_straight2curve.nii.gz', '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'], verbose)
+            sct_concat_transfo.main(args=['-w', ','.join(warp_inverse) + ',warp_straight2curve.nii.gz', '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'])
         else:
-            sct.run(['sct_concat_transfo', '-w', ','.join(warp_inverse) + ',-straight2templateAffine.txt,warp_straight2curve.nii.gz', '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'], verbose)
+            sct_concat_transfo.main(args=['-w', ','.join(warp_inverse) + ',-straight2templateAffine.txt,warp_straight2curve.nii.gz', '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'])
 
     # register template->subject
     elif ref == 'subject':
@@ -566,7 +581,8 @@ def main(args=None):
 
         # Remove unused label on template. Keep only label present in the input label image
         sct.printv('\nRemove unused label on template. Keep only label present in the input label image...', verbose)
-        sct.run(['sct_label_utils', '-i', ftmp_template_label, '-o', ftmp_template_label, '-remove', ftmp_label])
+        sct_label_utils.process_labels(Image(ftmp_template_label), 'remove', im_ref=Image(ftmp_label)) \
+         .save(ftmp_template_label, dtype='minimize_int')
 
         # Add one label because at least 3 orthogonal labels are required to estimate an affine transformation. This
         # new label is added at the level of the upper most label (lowest value), at 1cm to the right.
@@ -612,7 +628,8 @@ def main(args=None):
             else:
                 sct.printv('ERROR: Wrong image type.', 1, 'error')
             # apply transformation from previous step, to use as new src for registration
-            sct.run(['sct_apply_transfo', '-i', src, '-d', dest, '-w', ','.join(warp_forward), '-o', add_suffix(src, '_regStep' + str(i_step - 1)), '-x', interp_step], verbose)
+            sct_apply_transfo.apply_transfo(Image(src), Image(dest), warp_forward, interp=interp_step) \
+             .save(add_suffix(src, '_regStep' + str(i_step - 1)))
             src = add_suffix(src, '_regStep' + str(i_step - 1))
             # register src --> dest
             # TODO: display param for debugging
@@ -622,13 +639,13 @@ def main(args=None):
 
         # Concatenate transformations:
         sct.printv('\nConcatenate transformations: template --> subject...', verbose)
-        sct.run(['sct_concat_transfo', '-w', ','.join(warp_forward), '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'], verbose)
+        sct_concat_transfo.main(args=['-w', ','.join(warp_forward), '-d', 'data.nii', '-o', 'warp_template2anat.nii.gz'])
         sct.printv('\nConcatenate transformations: subject --> template...', verbose)
-        sct.run(['sct_concat_transfo', '-w', ','.join(warp_inverse), '-d', 'template.nii', '-o', 'warp_anat2template.nii.gz'], verbose)
+        sct_concat_transfo.main(args=['-w', ','.join(warp_inverse), '-d', 'template.nii', '-o', 'warp_anat2template.nii.gz'])
 
     # Apply warping fields to anat and template
-    sct.run(['sct_apply_transfo', '-i', 'template.nii', '-o', 'template2anat.nii.gz', '-d', 'data.nii', '-w', 'warp_template2anat.nii.gz', '-crop', '1'], verbose)
-    sct.run(['sct_apply_transfo', '-i', 'data.nii', '-o', 'anat2template.nii.gz', '-d', 'template.nii', '-w', 'warp_anat2template.nii.gz', '-crop', '1'], verbose)
+    sct_apply_transfo.main(args=['-i', 'template.nii', '-o', 'template2anat.nii.gz', '-d', 'data.nii', '-w', 'warp_template2anat.nii.gz', '-crop', '1'])
+    sct_apply_transfo.main(args=['-i', 'data.nii', '-o', 'anat2template.nii.gz', '-d', 'template.nii', '-w', 'warp_anat2template.nii.gz', '-crop', '1'])
 
     # come back
     os.chdir(curdir)
@@ -750,18 +767,19 @@ def resample_labels(fname_labels, fname_dest, fname_output):
     sampling_factor = [float(nx) / nxd, float(ny) / nyd, float(nz) / nzd]
     # read labels
     from sct_label_utils import ProcessLabels
+    from msct_types import Coordinate
     processor = ProcessLabels(fname_labels)
     label_list = processor.display_voxel()
     label_new_list = []
     for label in label_list:
-        label_sub_new = [str(int(np.round(int(label.x) / sampling_factor[0]))),
-                         str(int(np.round(int(label.y) / sampling_factor[1]))),
-                         str(int(np.round(int(label.z) / sampling_factor[2]))),
-                         str(int(float(label.value)))]
-        label_new_list.append(','.join(label_sub_new))
-    label_new_list = ':'.join(label_new_list)
+        label_sub_new = [int(np.round(int(label.x) / sampling_factor[0])),
+                         int(np.round(int(label.y) / sampling_factor[1])),
+                         int(np.round(int(label.z) / sampling_factor[2])),
+                         int(float(label.value))]
+        label_new_list.append(Coordinate(label_sub_new))
     # create new labels
-    sct.run(['sct_label_utils', '-i', fname_dest, '-create', label_new_list, '-v', '1', '-o', fname_output])
+    sct_label_utils.process_labels(Image(fname_dest), 'create', coordinates=label_new_list) \
+     .save(fname_output, dtype='minimize_int')
 
 
 def check_labels(fname_landmarks, label_type='body'):
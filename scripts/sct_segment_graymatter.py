@@ -14,11 +14,12 @@
 '''
 INFORMATION:
 The model used in this function is compound of:
-  - a dictionary: a list of slices of WM/GM contrasted images with their manual segmentations [slices.pklz]
-  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [fitted_model.pklz]
-  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.pklz]
-  - the averaged median intensity in the white and gray matter in the model [intensities.pklz]
+  - a dictionary: slices of WM/GM contrasted images with their manual segmentations and vertebral levels [im.npy, im_M.npy, gm_seg_M.npy, wm_seg_M.npy, nb_gm_seg.npy, nb_wm_seg.npy, levels.npy, mean_image.npy]
+  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [pca_*.npy or fitted_model.pklz]
+  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.npy]
+  - the averaged median intensity in the white and gray matter in the model, and the version of the model format [model.json]
   - an information file indicating which parameters were used to construct this model, and te date of computation [info.txt]
+Models saved in the former format (gzip-compressed pickles: slices.pklz, fitted_model.pklz, fitted_data.pklz, intensities.pklz) are still loaded, and converted with: msct_multiatlas_seg -convert <model folder> (done by install_sct).
 
 A constructed model is provided in the toolbox here: $PATH_SCT/data/gm_model.
 It's made from T2* images of 80 subjects and computed with the parameters that gives the best gray matter segmentation results.
@@ -49,14 +50,15 @@ import time
 import copy
 
 import numpy as np
+from scipy.spatial.distance import cdist
 
 import matplotlib
 
 import sct_maths
 import sct_process_segmentation
 import sct_register_multimodal
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, binarize,
-                              normalize_slice, pre_processing, register_data)
+from msct_gmseg_utils import (apply_transfo, binarize,
+                              normalize_slice, pre_processing, register_data, sum_gm)
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from msct_multiatlas_seg import Model, Param, ParamData, ParamModel
@@ -253,10 +255,10 @@ class SegmentGM:
         self.project_target()
 
         printv('\nCompute similarities between target slices and model slices using model reduced space...', self.param.verbose, 'normal')
-        list_dic_indexes_by_slice = self.compute_similarities()
+        dic_slices_selected = self.compute_similarities()
 
         printv('\nLabel fusion of model slices most similar to target slices...', self.param.verbose, 'normal')
-        self.label_fusion(list_dic_indexes_by_slice)
+        self.label_fusion(dic_slices_selected)
 
         printv('\nWarp back segmentation into image space...', self.param.verbose, 'normal')
         self.warp_back_seg(path_warp)
@@ -361,56 +363,50 @@ class SegmentGM:
             target_slice.set(im_m=norm_im_M)
 
     def project_target(self):
-        projected_target_slices = []
-        for target_slice in self.target_im:
-            # get slice data in the good shape
-            slice_data = target_slice.im_M.flatten()
-            slice_data = slice_data.reshape(1, -1)  # data with single sample
-            # project slice data into the model
-            slice_data_projected = self.model.fitted_model.transform(slice_data)
-            projected_target_slices.append(slice_data_projected.reshape(-1, ))
-        # store projected target slices
-        self.projected_target = projected_target_slices
+        # project the data of all the target slices into the model at once (one sample per slice)
+        target_data = np.array([target_slice.im_M.flatten() for target_slice in self.target_im])
+        self.projected_target = self.model.fitted_model.transform(target_data)
 
     def compute_similarities(self):
-        list_dic_indexes_by_slice = []
-        for i, target_coord in enumerate(self.projected_target):
-            list_dic_similarities = []
-            for j, dic_coord in enumerate(self.model.fitted_data):
-                # compute square norm using coordinates in the model space
-                square_norm = np.linalg.norm((target_coord - dic_coord), 2)
-                # compute similarity with or without levels
-                if self.param_seg.fname_level is not None:
-                    # EQUATION WITH LEVELS
-                    similarity = np.exp(-self.param_seg.weight_level * abs(self.target_im[i].level - self.model.slices[j].level)) * np.exp(-self.param_seg.weight_coord * square_norm)
-                else:
-                    # EQUATION WITHOUT LEVELS
-                    similarity = np.exp(-self.param_seg.weight_coord * square_norm)
-                # add similarity to list
-                list_dic_similarities.append(similarity)
-            list_norm_similarities = [float(s) / sum(list_dic_similarities) for s in list_dic_similarities]
-            # select indexes of most similar slices
-            list_dic_indexes = []
-            for j, norm_sim in enumerate(list_norm_similarities):
-                if norm_sim >= self.param_seg.thr_similarity:
-                    list_dic_indexes.append(j)
-            # save list of indexes into list by slice
-            list_dic_indexes_by_slice.append(list_dic_indexes)
-
-        return list_dic_indexes_by_slice
-
-    def label_fusion(self, list_dic_indexes_by_slice):
-        for target_slice in self.target_im:
-            # get list of slices corresponding to the indexes
-            list_dic_slices = [self.model.slices[j] for j in list_dic_indexes_by_slice[target_slice.id]]
-            # average slices GM and WM
-            # WM is not used anymore here, but the average_gm_wm() function is used in other parts of the code that need both the GM and WM averages
-            data_mean_gm, data_mean_wm = average_gm_wm(list_dic_slices)
-            # set negative values to 0
-            data_mean_gm[data_mean_gm < 0] = 0
+        """
+        Compute the similarities between all the target slices and all the model slices, using the model reduced space
+        (and the vertebral levels), and select the most similar model slices.
+        :return: boolean array of shape (number of target slices, number of model slices), True for the model slices
+        selected for each target slice
+        """
+        # square norm using coordinates in the model space
+        square_norm = cdist(self.projected_target, self.model.fitted_data)
+        similarities = np.exp(-self.param_seg.weight_coord * square_norm)
+        if self.param_seg.fname_level is not None:
+            # EQUATION WITH LEVELS
+            levels_target = np.array([target_slice.level for target_slice in self.target_im], dtype=np.float64)
+            levels_dic = np.array([dic_slice.level for dic_slice in self.model.slices], dtype=np.float64)
+            similarities *= np.exp(-self.param_seg.weight_level * np.abs(levels_target[:, np.newaxis] - levels_dic))
+        # normalize the similarities by target slice and select indexes of most similar slices
+        norm_similarities = similarities / similarities.sum(axis=1)[:, np.newaxis]
+
+        return norm_similarities >= self.param_seg.thr_similarity
+
+    def label_fusion(self, dic_slices_selected):
+        """
+        Average the GM segmentations of the model slices selected for each target slice.
+        :param dic_slices_selected: boolean array (number of target slices, number of model slices), see
+        compute_similarities()
+        """
+        data_sum_gm, nb_seg = sum_gm(self.model.slices)
+        weights = dic_slices_selected.astype(np.float64)
+        nb_seg_selected = weights.dot(nb_seg)
+        if not nb_seg_selected.all():
+            printv('ERROR: No model segmentation was selected for the target slice(s) '
+                   + ', '.join(str(i) for i in np.flatnonzero(nb_seg_selected == 0))
+                   + '. Try a lower similarity threshold (-thr-sim).', self.param.verbose, 'error')
+        data_mean_gm = np.tensordot(weights, data_sum_gm, axes=1) / nb_seg_selected[:, np.newaxis, np.newaxis]
+        # set negative values to 0
+        data_mean_gm[data_mean_gm < 0] = 0
 
+        for target_slice in self.target_im:
             # store segmentation into target_im
-            target_slice.set(gm_seg_m=data_mean_gm)
+            target_slice.set(gm_seg_m=data_mean_gm[target_slice.id])
 
     def warp_back_seg(self, path_warp):
         # get 3D images from list of slices
@@ -22,7 +22,10 @@ import numpy as np
 
 import sct_utils as sct
 import sct_maths
+import sct_apply_transfo
+import sct_straighten_spinalcord
 import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox.cache import CACHE_HELP
 from sct_convert import convert
 from msct_parser import Parser
 
@@ -54,7 +57,8 @@ def get_parser():
     parser.usage.set_description('Smooth the spinal cord along its centerline. Steps are:\n'
                                  '1) Spinal cord is straightened (using centerline),\n'
                                  '2) a Gaussian kernel is applied in the superior-inferior direction,\n'
-                                 '3) then cord is de-straightened as originally.\n')
+                                 '3) then cord is de-straightened as originally.\n\n'
+                                 + CACHE_HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="Image to smooth",
@@ -178,40 +182,33 @@ def main(args=None):
     # Straighten the spinal cord
     # straighten segmentation
     sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
-    cache_sig = sct.cache_signature(input_files=[fname_anat_rpi, fname_centerline_rpi],
-                                    input_params={"x": "spline"})
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, 'warp_curve2straight.nii.gz')) and os.path.isfile(os.path.join(curdir, 'warp_straight2curve.nii.gz')) and os.path.isfile(os.path.join(curdir, 'straight_ref.nii.gz')):
-        # if they exist, copy them into current folder
+    # reuse the warping fields if this centerline was already straightened with the same parameters
+    straightening_cache = sct_straighten_spinalcord.get_straightening_cache()
+    cache_key = sct_straighten_spinalcord.straightening_cache_key(fname_centerline_rpi, fname_anat_rpi,
+                                                                  algo_fitting=param.algo_fitting)
+    if straightening_cache.get(cache_key, sct_straighten_spinalcord.STRAIGHTENING_CACHE_FILES):
         sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, 'warp_curve2straight.nii.gz'), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, 'warp_straight2curve.nii.gz'), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, 'straight_ref.nii.gz'), 'straight_ref.nii.gz')
         # apply straightening
-        sct.run(['sct_apply_transfo', '-i', fname_anat_rpi, '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'anat_rpi_straight.nii', '-x', 'spline'], verbose)
+        im_anat_straight = sct_apply_transfo.apply_transfo(msct_image.Image(fname_anat_rpi),
+                                                           msct_image.Image('straight_ref.nii.gz'),
+                                                           ['warp_curve2straight.nii.gz'], interp='spline')
     else:
-        sct.run(['sct_straighten_spinalcord', '-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline', '-param', 'algo_fitting='+param.algo_fitting], verbose)
-        sct.cache_save(cachefile, cache_sig)
-        # move warping fields locally (to use caching next time)
-        sct.copy('warp_curve2straight.nii.gz', os.path.join(curdir, 'warp_curve2straight.nii.gz'))
-        sct.copy('warp_straight2curve.nii.gz', os.path.join(curdir, 'warp_straight2curve.nii.gz'))
+        sct_straighten_spinalcord.main(args=['-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline', '-param', 'algo_fitting='+param.algo_fitting])
+        straightening_cache.put(cache_key, sct_straighten_spinalcord.STRAIGHTENING_CACHE_FILES)
+        im_anat_straight = msct_image.Image('anat_rpi_straight.nii')
 
     # Smooth the straightened image along z
     sct.printv('\nSmooth the straightened image...')
-    sigma_smooth = ",".join([str(i) for i in sigma])
-    sct_maths.main(args=['-i', 'anat_rpi_straight.nii',
-                         '-smooth', sigma_smooth,
-                         '-o', 'anat_rpi_straight_smooth.nii',
-                         '-v', '0'])
+    im_smooth = sct_maths.smooth_image(im_anat_straight, sigma)
     # Apply the reversed warping field to get back the curved spinal cord
     sct.printv('\nApply the reversed warping field to get back the curved spinal cord...')
-    sct.run(['sct_apply_transfo', '-i', 'anat_rpi_straight_smooth.nii', '-o', 'anat_rpi_straight_smooth_curved.nii', '-d', 'anat.nii', '-w', 'warp_straight2curve.nii.gz', '-x', 'spline'], verbose)
+    im_anat = msct_image.Image('anat.nii')
+    nii_smooth = sct_apply_transfo.apply_transfo(im_smooth, im_anat, ['warp_straight2curve.nii.gz'], interp='spline')
 
     # replace zeroed voxels by original image (issue #937)
     sct.printv('\nReplace zeroed voxels by original image...', verbose)
-    nii_smooth = Image('anat_rpi_straight_smooth_curved.nii')
     data_smooth = nii_smooth.data
-    data_input = Image('anat.nii').data
+    data_input = im_anat.data
     indzero = np.where(data_smooth == 0)
     data_smooth[indzero] = data_input[indzero]
     nii_smooth.data = data_smooth
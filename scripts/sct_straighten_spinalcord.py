@@ -14,7 +14,8 @@
 
 from __future__ import division, absolute_import
 
-import sys, io, os, shutil, time, bisect
+import sys, io, os, shutil, time, bisect, multiprocessing
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 from nibabel import Nifti1Image, save
@@ -23,11 +24,14 @@ import tqdm
 
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CacheStore, cache_key
 from msct_parser import Parser
 from msct_types import Centerline
 from sct_apply_transfo import Transform
+from sct_image import pad_image
 import sct_utils as sct
 from msct_smooth import smoothing_window, evaluate_derivative_3D, b_spline_nurbs
+from spinalcordtoolbox.resample.nipy_resample import resample_file
 
 
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0, nurbs_pts_number=1000, all_slices=True, phys_coordinates=False, remove_outliers=False):
@@ -196,6 +200,109 @@ def generate_qc(fn_input, fn_centerline, fn_output, args, path_qc):
     )
 
 
+# files generated by the straightening that are kept in the straightening cache
+STRAIGHTENING_CACHE_FILES = ['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz', 'straight_ref.nii.gz']
+# version of the straightening results, to be increased when the computation of the warping fields changes, so
+# that the results of older versions are not reused
+STRAIGHTENING_CACHE_VERSION = 1
+# parameters of SpinalCordStraightener which influence the straightening results
+STRAIGHTENING_CACHE_PARAMS = ['deg_poly', 'gapxy', 'gapz', 'leftright_width', 'precision', 'threshold_distance',
+                              'type_window', 'window_length', 'speed_factor', 'resample_factor', 'template_orientation',
+                              'xy_size', 'curved2straight', 'straight2curved']
+
+
+def get_straightening_cache():
+    """
+    :return: CacheStore of the straightening results, shared by all tools that straighten the spinal cord
+    """
+    return CacheStore('straightening')
+
+
+def straightening_cache_key(fname_centerline, fname_anat, fname_centerline_ref=None, fname_discs_input=None,
+                            fname_discs_ref=None, algo_fitting='nurbs'):
+    """
+    Key of the straightening results (see STRAIGHTENING_CACHE_FILES) in the straightening cache. The warping fields
+    only depend on the content of the centerline and of the references, on the geometry of the input image, and on
+    the parameters. straight_ref.nii.gz is only meant to be used as a reference space.
+    :param fname_centerline: centerline or segmentation
+    :param fname_anat: input image
+    :param fname_centerline_ref: see SpinalCordStraightener.centerline_reference_filename
+    :param fname_discs_input: see SpinalCordStraightener.discs_input_filename
+    :param fname_discs_ref: see SpinalCordStraightener.discs_ref_filename
+    :param algo_fitting: see SpinalCordStraightener.algo_fitting
+    :return: str
+    """
+    references = [fname_centerline_ref, fname_discs_input, fname_discs_ref]
+    # the other parameters of the straightening are the defaults of SpinalCordStraightener
+    straightener = SpinalCordStraightener(fname_anat, fname_centerline)
+    params = dict((param, getattr(straightener, param)) for param in STRAIGHTENING_CACHE_PARAMS)
+    params.update({'algo_fitting': algo_fitting,
+                   'references': [bool(fname) for fname in references],
+                   'version': STRAIGHTENING_CACHE_VERSION})
+    return cache_key(input_images=[fname_centerline] + [fname for fname in references if fname],
+                     input_geometries=[fname_anat],
+                     input_params=params)
+
+
+# state of the processes computing the warping fields, see init_warping_field_worker()
+warping_field_context = {}
+
+
+def init_warping_field_worker(warping_fields):
+    """
+    Set the warping fields to compute in the current process.
+    :param warping_fields: dict {name: field}, see SpinalCordStraightener.straighten()
+    """
+    warping_field_context.clear()
+    warping_field_context.update(warping_fields)
+
+
+def compute_warping_field_chunk(task):
+    """
+    Compute the displacements of a chunk of slices of a warping field, and write them in the output array of the
+    field. Each voxel is projected on the nearest plane of the source centerline, and mapped to the corresponding plane
+    of the destination centerline (given by the lookup table).
+    :param task: (name, z_start, z_stop): name of the field in warping_field_context and range of slices
+    :return: number of slices computed
+    """
+    name, z_start, z_stop = task
+    field = warping_field_context[name]
+    nx, ny, nz = field['shape'][:3]
+    data_warp = field['data']
+    if not isinstance(data_warp, np.ndarray):
+        # shared memory
+        data_warp = np.frombuffer(data_warp).reshape(field['shape'])
+    centerline, centerline_dest, lookup_table = field['centerline'], field['centerline_dest'], field['lookup']
+
+    x, y, z = np.mgrid[0:nx, 0:ny, z_start:z_stop]
+    indexes = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+    physical_coordinates = np.dot(np.hstack((indexes, np.ones((len(indexes), 1)))), field['affine'].T)[:, :3]
+    nearest_indexes = centerline.find_nearest_indexes(physical_coordinates)
+    distances = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    lookup = lookup_table[nearest_indexes]
+    indexes_out_distance = np.logical_or(np.logical_or(distances > field['threshold_distance'], distances < -field['threshold_distance']), lookup == 0)
+    projected_points = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline.get_in_plans_coordinates(projected_points, nearest_indexes)
+
+    if name == 'curve2straight':
+        coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup)
+    else:
+        # the planes of the straight centerline are axial
+        coord_dest = centerline_dest.points[lookup]
+        coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_dest[:, 2] += distances
+    displacements = coord_dest - physical_coordinates
+    # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
+    # while ours is LPI-
+    # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
+    #  https://www.slicer.org/wiki/Coordinate_systems
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+
+    data_warp[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements
+    return z_stop - z_start
+
+
 class SpinalCordStraightener(object):
 
     def __init__(self, input_filename, centerline_filename, debug=0, deg_poly=10, gapxy=30, gapz=15,
@@ -242,6 +349,7 @@ class SpinalCordStraightener(object):
         self.xy_size = 35  # in mm
 
         self.path_qc = None
+        self.jobs = 1  # number of processes used to compute the warping fields. 0: all available CPUs
 
     def straighten(self):
         # Initialization
@@ -319,7 +427,7 @@ class SpinalCordStraightener(object):
                 sct.mv('centerline_rpi.nii.gz', 'centerline_rpi_native.nii.gz')
                 pz_native = pz
 
-                sct.run(['sct_resample', '-i', 'centerline_rpi_native.nii.gz', '-mm', str(px_r) + 'x' + str(py_r) + 'x' + str(pz_r), '-o', 'centerline_rpi.nii.gz'])
+                resample_file('centerline_rpi_native.nii.gz', 'centerline_rpi.nii.gz', str(px_r) + 'x' + str(py_r) + 'x' + str(pz_r), 'mm', 'linear', verbose=0)
                 image_centerline = Image('centerline_rpi.nii.gz')
                 nx, ny, nz, nt, px, py, pz, pt = image_centerline.dim
 
@@ -473,7 +581,7 @@ class SpinalCordStraightener(object):
                 # if the destination image is resampled, we still create the straight reference space with the native resolution
                 if intermediate_resampling:
                     padding_z = int(np.ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz_native))
-                    sct.run(['sct_image', '-i', 'centerline_rpi_native.nii.gz', '-o', 'tmp.centerline_pad_native.nii.gz', '-pad', '0,0,' + str(padding_z)])
+                    im_centerline_pad_native = pad_image(Image('centerline_rpi_native.nii.gz'), pad_z_i=padding_z, pad_z_f=padding_z)
                     image_centerline_pad = Image('centerline_rpi_native.nii.gz')
                     nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
                     start_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
@@ -494,7 +602,7 @@ class SpinalCordStraightener(object):
                      (1, warp_space_y),
                      (2, (0, end_point_coord_native[2] - start_point_coord_native[2])),
                     ))
-                    msct_image.spatial_crop(Image("tmp.centerline_pad_native.nii.gz"), spec).save("tmp.centerline_pad_crop_native.nii.gz")
+                    msct_image.spatial_crop(im_centerline_pad_native, spec).save("tmp.centerline_pad_crop_native.nii.gz")
 
                     fname_ref = 'tmp.centerline_pad_crop_native.nii.gz'
                     offset_z = 4
@@ -503,7 +611,7 @@ class SpinalCordStraightener(object):
 
                 nx, ny, nz, nt, px, py, pz, pt = image_centerline.dim
                 padding_z = int(np.ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz)) + offset_z
-                sct.run(['sct_image', '-i', 'centerline_rpi.nii.gz', '-o', 'tmp.centerline_pad.nii.gz', '-pad', '0,0,' + str(padding_z)])
+                im_centerline_pad = pad_image(Image('centerline_rpi.nii.gz'), pad_z_i=padding_z, pad_z_f=padding_z)
                 image_centerline_pad = Image('centerline_rpi.nii.gz')
                 nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
                 hdr_warp = image_centerline_pad.hdr.copy()
@@ -532,7 +640,7 @@ class SpinalCordStraightener(object):
                  (1, warp_space_y),
                  (2, (0, end_point_coord[2] - start_point_coord[2] + offset_z)),
                 ))
-                msct_image.spatial_crop(Image("tmp.centerline_pad.nii.gz"), spec).save("tmp.centerline_pad_crop.nii.gz")
+                msct_image.spatial_crop(im_centerline_pad, spec).save("tmp.centerline_pad_crop.nii.gz")
 
                 image_centerline_straight = Image('tmp.centerline_pad_crop.nii.gz')
                 nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
@@ -636,67 +744,77 @@ class SpinalCordStraightener(object):
 
             # Create volumes containing curved and straight warping fields
             time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
 
             # 5. compute transformations
             # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
             # b. determine which plane of spinal cord centreline it is included
             # sct.printv(nx * ny * nz, nx_s * ny_s * nz_s)
 
+            # The fields are split in chunks of slices, which are computed in parallel (both directions at the same
+            # time). Each process writes its chunks directly in the output arrays, which are in shared memory.
+            jobs = self.jobs if self.jobs > 0 else multiprocessing.cpu_count()
+            warping_fields = {}
             if self.curved2straight:
-                for u in tqdm.tqdm(range(nz_s)):
-                    x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                    indexes_straight = np.array(list(zip(x_s.ravel(), y_s.ravel(), z_s.ravel())))
-                    physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                    nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                    distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    lookup = lookup_straight2curved[nearest_indexes_straight]
-                    indexes_out_distance_straight = np.logical_or(np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance), lookup == 0)
-                    projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-
-                    coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup)
-                    displacements_straight = coord_straight2curved - physical_coordinates_straight
-                    # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
-                    # while ours is LPI-
-                    # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
-                    #  https://www.slicer.org/wiki/Coordinate_systems
-                    displacements_straight[:, 2] = -displacements_straight[:, 2]
-                    displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
-
+                # the field is defined in the straight space: each voxel is mapped to the curved space
+                warping_fields['curve2straight'] = {
+                    'shape': (nx_s, ny_s, nz_s, 1, 3),
+                    'affine': image_centerline_straight.hdr.get_best_affine(),
+                    'centerline': centerline_straight,
+                    'lookup': lookup_straight2curved,
+                    'centerline_dest': centerline,
+                    'threshold_distance': self.threshold_distance,
+                }
             if self.straight2curved:
-                for u in tqdm.tqdm(range(nz)):
-                    x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                    indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
-                    physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                    nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                    distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-                    lookup = lookup_curved2straight[nearest_indexes_curved]
-                    indexes_out_distance_curved = np.logical_or(np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance), lookup == 0)
-                    projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-                    coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-
-                    coord_curved2straight = centerline_straight.points[lookup]
-                    coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                    coord_curved2straight[:, 2] += distances_curved
-
-                    displacements_curved = coord_curved2straight - physical_coordinates
-
-                    displacements_curved[:, 2] = -displacements_curved[:, 2]
-                    displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
+                # the field is defined in the curved space: each voxel is mapped to the straight space
+                warping_fields['straight2curve'] = {
+                    'shape': (nx, ny, nz, 1, 3),
+                    'affine': image_centerline_pad.hdr.get_best_affine(),
+                    'centerline': centerline,
+                    'lookup': lookup_curved2straight,
+                    'centerline_dest': centerline_straight,
+                    'threshold_distance': self.threshold_distance,
+                }
+            for field in warping_fields.values():
+                if jobs > 1:
+                    field['data'] = RawArray('d', int(np.prod(field['shape'])))
+                else:
+                    field['data'] = np.zeros(field['shape'])
+
+            tasks = []
+            for name, field in warping_fields.items():
+                nz_field = field['shape'][2]
+                chunk_size = max(1, int(np.ceil(nz_field / (4.0 * jobs))))
+                tasks += [(name, z, min(z + chunk_size, nz_field)) for z in range(0, nz_field, chunk_size)]
+            with tqdm.tqdm(total=sum(z_stop - z_start for _, z_start, z_stop in tasks), unit='slice') as pbar:
+                if jobs > 1:
+                    pool = multiprocessing.Pool(processes=jobs, initializer=init_warping_field_worker,
+                                                initargs=(warping_fields,))
+                    try:
+                        for nb_slices in pool.imap_unordered(compute_warping_field_chunk, tasks):
+                            pbar.update(nb_slices)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    init_warping_field_worker(warping_fields)
+                    for task in tasks:
+                        pbar.update(compute_warping_field_chunk(task))
+            init_warping_field_worker({})
 
-                    data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+            if jobs > 1:
+                for field in warping_fields.values():
+                    field['data'] = np.frombuffer(field['data']).reshape(field['shape'])
+            data_warp_curved2straight = warping_fields.get('curve2straight', {}).get('data')
+            data_warp_straight2curved = warping_fields.get('straight2curve', {}).get('data')
 
             # Creation of the safe zone based on pre-calculated safe boundaries
             coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
             coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
 
-            if radius_safe > 0:
+            if radius_safe > 0 and self.curved2straight:
                 data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
                 data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
+            if radius_safe > 0 and self.straight2curved:
                 data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
                 data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
 
@@ -717,9 +835,8 @@ class SpinalCordStraightener(object):
 
             if self.curved2straight:
                 sct.printv('\nApply transformation to input image...', verbose)
-                s, o = sct.run(['sct_apply_transfo', '-i', 'data.nii', '-d', fname_ref, '-o', 'tmp.anat_rigid_warp.nii.gz', '-w', 'tmp.curve2straight.nii.gz', '-x', interpolation_warp], verbose)
-                for line in o.splitlines():
-                    sct.printv("> %s" % line, verbose=verbose)
+                Transform(input_filename='data.nii', fname_dest=fname_ref, output_filename='tmp.anat_rigid_warp.nii.gz',
+                          warp='tmp.curve2straight.nii.gz', interp=interpolation_warp, verbose=0).apply()
 
             if self.accuracy_results:
                 time_accuracy_results = time.time()
@@ -918,6 +1035,12 @@ def get_parser():
                       mandatory=False,
                       example=['0', '1'],
                       default_value='1')
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of processes used to compute the warping fields. 0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=1,
+                      example=4)
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="Verbose. 0: nothing, 1: basic, 2: extended.",
@@ -991,8 +1114,8 @@ def main(args=None):
     verbose = int(arguments.get("-v", 0))
     sc_straight.verbose = verbose
 
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-jobs" in arguments:
+        sc_straight.jobs = int(arguments["-jobs"])
 
     path_qc = arguments.get("-qc", None)
 
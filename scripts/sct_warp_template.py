@@ -14,13 +14,22 @@
 from __future__ import absolute_import
 
 import sys, io, os, time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+from tqdm import tqdm
 
 import spinalcordtoolbox.metadata
 
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CACHE_HELP
 
 from msct_parser import Parser
 import sct_utils as sct
+import sct_concat_transfo
+from sct_apply_transfo import INTERP_ORDER, displacement_to_coordinates
 
 # get path of the script and the toolbox
 path_script = os.path.dirname(__file__)
@@ -44,10 +53,11 @@ class Param:
         self.list_labels_nn = ['_level.nii.gz', '_levels.nii.gz', '_csf.nii.gz', '_CSF.nii.gz', '_cord.nii.gz']  # list of files for which nn interpolation should be used. Default = linear.
         self.verbose = 1  # verbose
         self.path_qc = None
+        self.jobs = 1  # number of threads used to warp the labels. 0: use all the available CPUs
 
 
 class WarpTemplate:
-    def __init__(self, fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose):
+    def __init__(self, fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, jobs=1):
 
         # Initialization
         self.fname_src = fname_src
@@ -73,22 +83,95 @@ class WarpTemplate:
         if not os.path.exists(self.folder_out):
             os.makedirs(self.folder_out)
 
+        # Load the warping field once, for all the labels
+        warper = LabelWarper(self.fname_src, self.fname_transfo, jobs=jobs, verbose=self.verbose)
+
         # Warp template objects
         sct.printv('\nWARP TEMPLATE:', self.verbose)
-        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warper=warper)
 
         # Warp atlas
         if self.warp_atlas == 1:
             sct.printv('\nWARP ATLAS OF WHITE MATTER TRACTS:', self.verbose)
-            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warper=warper)
 
         # Warp spinal levels
         if self.warp_spinal_levels == 1:
             sct.printv('\nWARP SPINAL LEVELS:', self.verbose)
-            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warper=warper)
 
 
-def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
+class LabelWarper(object):
+    """
+    Warp images onto the grid of a destination image, through a warping field which is only loaded once. The images
+    are resampled concurrently, in-process, as sct_apply_transfo does for 4D data.
+    """
+    def __init__(self, fname_dest, fname_transfo, jobs=1, verbose=1):
+        """
+        :param fname_dest: destination image
+        :param fname_transfo: warping field (or affine transformation)
+        :param jobs: number of threads. 0: use all the available CPUs.
+        """
+        self.im_dest = Image(fname_dest, mmap=True)
+        self.jobs = jobs if jobs > 0 else cpu_count()
+        self.verbose = verbose
+        # voxel coordinates in the source images, for each source geometry
+        self.coords = {}
+        # the warping field is used as is if it is already defined on the destination grid, otherwise it is composed
+        # (and cached) onto it
+        im_warp = Image(fname_transfo, mmap=True) if fname_transfo.endswith(('.nii', '.nii.gz')) else None
+        if im_warp is None or not self.same_geometry(im_warp, self.im_dest):
+            path_tmp = sct.tmp_create(basename="warp_template", verbose=verbose)
+            # the composed field is read into memory, as its file is removed with the temporary folder
+            im_warp = Image(sct_concat_transfo.compose_warps(
+             [fname_transfo], fname_dest, os.path.join(path_tmp, 'warp.nii.gz'), '3', verbose=verbose), mmap=False)
+            sct.rmtree(path_tmp, verbose=verbose)
+        self.im_warp = im_warp
+
+    @staticmethod
+    def same_geometry(im1, im2):
+        return im1.hdr.get_data_shape()[:3] == im2.hdr.get_data_shape()[:3] \
+         and np.allclose(im1.hdr.get_best_affine(), im2.hdr.get_best_affine())
+
+    def get_coordinates(self, im_src):
+        """
+        :return: voxel coordinates in im_src of each voxel of the destination image
+        """
+        geometry = (im_src.hdr.get_data_shape()[:3], tuple(im_src.hdr.get_best_affine().round(6).ravel()))
+        if geometry not in self.coords:
+            self.coords[geometry] = displacement_to_coordinates(self.im_warp, self.im_dest, im_src)
+        return self.coords[geometry]
+
+    def warp(self, list_fname_in, list_fname_out, list_interp):
+        """
+        Warp images.
+
+        :param list_fname_in: list of source images
+        :param list_fname_out: list of output images
+        :param list_interp: list of interpolation methods ('nn', 'linear', 'spline')
+        """
+        # coordinates are computed beforehand, as they are shared by the threads
+        list_coords = [self.get_coordinates(Image(fname_in, mmap=True)) for fname_in in list_fname_in]
+
+        def warp_image(i):
+            data_in = Image(list_fname_in[i]).data
+            data_out = map_coordinates(data_in, list_coords[i], order=INTERP_ORDER[list_interp[i]],
+                                       output=np.float32, mode='constant', cval=0.0)
+            hdr = self.im_dest.hdr.copy()
+            hdr.set_data_dtype(np.float32)
+            Image(data_out, hdr=hdr).save(list_fname_out[i], verbose=0)
+
+        pool = ThreadPool(self.jobs)
+        try:
+            for _ in tqdm(pool.imap_unordered(warp_image, range(len(list_fname_in))), total=len(list_fname_in),
+                          unit='file', desc="Warp labels", ascii=True, ncols=80, disable=not self.verbose):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+
+def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out, warper=None):
     """
     Warp label files according to info_label.txt file
     :param path_label:
@@ -97,6 +180,7 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
     :param fname_src:
     :param fname_transfo:
     :param path_out:
+    :param warper: LabelWarper used to warp the files. If None, one is created from fname_src and fname_transfo.
     :return:
     """
     # read label file and check if file exists
@@ -111,12 +195,11 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
         if not os.path.exists(os.path.join(path_out, folder_label)):
             os.makedirs(os.path.join(path_out, folder_label))
         # Warp label
-        for i in range(0, len(template_label_file)):
-            fname_label = os.path.join(path_label, folder_label, template_label_file[i])
-            # check if file exists
-            # sct.check_file_exist(fname_label)
-            # apply transfo
-            sct.run('sct_apply_transfo -i ' + fname_label + ' -o ' + os.path.join(path_out, folder_label, template_label_file[i]) + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
+        if warper is None:
+            warper = LabelWarper(fname_src, fname_transfo, jobs=param.jobs, verbose=param.verbose)
+        warper.warp([os.path.join(path_label, folder_label, f) for f in template_label_file],
+                    [os.path.join(path_out, folder_label, f) for f in template_label_file],
+                    [get_interp(f) for f in template_label_file])
         # Copy list.txt
         sct.copy(os.path.join(path_label, folder_label, param.file_info_label), os.path.join(path_out, folder_label))
 
@@ -140,7 +223,8 @@ def get_parser():
     param_default = Param()
     # Initialize parser
     parser = Parser(__file__)
-    parser.usage.set_description('This function warps the template and all atlases to a given image (e.g. fMRI, DTI, MTR, etc.).')
+    parser.usage.set_description('This function warps the template and all atlases to a given image (e.g. fMRI, DTI, MTR, etc.).\n\n'
+                                 + CACHE_HELP)
     parser.add_option(name="-d",
                       type_value="file",
                       description="destination image the template will be warped into",
@@ -178,6 +262,12 @@ def get_parser():
                       type_value='folder_creation',
                       description='The path where the quality control generated content will be saved',
                       default_value=param_default.path_qc)
+    parser.add_option(name="-jobs",
+                      type_value="int",
+                      description="Number of threads used to warp the labels. 0: use all the available CPUs.",
+                      mandatory=False,
+                      default_value=param_default.jobs,
+                      example='4')
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose.""",
@@ -222,9 +312,10 @@ def main(args=None):
     path_template = arguments['-t']
     verbose = int(arguments['-v'])
     path_qc = arguments.get("-qc", None)
+    jobs = arguments['-jobs']
 
     # call main function
-    w = WarpTemplate(fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose)
+    w = WarpTemplate(fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, jobs=jobs)
 
     path_template = os.path.join(w.folder_out, w.folder_template)
     if set(spinalcordtoolbox.metadata.get_indiv_label_names(path_template)).issuperset(["white matter", "T2-weighted template", "gray matter"]):
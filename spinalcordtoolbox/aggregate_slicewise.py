@@ -15,8 +15,7 @@ import csv
 import datetime
 
 import sct_utils as sct
-from spinalcordtoolbox.template import get_slices_from_vertebral_levels, get_vertebral_level_from_slice
-from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.template import get_vert_level_index
 from spinalcordtoolbox.utils import parse_num_list_inv
 
 
@@ -44,23 +43,14 @@ class LabelStruc:
         self.map_cluster = map_cluster
 
 
-def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], perslice=None, perlevel=False,
-                                 vert_level=None, group_funcs=(('MEAN', np.mean),), map_clusters=None):
+def get_slicegroups(nz, slices=[], levels=[], perslice=None, perlevel=False, vert_level=None):
     """
-    The aggregation will be performed along the last dimension of 'metric' ndarray.
-    :param metric: Class Metric(): data to aggregate.
-    :param mask: Class Metric(): mask to use for aggregating the data. Optional.
-    :param slices: List[int]: Slices to aggregate metric from. If empty, select all slices.
-    :param levels: List[int]: Vertebral levels to aggregate metric from. It has priority over "slices".
-    :param Bool perslice: Aggregate per slice (True) or across slices (False)
-    :param Bool perlevel: Aggregate per level (True) or across levels (False). Has priority over "perslice".
-    :param vert_level: Vertebral level. Could be either an Image or a file name.
-    :param tuple group_funcs: Functions to apply on metric. Example: (('mean', np.mean),))
-    :param map_clusters: list of list of int: See func_map()
-    :return: Aggregated metric
+    Build the groups of slices across which metrics are aggregated. See aggregate_per_slice_or_level() for the
+    description of the parameters.
+    :param nz: int: Number of slices (size of the last dimension of the metric)
+    :return: slicegroups: List[tuple]: Slices of each group. Example: [(0, 1, 2), (3, 4, 5)]
+    :return: vertgroups: List[tuple]: Vertebral levels associated with each group, or None if levels are not used.
     """
-    # TODO: always add vertLevel if exists
-
     # If user neither specified slices nor levels, set perslice=True, otherwise, the output will likely contain nan
     # because in many cases the segmentation does not span the whole I-S dimension.
     if perslice is None:
@@ -70,23 +60,22 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
             perslice = False
 
     # if slices is empty, select all available slices from the metric
-    ndim = metric.data.ndim
     if not slices:
-        slices = range(metric.data.shape[ndim-1])
+        slices = range(nz)
 
     # aggregation based on levels
     if levels:
-        im_vert_level = Image(vert_level).change_orientation('RPI')
+        vert_level_index = get_vert_level_index(vert_level)
         # slicegroups = [(0, 1, 2), (3, 4, 5), (6, 7, 8)]
-        slicegroups = [tuple(get_slices_from_vertebral_levels(im_vert_level, level)) for level in levels]
+        slicegroups = [tuple(vert_level_index.get_slices(level)) for level in levels]
         if perlevel:
             # vertgroups = [(2,), (3,), (4,)]
             vertgroups = [tuple([level]) for level in levels]
         elif perslice:
             # slicegroups = [(0,), (1,), (2,), (3,), (4,), (5,), (6,), (7,), (8,)]
-            slicegroups = [tuple([i]) for i in reduce(operator.concat, slicegroups)]  # reduce to individual tuple
+            slicegroups = [tuple([i]) for i in functools.reduce(operator.concat, slicegroups)]  # reduce to individual tuple
             # vertgroups = [(2,), (2,), (2,), (3,), (3,), (3,), (4,), (4,), (4,)]
-            vertgroups = [tuple([get_vertebral_level_from_slice(im_vert_level, i[0])]) for i in slicegroups]
+            vertgroups = [tuple([vert_level_index.get_level(i[0])]) for i in slicegroups]
         # output aggregate metric across levels
         else:
             # slicegroups = [(0, 1, 2, 3, 4, 5, 6, 7, 8)]
@@ -102,6 +91,27 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
         else:
             # slicegroups = [(0, 1, 2, 3, 4, 5, 6, 7, 8)]
             slicegroups = [tuple(slices)]
+    return slicegroups, vertgroups
+
+
+def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], perslice=None, perlevel=False,
+                                 vert_level=None, group_funcs=(('MEAN', np.mean),), map_clusters=None):
+    """
+    The aggregation will be performed along the last dimension of 'metric' ndarray.
+    :param metric: Class Metric(): data to aggregate.
+    :param mask: Class Metric(): mask to use for aggregating the data. Optional.
+    :param slices: List[int]: Slices to aggregate metric from. If empty, select all slices.
+    :param levels: List[int]: Vertebral levels to aggregate metric from. It has priority over "slices".
+    :param Bool perslice: Aggregate per slice (True) or across slices (False)
+    :param Bool perlevel: Aggregate per level (True) or across levels (False). Has priority over "perslice".
+    :param vert_level: Vertebral level. Could be either an Image, a file name or a VertLevelIndex.
+    :param tuple group_funcs: Functions to apply on metric. Example: (('mean', np.mean),))
+    :param map_clusters: list of list of int: See func_map()
+    :return: Aggregated metric
+    """
+    # TODO: always add vertLevel if exists
+    slicegroups, vertgroups = get_slicegroups(metric.data.shape[-1], slices=slices, levels=levels, perslice=perslice,
+                                              perlevel=perlevel, vert_level=vert_level)
     agg_metric = dict((slicegroup, dict()) for slicegroup in slicegroups)
 
     # loop across slice group
@@ -195,51 +205,189 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
     :param id_label: int: ID of label to select
     :param indiv_labels_ids: list of int: IDs of labels corresponding to individual (as opposed to combined) labels for
     use with ML or MAP estimation.
-    :param map_clusters: list of list of int: See func_map()
     :return: aggregate_per_slice_or_level()
     """
-    # Initializations
-    map_clusters = None
-    func_methods = {'ml': ('ML', func_ml), 'map': ('MAP', func_map)}
-    # If label_struc[id_label].id is a list, it means that it comes from a combined labels
-    if isinstance(label_struc[id_label].id, list):
-        # Sum across labels
-        labels_sum = np.sum(labels[..., label_struc[id_label].id], axis=3)  # (nx, ny, nz, 1)
-    else:
-        # Simply extract
-        labels_sum = labels[..., label_struc[id_label].id]
-    # expand dim: labels_sum=(..., 1)
-    ndim = labels_sum.ndim
-    labels_sum = np.expand_dims(labels_sum, axis=ndim)
-
-    # Maximum Likelihood or Maximum a Posteriori
-    if method in ['ml', 'map']:
-        id_label_compl = diff_between_list_or_int(indiv_labels_ids, label_struc[id_label].id)
-        # Generate a list of map_clusters for each label in mask.
-        # Start with the first label (the one chosed by the user)
-        map_clusters = [label_struc[id_label].map_cluster]
-        # Then append the remaining cluster IDs
-        map_clusters += [label_struc[i].map_cluster for i in id_label_compl]
-        # Concatenate labels: the one asked by the user, followed by the remaining ones
-        labels_sum = np.concatenate([labels_sum, labels[..., id_label_compl]], axis=ndim)
-        mask = Metric(data=labels_sum, label=label_struc[id_label].name)
-        group_funcs = (func_methods[method], ('STD', func_std))
-    # Weighted average
-    elif method == 'wa':
-        mask = Metric(data=labels_sum, label=label_struc[id_label].name)
-        group_funcs = (('WA', func_wa), ('STD', func_std))
-    # Binarize mask
-    elif method == 'bin':
-        mask = Metric(data=labels_sum, label=label_struc[id_label].name)
-        group_funcs = (('BIN', func_bin), ('STD', func_std))
-    # Maximum
-    elif method == 'max':
-        mask = Metric(data=labels_sum, label=label_struc[id_label].name)
-        group_funcs = (('MAX', func_max),)
-
-    return aggregate_per_slice_or_level(data, mask=mask, slices=slices, levels=levels, perslice=perslice,
-                                        perlevel=perlevel, vert_level=vert_level, group_funcs=group_funcs,
-                                        map_clusters=map_clusters)
+    return extract_metrics([data], labels=labels, slices=slices, levels=levels, perslice=perslice, perlevel=perlevel,
+                           vert_level=vert_level, method=method, label_struc=label_struc, ids_label=[id_label],
+                           indiv_labels_ids=indiv_labels_ids)[id_label]
+
+
+def extract_metrics(metrics, labels=None, slices=None, levels=None, perslice=True, perlevel=False,
+                    vert_level=None, method=None, label_struc=None, ids_label=None, indiv_labels_ids=None):
+    """
+    Extract several metrics within several labels at once, using a given method.
+    The slice/level grouping is built once. Weighted sums (and the label cross-products needed by ML/MAP) are computed
+    once per slice for all labels, then summed within each slicegroup, so that the estimation for all groups and all
+    labels reduces to small matrix operations.
+    :param metrics: list of Class Metric(): Data of n-dimension to extract aggregated value from. The label of each
+    Metric is used to name the output fields, e.g.: WA(FA).
+    :param labels: ndarray: Labels of (n+1)dim. The last dim encloses the individual labels.
+    :param slices:
+    :param levels:
+    :param perslice:
+    :param perlevel:
+    :param vert_level:
+    :param method: {'wa', 'bin', 'ml', 'map', 'max'}
+    :param label_struc: Label structure defined in sct_extract_metric
+    :param ids_label: list of int: IDs of labels to select
+    :param indiv_labels_ids: list of int: IDs of labels corresponding to individual (as opposed to combined) labels for
+    use with ML or MAP estimation.
+    :return: dict: {id_label: agg_metric}, with agg_metric structured as the output of aggregate_per_slice_or_level()
+    """
+    func_names = {'wa': ('WA', 'STD'), 'bin': ('BIN', 'STD'), 'ml': ('ML', 'STD'), 'map': ('MAP', 'STD'),
+                  'max': ('MAX',)}[method]
+    nz, n_labels = labels.shape[-2], labels.shape[-1]
+    slicegroups, vertgroups = get_slicegroups(nz, slices=slices, levels=levels, perslice=perslice, perlevel=perlevel,
+                                              vert_level=vert_level)
+
+    # Build the slicegroup index: group_index[i, z] is the number of times slice z is selected in slicegroup i
+    group_index = np.zeros((len(slicegroups), nz))
+    group_errors = {}
+    for i_group, slicegroup in enumerate(slicegroups):
+        try:
+            np.add.at(group_index[i_group], np.array(slicegroup, dtype=int), 1)
+        except IndexError as e:
+            group_errors[i_group] = str(e)
+    group_empty = group_index.sum(axis=1) == 0
+
+    # Only keep voxels that belong to at least one label, sorted by slice so that each slice is a contiguous segment
+    labels_flat = labels.reshape(-1, n_labels)
+    ind_vox = np.flatnonzero(np.any(labels_flat != 0, axis=1))
+    ind_vox = ind_vox[np.argsort(ind_vox % nz, kind='mergesort')]
+    bounds = np.searchsorted(ind_vox % nz, np.arange(nz + 1))
+    weights = labels_flat[ind_vox].astype(np.float64)
+
+    # For each label: rows of matrix_labels combine the individual labels into the columns of the mask used for
+    # estimation. The first column is the selected label, then (ML/MAP only) the remaining individual labels.
+    matrix_labels, map_clusters = {}, {}
+    for id_label in ids_label:
+        ids = [label_struc[id_label].id]
+        if method in ['ml', 'map']:
+            ids += diff_between_list_or_int(indiv_labels_ids, label_struc[id_label].id)
+            map_clusters[id_label] = [label_struc[id_label].map_cluster] + [label_struc[i].map_cluster for i in ids[1:]]
+        matrix_labels[id_label] = np.zeros((len(ids), n_labels))
+        for i_col, id_col in enumerate(ids):
+            matrix_labels[id_label][i_col, id_col] = 1
+
+    # Volume of each mask, computed before discarding non-finite values
+    size_slice = sum_per_slice(weights, bounds)
+    gram = None
+
+    agg_metrics = dict((id_label, dict((slicegroup, dict()) for slicegroup in slicegroups)) for id_label in ids_label)
+    for metric in metrics:
+        data = np.asarray(metric.data)
+        # Ignore nonfinite values, in the data and in the labels
+        isfinite = np.isfinite(data)
+        data_vox = np.where(isfinite, data, 0.).reshape(-1)[ind_vox].astype(np.float64)
+        isfinite_vox = isfinite.reshape(-1)[ind_vox]
+        if isfinite_vox.all():
+            weights_metric = weights
+        else:
+            weights_metric = weights * isfinite_vox[:, np.newaxis]
+        if 'MAX' in func_names:
+            # func_max() does not use the mask: take the maximum across all voxels of the slicegroup
+            max_slice = np.where(isfinite, data, 0.).reshape(-1, nz).max(axis=0)
+            max_group = np.where(group_index > 0, max_slice, -np.inf).max(axis=1)
+        if method in ['ml', 'map']:
+            # Cross-products between labels, and between labels and data, summed within each slicegroup
+            if weights_metric is weights:
+                if gram is None:
+                    gram = np.tensordot(group_index, gram_per_slice(weights, bounds), axes=1)
+                gram_metric = gram
+            else:
+                gram_metric = np.tensordot(group_index, gram_per_slice(weights_metric, bounds), axes=1)
+            xty = np.dot(group_index, sum_per_slice(weights_metric * data_vox[:, np.newaxis], bounds))
+
+        for id_label in ids_label:
+            agg_metric = agg_metrics[id_label]
+            matrix = matrix_labels[id_label]
+            results = {}
+            # Weighted average and standard deviation within the selected label
+            mask_vox = np.dot(weights_metric, matrix[0])
+            sum_w, sum_wd, sum_wd2 = np.dot(group_index, sum_per_slice(
+                np.stack([mask_vox, mask_vox * data_vox, mask_vox * data_vox ** 2], axis=1), bounds)).T
+            if 'WA' in func_names or 'STD' in func_names:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    average = sum_wd / sum_w
+                    results['WA'] = average
+                    results['STD'] = np.sqrt(np.maximum(sum_wd2 / sum_w - average ** 2, 0))
+            if 'BIN' in func_names:
+                mask_bin = np.where(mask_vox >= 0.5, 1, 0)
+                sum_b, sum_bd = np.dot(group_index, sum_per_slice(
+                    np.stack([mask_bin, mask_bin * data_vox], axis=1), bounds)).T
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    results['BIN'] = sum_bd / sum_b
+            if 'MAX' in func_names:
+                results['MAX'] = max_group
+            if method in ['ml', 'map']:
+                # ML estimation: beta = (Xt . X)^(-1) . Xt . y, see func_ml()
+                xtx_label = np.matmul(np.matmul(matrix, gram_metric), matrix.T)
+                xty_label = np.dot(xty, matrix.T)
+                if method == 'ml':
+                    results['ML'] = np.einsum('gij,gj->gi', np.linalg.pinv(xtx_label), xty_label)[:, 0]
+                else:
+                    # MAP estimation: beta = beta_0 + (Xt . X + 1)^(-1) . Xt . (y - X . beta_0), see func_map()
+                    clusters = map_clusters[id_label]
+                    matrix_clusters = np.array([[float(clusters[i] == i_cluster) for i in range(len(clusters))]
+                                                for i_cluster in list(set(clusters))])
+                    xtx_cluster = np.matmul(np.matmul(matrix_clusters, xtx_label), matrix_clusters.T)
+                    beta_cluster = np.einsum('gij,gj->gi', np.linalg.pinv(xtx_cluster),
+                                             np.dot(xty_label, matrix_clusters.T))
+                    beta_0 = beta_cluster[:, clusters]
+                    beta = beta_0 + np.einsum('gij,gj->gi', np.linalg.pinv(xtx_label + np.eye(len(clusters))),
+                                              xty_label - np.einsum('gij,gj->gi', xtx_label, beta_0))
+                    results['MAP'] = beta[:, 0]
+            size_group = np.dot(group_index, np.dot(size_slice, matrix.sum(axis=0)))
+
+            for i_group, slicegroup in enumerate(slicegroups):
+                if levels:
+                    agg_metric[slicegroup]['VertLevel'] = vertgroups[i_group]
+                for name in func_names:
+                    key = '{}({})'.format(name, metric.label)
+                    if i_group in group_errors:
+                        agg_metric[slicegroup][key] = group_errors[i_group]
+                        continue
+                    agg_metric[slicegroup]['Label'] = label_struc[id_label].name
+                    agg_metric[slicegroup]['Size [vox]'] = size_group[i_group]
+                    if name == 'MAX' and group_empty[i_group]:
+                        agg_metric[slicegroup][key] = 'zero-size array to reduction operation maximum which has no ' \
+                                                      'identity'
+                    elif name in ['WA', 'BIN', 'STD'] and not (sum_b if name == 'BIN' else sum_w)[i_group]:
+                        agg_metric[slicegroup][key] = "Weights sum to zero, can't be normalized"
+                    elif np.isnan(results[name][i_group]):
+                        agg_metric[slicegroup][key] = 'nan'
+                    else:
+                        agg_metric[slicegroup][key] = results[name][i_group]
+    return agg_metrics
+
+
+def sum_per_slice(values, bounds):
+    """
+    Sum values within each slice.
+    :param values: nd-array: values of each voxel, sorted by slice (first dimension).
+    :param bounds: 1d-array of int: slice z spans values[bounds[z]:bounds[z+1]].
+    :return: nd-array: sum of values for each slice (first dimension).
+    """
+    sums = np.zeros((len(bounds) - 1,) + values.shape[1:])
+    slices_nonempty = np.flatnonzero(bounds[1:] > bounds[:-1])
+    if slices_nonempty.size:
+        # reduceat sums between consecutive indices: empty slices in-between do not contribute
+        sums[slices_nonempty] = np.add.reduceat(values, bounds[slices_nonempty], axis=0)
+    return sums
+
+
+def gram_per_slice(weights, bounds):
+    """
+    Compute the cross-products between labels (Xt . X) within each slice.
+    :param weights: 2d-array [nb_vox x nb_labels]: labels of each voxel, sorted by slice.
+    :param bounds: 1d-array of int: slice z spans weights[bounds[z]:bounds[z+1]].
+    :return: 3d-array [nb_slices x nb_labels x nb_labels]
+    """
+    gram = np.zeros((len(bounds) - 1, weights.shape[1], weights.shape[1]))
+    for iz in np.flatnonzero(bounds[1:] > bounds[:-1]):
+        weights_slice = weights[bounds[iz]:bounds[iz + 1]]
+        gram[iz] = np.dot(weights_slice.T, weights_slice)
+    return gram
 
 
 def func_bin(data, mask, map_clusters=None):
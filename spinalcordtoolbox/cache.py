@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Persistent store for results that are expensive to compute (e.g. straightening warping fields), shared by all tools
+# and runs.
+#
+# Entries are identified by a key computed from the content of the inputs (see cache_key()), so that a result is
+# reused whatever the name, location or compression of the input files. Each entry is a folder of files. The store
+# is located in $SCT_CACHE_DIR (default: ~/.cache/spinalcordtoolbox) and its size is limited to $SCT_CACHE_MAX_SIZE
+# MB: when it is exceeded, the least recently used entries are removed. The cache is disabled unless
+# $SCT_CACHE_MAX_SIZE is set to a positive value (default: 0).
+
+from __future__ import absolute_import, division
+
+import os, shutil, hashlib, tempfile, errno
+
+import numpy as np
+
+from sct_utils import log
+
+CACHE_DIR = os.environ.get("SCT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "spinalcordtoolbox"))
+CACHE_MAX_SIZE = float(os.environ.get("SCT_CACHE_MAX_SIZE", 0))  # in MB
+
+# description of the cache, for the help of the tools that use it
+CACHE_HELP = 'Results that are expensive to compute (straightening, composed warping fields) can be reused across ' \
+             'runs and subjects: set the environment variable SCT_CACHE_MAX_SIZE to the maximum size of the cache, ' \
+             'in MB (default: 0, the cache is disabled). The cache is located in $SCT_CACHE_DIR (default: ' \
+             '~/.cache/spinalcordtoolbox), and the least recently used results are removed when it is full.'
+
+# prefix of the folders that are being written or deleted
+_TMP_PREFIX = ".tmp_"
+
+
+# digests of the files already hashed by this process, indexed by (path, size, modification time)
+_file_digests = {}
+
+
+def file_digest(fname):
+    """
+    :return: str: hexadecimal md5 digest of the content of a file. It is only computed once per process, unless the
+    file is modified.
+    """
+    stat = os.stat(fname)
+    index = (os.path.realpath(fname), stat.st_size, stat.st_mtime)
+    if index not in _file_digests:
+        h = hashlib.md5()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_digests[index] = h.hexdigest()
+    return _file_digests[index]
+
+
+def cache_key(input_images=[], input_geometries=[], input_params={}, input_files=[]):
+    """
+    Compute a key identifying a result from the content of its inputs.
+
+    :param input_images: images (Image or file names) whose data and geometry influence the result
+    :param input_geometries: images (Image or file names) whose geometry only (shape and affine) influences the result
+    :param input_params: parameters that influence the result
+    :param input_files: files (e.g. transformations) whose raw content influences the result. This is faster than
+                        input_images for large images, but depends on their compression.
+    :return: str: hexadecimal digest
+    """
+    from spinalcordtoolbox.image import Image
+    h = hashlib.md5()
+    for fname in input_files:
+        h.update(file_digest(fname).encode())
+    for images, with_data in [(input_images, True), (input_geometries, False)]:
+        for im in images:
+            if isinstance(im, Image):
+                shape = im.data.shape
+            else:
+                # the data is only read if it is hashed
+                im = Image(im, mmap=True)
+                shape = tuple(im.hdr.get_data_shape())
+            h.update(str((shape, im.hdr.get_best_affine().round(6).tolist())).encode())
+            if with_data:
+                data = np.ascontiguousarray(im.data)
+                h.update(data.dtype.str.encode())
+                h.update(data.view(np.uint8).reshape(-1))
+    for k, v in sorted(input_params.items()):
+        h.update(str((k, v)).encode())
+    return h.hexdigest()
+
+
+class CacheStore(object):
+    """
+    Store of cached results, see module description.
+
+    Example:
+    store = CacheStore('straightening')
+    key = cache_key(input_images=['seg.nii.gz'], input_params={'algo_fitting': 'nurbs'})
+    if not store.get(key, ['warp.nii.gz']):
+        ...  # compute warp.nii.gz
+        store.put(key, ['warp.nii.gz'])
+    """
+    def __init__(self, name, path=None, max_size=None):
+        """
+        :param name: name of the store (sub-folder of the cache folder)
+        :param path: cache folder. Default: CACHE_DIR
+        :param max_size: maximum size of the cache folder, in MB. Default: CACHE_MAX_SIZE
+        """
+        self.path = os.path.join(path if path is not None else CACHE_DIR, name)
+        self.max_size = max_size if max_size is not None else CACHE_MAX_SIZE
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key, filenames, path_out='.'):
+        """
+        Copy the files of an entry to path_out.
+
+        :param key: key of the entry
+        :param filenames: files that must be in the entry
+        :param path_out: output folder
+        :return: True if all the files were found, False otherwise
+        """
+        if not self.enabled:
+            return False
+        path_entry = os.path.join(self.path, key)
+        try:
+            for fname in filenames:
+                shutil.copy(os.path.join(path_entry, fname), os.path.join(path_out, fname))
+            # mark the entry as recently used
+            os.utime(path_entry, None)
+        except (IOError, OSError):
+            # missing entry, or entry evicted by another process in the meantime
+            return False
+        log.info('Reusing cached result %s from %s', key, self.path)
+        return True
+
+    def put(self, key, filenames, path_in='.'):
+        """
+        Add the files to the store, as a new entry. The entry is written in a temporary folder which is then
+        renamed, so that other processes never see partial entries. Least recently used entries are evicted if the
+        size limit is exceeded.
+
+        :param key: key of the entry
+        :param filenames: files to store
+        :param path_in: folder containing the files
+        """
+        if not self.enabled:
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                log.warning('Cannot create cache folder %s: %s', self.path, e)
+                return
+        path_entry = os.path.join(self.path, key)
+        path_tmp = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=self.path)
+        try:
+            for fname in filenames:
+                shutil.copy(os.path.join(path_in, fname), os.path.join(path_tmp, fname))
+            if os.path.isdir(path_entry):
+                # already added by another process
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            else:
+                os.rename(path_tmp, path_entry)
+        except (IOError, OSError) as e:
+            log.warning('Cannot add %s to the cache: %s', key, e)
+            shutil.rmtree(path_tmp, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def remove(self, key):
+        """
+        Remove an entry. It is renamed first, so that other processes never see partial entries.
+        """
+        path_tmp = os.path.join(self.path, _TMP_PREFIX + key + "_{}".format(os.getpid()))
+        try:
+            os.rename(os.path.join(self.path, key), path_tmp)
+        except OSError:
+            return
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+    def entries(self):
+        """
+        :return: list of (key, time of last use, size in bytes), from the least to the most recently used entry
+        """
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for key in os.listdir(self.path):
+            path_entry = os.path.join(self.path, key)
+            if key.startswith(_TMP_PREFIX) or not os.path.isdir(path_entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path_entry, f)) for f in os.listdir(path_entry))
+                entries.append((key, os.path.getmtime(path_entry), size))
+            except OSError:
+                # removed by another process in the meantime
+                continue
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the size of the store is below max_size.
+
+        :param keep: key of an entry that must not be removed
+        """
+        entries = self.entries()
+        size = sum(entry[2] for entry in entries)
+        for key, _, size_entry in entries:
+            if size <= self.max_size * 1024 * 1024:
+                break
+            if key == keep:
+                continue
+            log.debug('Removing %s from the cache', key)
+            self.remove(key)
+            size -= size_entry
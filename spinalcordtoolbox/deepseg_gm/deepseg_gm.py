@@ -35,6 +35,7 @@ else:
     sys.stderr = original_stderr
 
 from spinalcordtoolbox.resample import nipy_resample
+from spinalcordtoolbox.model_registry import get_model
 from . import model
 
 
@@ -202,6 +203,19 @@ def threshold_predictions(predictions, thr=0.999):
     return thresholded_preds
 
 
+def load_model(model_abs_path, filters, net_input_size):
+    """Create the model and load its weights.
+
+    :param model_abs_path: the path of the weights.
+    :param filters: the number of filters of the model.
+    :param net_input_size: the size of the input slices.
+    :return: the model.
+    """
+    deepgmseg_model = model.create_model(filters, net_input_size)
+    deepgmseg_model.load_weights(model_abs_path)
+    return deepgmseg_model
+
+
 def segment_volume(ninput_volume, model_name,
                    threshold=0.999, use_tta=False):
     """Segment a nifti volume.
@@ -230,11 +244,9 @@ def segment_volume(ninput_volume, model_name,
         # larger sizer, crop at 200x200
         net_input_size = (SMALL_INPUT_SIZE, SMALL_INPUT_SIZE)
 
-    deepgmseg_model = model.create_model(metadata['filters'],
-                                         net_input_size)
-
     model_abs_path = gmseg_model_challenge.get_file_path(model_path)
-    deepgmseg_model.load_weights(model_abs_path)
+    deepgmseg_model = get_model(('deepseg_gm', model_abs_path, tuple(net_input_size)),
+                                lambda: load_model(model_abs_path, metadata['filters'], net_input_size))
 
     volume_data = ninput_volume.get_data()
     axial_slices = []
@@ -343,3 +355,19 @@ def segment_file(input_filename, output_filename,
 
     nipy.save_image(nii_resampled_original, output_filename)
     return output_filename
+
+
+def segment_files(input_filenames, output_filenames,
+                  model_name, threshold, verbosity,
+                  use_tta):
+    """Segment several volume files. The model is only
+    loaded once (see spinalcordtoolbox.model_registry).
+
+    :param input_filenames: the list of input filenames.
+    :param output_filenames: the list of output filenames.
+    :return: the list of output filenames.
+    """
+    return [segment_file(input_filename, output_filename,
+                         model_name, threshold, verbosity, use_tta)
+            for input_filename, output_filename
+            in zip(input_filenames, output_filenames)]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Sliding-window inference of 3D models (e.g. 3D kernels of sct_deepseg_sc and sct_deepseg_lesion).
+#
+# The volume is divided in (possibly overlapping) patches, which are extracted with strided views, predicted by
+# batches, and blended back with a weighted average.
+
+from __future__ import absolute_import, division
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def patch_weights(patch_size, weighting='uniform'):
+    """
+    Weights of the voxels of a patch when blending overlapping predictions.
+
+    :param patch_size: shape of the patches
+    :param weighting: 'uniform', or 'gaussian' to favour the center of the patches, where the predictions are less
+                      affected by the borders
+    :return: array of shape patch_size
+    """
+    if weighting == 'uniform':
+        return np.ones(patch_size, dtype=np.float32)
+    elif weighting == 'gaussian':
+        weights = np.ones(patch_size, dtype=np.float32)
+        for axis, size in enumerate(patch_size):
+            x = np.arange(size) - (size - 1) / 2.
+            profile = np.exp(-0.5 * (x / (size / 4.)) ** 2)
+            shape = [1] * len(patch_size)
+            shape[axis] = size
+            weights *= profile.reshape(shape).astype(np.float32)
+        return weights
+    else:
+        raise ValueError("Unknown weighting: {}".format(weighting))
+
+
+def predict_sliding_window(model, data, patch_size, step=None, batch_size=4, preprocess=None, skip_empty=True,
+                           weighting='uniform'):
+    """
+    Predict a volume with a 3D model, patch by patch.
+
+    :param model: model with a predict() method, taking inputs of shape (n, 1) + patch_size, and returning outputs of
+                  the same shape
+    :param data: 3D array
+    :param patch_size: shape of the patches
+    :param step: step between the patches along each axis. Default: patch_size (no overlap)
+    :param batch_size: number of patches per call to model.predict()
+    :param preprocess: function applied to each batch of patches before the prediction (e.g. intensity normalization).
+                       The batch is a copy of the data, which can be modified in-place.
+    :param skip_empty: if True, patches which are entirely 0 are not predicted
+    :param weighting: weighting of the overlapping predictions, see patch_weights()
+    :return: array of the shape of data: prediction, averaged over the patches containing each voxel
+    """
+    patch_size = tuple(int(p) for p in patch_size)
+    step = tuple(int(s) for s in (step if step is not None else patch_size))
+    shape = data.shape
+
+    # pad the volume with zeros, so that the patches cover it entirely with a constant step
+    shape_padded = tuple(max(p, int(np.ceil((n - p) / s)) * s + p) for n, p, s in zip(shape, patch_size, step))
+    data_padded = np.zeros(shape_padded, dtype=np.float32)
+    data_padded[tuple(slice(0, n) for n in shape)] = data
+
+    # view of all the patches, of shape (nb patches along x, y, z) + patch_size
+    nb_patches = tuple((n - p) // s + 1 for n, p, s in zip(shape_padded, patch_size, step))
+    patches = as_strided(data_padded, shape=nb_patches + patch_size,
+                         strides=tuple(st * s for st, s in zip(data_padded.strides, step)) + data_padded.strides,
+                         writeable=False)
+    indexes = list(np.ndindex(*nb_patches))
+    if skip_empty:
+        indexes = [index for index in indexes if np.any(patches[index])]
+
+    weights = patch_weights(patch_size, weighting)
+    pred_sum = np.zeros(shape_padded, dtype=np.float32)
+    weight_sum = np.zeros(shape_padded, dtype=np.float32)
+    for i_batch in range(0, len(indexes), batch_size):
+        indexes_batch = indexes[i_batch:i_batch + batch_size]
+        batch = np.stack([patches[index] for index in indexes_batch])[:, np.newaxis]
+        if preprocess is not None:
+            batch = preprocess(batch)
+        pred_batch = model.predict(batch, batch_size=len(indexes_batch))
+        for index, pred in zip(indexes_batch, pred_batch):
+            region = tuple(slice(i * s, i * s + p) for i, s, p in zip(index, step, patch_size))
+            pred_sum[region] += pred[0] * weights
+            weight_sum[region] += weights
+    # voxels which are only in skipped patches have a prediction of 0
+    pred_sum /= np.maximum(weight_sum, np.finfo(np.float32).tiny)
+    return pred_sum[tuple(slice(0, n) for n in shape)]
@@ -27,6 +27,11 @@ from msct_types import Coordinate
 import sct_utils as sct
 
 
+# Process-wide default for the lazy, memory-mapped loading mode of Image (see Image.loadFromPath()).
+# Can be overridden per image with Image(path, mmap=True|False), or globally by setting SCT_IMAGE_MMAP=1
+MMAP_DEFAULT = os.environ.get("SCT_IMAGE_MMAP", "0") not in ("", "0")
+
+
 def _get_permutations(im_src_orientation, im_dst_orientation):
     """
     :return: list of axes permutations and list of inversions to achive an orientation change
@@ -46,6 +51,49 @@ def _get_permutations(im_src_orientation, im_dst_orientation):
     return perm, inversion
 
 
+def _reorient_data(data, perm, inversion):
+    """
+    :return: a view of data with flipped and transposed axes (no copy is performed)
+    :param perm: axes permutation, as returned by _get_permutations()
+    :param inversion: axes inversion, as returned by _get_permutations()
+    """
+
+    # axes inversion (flip)
+    data = data[::inversion[0], ::inversion[1], ::inversion[2]]
+
+    # axes manipulations (transpose)
+    if perm == [1, 0, 2]:
+        data = np.swapaxes(data, 0, 1)
+    elif perm == [2, 1, 0]:
+        data = np.swapaxes(data, 0, 2)
+    elif perm == [0, 2, 1]:
+        data = np.swapaxes(data, 1, 2)
+    elif perm == [2, 0, 1]:
+        data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
+        data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
+    elif perm == [1, 2, 0]:
+        data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
+        data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
+    elif perm == [0, 1, 2]:
+        # do nothing
+        pass
+    else:
+        raise NotImplementedError()
+
+    return data
+
+
+def _get_memmap_filename(data):
+    """
+    :return: path of the file backing data if it is (a view of) a memory map, None otherwise
+    """
+    while data is not None:
+        if isinstance(data, np.memmap) and getattr(data, "filename", None) is not None:
+            return data.filename
+        data = getattr(data, "base", None)
+    return None
+
+
 class Slicer(object):
     """
     Provides a sliced view onto original image data.
@@ -55,6 +103,8 @@ class Slicer(object):
 
     - The original image data is directly available without copy,
       which is a nice feature, not a bug! Use .copy() if you need copies...
+    - If the image was loaded with mmap=True, only the slices that are
+      accessed are read from disk.
 
     Example:
 
@@ -81,27 +131,7 @@ class Slicer(object):
 
         perm, inversion = _get_permutations(im.orientation, orientation)
 
-        # axes inversion (flip)
-        data = im.data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-        # axes manipulations (transpose)
-        if perm == [1, 0, 2]:
-            data = np.swapaxes(data, 0, 1)
-        elif perm == [2, 1, 0]:
-            data = np.swapaxes(data, 0, 2)
-        elif perm == [0, 2, 1]:
-            data = np.swapaxes(data, 1, 2)
-        elif perm == [2, 0, 1]:
-            data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-            data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-        elif perm == [1, 2, 0]:
-            data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-            data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-        elif perm == [0, 1, 2]:
-            # do nothing
-            pass
-        else:
-            raise NotImplementedError()
+        data = _reorient_data(im.data, perm, inversion)
 
         self._data = data
         self._orientation = orientation
@@ -131,6 +161,9 @@ class SlicerOneAxis(object):
     its specification.
 
     Can help getting ranges and slice indices.
+
+    As with Slicer, the slices are views onto the image data, so iterating
+    through a memory-mapped image only reads the slices that are accessed.
     """
 
     def __init__(self, im, axis="IS"):
@@ -211,12 +244,17 @@ class Image(object):
 
     """
 
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None, verbose=1, mmap=None):
+        """
+        :param mmap: when loading from a file, whether to use the lazy, memory-mapped mode (see loadFromPath()).
+                     If None, MMAP_DEFAULT is used.
+        """
         from nibabel import Nifti1Header
 
         # initialization of all parameters
         self.im_file = None
-        self.data = None
+        self._data = None
+        self._dataobj = None
         self._path = None
         self.ext = ""
 
@@ -232,7 +270,7 @@ class Image(object):
 
         # load an image from file
         if isinstance(param, str) or (sys.hexversion < 0x03000000 and isinstance(param, unicode)):
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, mmap=mmap)
         # copy constructor
         elif isinstance(param, type(self)):
             self.copy(param)
@@ -248,6 +286,24 @@ class Image(object):
             raise TypeError('Image constructor takes at least one argument.')
 
 
+    @property
+    def data(self):
+        """
+        Image data (numpy array).
+
+        If the image was loaded lazily (mmap=True), the data is only read
+        (or memory-mapped) on first access.
+        """
+        if self._data is None and self._dataobj is not None:
+            self._data = np.asanyarray(self._dataobj)
+            self._dataobj = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._dataobj = None
+
     @property
     def dim(self):
         return get_dimension(self)
@@ -307,24 +363,40 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, mmap=None):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param mmap: whether to use the lazy, memory-mapped mode. If None, MMAP_DEFAULT is used.
+                     In this mode, the data is only read when it is first accessed, and uncompressed (.nii)
+                     files that don't need intensity scaling are memory-mapped (copy-on-write), so that only
+                     the parts of the array which are actually used are loaded in RAM.
+                     Compressed files can't be memory-mapped, and are read entirely on first access.
         :return:
         """
 
+        if mmap is None:
+            mmap = MMAP_DEFAULT
+
         try:
-            self.im_file = nibabel.load(path)
+            if mmap:
+                self.im_file = nibabel.load(path, mmap='c')
+            else:
+                self.im_file = nibabel.load(path)
         except nibabel.spatialimages.ImageFileError:
             sct.printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.data = self.im_file.get_data()
+        if mmap:
+            self._data = None
+            self._dataobj = self.im_file.dataobj
+        else:
+            self.data = self.im_file.get_data()
         self.hdr = self.im_file.get_header()
         self.absolutepath = path
+        shape = self.hdr.get_data_shape()
         if path != self.absolutepath:
-            sct.log.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.data.shape)
+            sct.log.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, shape)
         else:
-            sct.log.debug("Loaded %s orientation %s shape %s", path, self.orientation, self.data.shape)
+            sct.log.debug("Loaded %s orientation %s shape %s", path, self.orientation, shape)
 
 
     def change_shape(self, shape, generate_path=False):
@@ -442,9 +514,16 @@ class Image(object):
         if hdr:
             hdr.set_data_shape(data.shape)
 
-        # nb. that copy() is important because if it were a memory map, save()
-        # would corrupt it
-        img = Nifti1Image(data.copy(), None, hdr)
+        # nb. if the data is memory-mapped from the file we are about to overwrite,
+        # it must be copied, otherwise save() would corrupt it
+        memmap_filename = _get_memmap_filename(data)
+        if memmap_filename is not None and os.path.exists(path) \
+         and os.path.realpath(memmap_filename) == os.path.realpath(path):
+            data = data.copy()
+            if dtype is None:
+                # the memory map is about to become invalid
+                self.data = data
+        img = Nifti1Image(data, None, hdr)
         if os.path.isfile(path):
             sct.printv('WARNING: File ' + path + ' already exists. Will overwrite it.', verbose, 'warning')
 
@@ -851,6 +930,23 @@ def orientation_string_nib2sct(s):
 orientation_string_sct2nib = orientation_string_nib2sct
 
 
+def _copy_without_data(im_src):
+    """
+    :return: a copy of an image that shares its data array (and nibabel file object) with the source,
+             meant to be used by functions that replace the data with a view of the source data
+             (so that this view doesn't need a full copy of the array to be made beforehand).
+
+    Notes:
+
+    - the resulting image has no path
+    """
+    from copy import copy
+    im_dst = copy(im_src)
+    im_dst.hdr = im_src.hdr.copy()
+    im_dst._path = None
+    return im_dst
+
+
 def change_shape(im_src, shape, im_dst=None):
     """
     :return: an image with changed shape
@@ -862,8 +958,7 @@ def change_shape(im_src, shape, im_dst=None):
     """
 
     if im_dst is None:
-        im_dst = im_src.copy()
-        im_dst._path = None
+        im_dst = _copy_without_data(im_src)
 
     if im_src.data.flags.f_contiguous:
         im_dst.data = im_src.data.reshape(shape, order="F")
@@ -912,36 +1007,14 @@ def change_orientation(im_src, orientation, im_dst=None, inverse=False):
     perm, inversion = _get_permutations(im_src_orientation, im_dst_orientation)
 
     if im_dst is None:
-        im_dst = im_src.copy()
-        im_dst._path = None
+        im_dst = _copy_without_data(im_src)
 
     im_src_data = im_src.data
     if len(im_src_data.shape) < 3:
         im_src_data = im_src_data.reshape(tuple(list(im_src_data.shape) + ([1]*(3-len(im_src_data.shape)))))
 
-    # Update data by performing inversions and swaps
-
-    # axes inversion (flip)
-    data = im_src_data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-    # axes manipulations (transpose)
-    if perm == [1, 0, 2]:
-        data = np.swapaxes(data, 0, 1)
-    elif perm == [2, 1, 0]:
-        data = np.swapaxes(data, 0, 2)
-    elif perm == [0, 2, 1]:
-        data = np.swapaxes(data, 1, 2)
-    elif perm == [2, 0, 1]:
-        data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-        data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-    elif perm == [1, 2, 0]:
-        data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-        data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-    elif perm == [0, 1, 2]:
-        # do nothing
-        pass
-    else:
-        raise NotImplementedError()
+    # Update data by performing inversions and swaps (this is a view, so memory-mapped data stays on disk)
+    data = _reorient_data(im_src_data, perm, inversion)
 
 
     # Update header
@@ -1152,7 +1225,8 @@ def spatial_crop(im_src, spec, im_dst=None):
     new_img = nibabel.Nifti1Image(new_data, new_aff, im_src.header)
 
     if im_dst is None:
-        im_dst = im_src.copy()
+        im_dst = _copy_without_data(im_src)
+        im_dst._path = im_src._path
 
     im_dst.header = new_img.header
     im_dst.data = new_data
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# In-process registry of loaded deep learning models (e.g. for sct_deepseg_sc, sct_deepseg_lesion, sct_deepseg_gm).
+#
+# Building a Keras architecture and loading its weights takes several seconds, so that each model is only loaded once
+# per process and then shared by all the subsequent segmentations (e.g. when a pipeline processes many subjects in the
+# same worker). The models are identified by a key describing how they were built (file name, contrast, kernel, input
+# size...). The memory used by the loaded models is limited to $SCT_MODEL_REGISTRY_MAX_MEMORY MB (default: 2000, 0
+# disables the registry): when it is exceeded, the least recently used models are released.
+
+from __future__ import absolute_import, division
+
+import os, threading
+from collections import OrderedDict
+
+from sct_utils import log
+
+MODEL_REGISTRY_MAX_MEMORY = float(os.environ.get("SCT_MODEL_REGISTRY_MAX_MEMORY", 2000))  # in MB
+
+
+def model_size(model):
+    """
+    :return: int: memory used by the weights of a model, in bytes (float32 weights are assumed). 0 if unknown.
+    """
+    try:
+        return int(model.count_params()) * 4
+    except AttributeError:
+        return 0
+
+
+class ModelRegistry(object):
+    """
+    Registry of loaded models, see module description.
+
+    Example:
+    registry = ModelRegistry()
+    model = registry.get(('deepseg_sc_3d', fname_model), lambda: load_trained_model(fname_model))
+    """
+    def __init__(self, max_memory=None):
+        """
+        :param max_memory: maximum memory used by the models, in MB. Default: MODEL_REGISTRY_MAX_MEMORY
+        """
+        self.max_memory = max_memory if max_memory is not None else MODEL_REGISTRY_MAX_MEMORY
+        # key -> (model, size in bytes), from the least to the most recently used model
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_memory > 0
+
+    @property
+    def memory(self):
+        """Memory used by the registered models, in bytes."""
+        return sum(size for _, size in self.models.values())
+
+    def get(self, key, loader):
+        """
+        Get a model, loading it if it is not registered yet.
+
+        :param key: hashable key identifying the model
+        :param loader: function without argument which loads the model
+        :return: model
+        """
+        if not self.enabled:
+            return loader()
+        with self.lock:
+            if key in self.models:
+                # mark the model as recently used
+                model, size = self.models.pop(key)
+                self.models[key] = (model, size)
+                return model
+            log.debug('Loading model %s', key)
+            model = loader()
+            self.models[key] = (model, model_size(model))
+            self.evict(keep=key)
+            return model
+
+    def evict(self, keep=None):
+        """
+        Release the least recently used models until the memory is below max_memory.
+
+        :param keep: key of a model that must not be released
+        """
+        for key in list(self.models):
+            if self.memory <= self.max_memory * 1024 * 1024:
+                break
+            if key == keep:
+                continue
+            log.debug('Releasing model %s', key)
+            del self.models[key]
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+# registry shared by all the tools of the process
+registry = ModelRegistry()
+
+
+def get_model(key, loader):
+    """
+    Get a model from the registry of the process, see ModelRegistry.get().
+    """
+    return registry.get(key, loader)
@@ -4,8 +4,6 @@
 
 from __future__ import absolute_import
 
-import os, math
-
 import numpy as np
 
 import sct_utils as sct
@@ -25,7 +23,7 @@ OUTPUT_ANGLE_VOLUME = 0
 
 
 def compute_csa(segmentation, algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True,
-                use_phys_coord=True, remove_temp_files=1, verbose=1):
+                use_phys_coord=True, centerline=None, remove_temp_files=1, verbose=1):
     """
     Compute CSA.
     Note: segmentation can be binary or weighted for partial volume effect.
@@ -35,18 +33,15 @@ def compute_csa(segmentation, algo_fitting='hanning', type_window='hanning', win
     :param window_length:
     :param angle_correction:
     :param use_phys_coord:
+    :param centerline: Centerline: precomputed centerline of the segmentation (in RPI orientation). Its points and
+    derivatives are expected in physical coordinates if use_phys_coord=True, and in (fitted) voxel coordinates
+    otherwise. If None, the centerline is fitted on the segmentation.
+    :param remove_temp_files: kept for backward compatibility: no temporary file is created anymore.
     :return metrics: Dict of class process_seg.Metric()
     """
-    # create temporary folder
-    path_tmp = sct.tmp_create()
-    # open image and save in temp folder
-    im_seg = msct_image.Image(segmentation).save(path_tmp, )
-
-    # change orientation to RPI
-    im_seg.change_orientation('RPI')
+    # open image (a copy is made if segmentation is an Image, so that the input is not reoriented)
+    im_seg = msct_image.Image(segmentation).change_orientation('RPI')
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
-    fname_seg = os.path.join(path_tmp, 'segmentation_RPI.nii.gz')
-    im_seg.save(fname_seg)
 
     # Extract min and max index in Z direction
     data_seg = im_seg.data
@@ -57,13 +52,14 @@ def compute_csa(segmentation, algo_fitting='hanning', type_window='hanning', win
     # Note: even if angle_correction=0, we should run the code below so that z_centerline_voxel is defined (later used
     # with option -vert). See #1791
     if use_phys_coord:
-        # fit centerline, smooth it and return the first derivative (in physical space)
-        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = \
-            smooth_centerline(fname_seg, algo_fitting=algo_fitting, type_window=type_window,
-                              window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True,
-                              verbose=verbose, all_slices=False)
-        centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv,
-                                y_centerline_deriv, z_centerline_deriv)
+        if centerline is None:
+            # fit centerline, smooth it and return the first derivative (in physical space)
+            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, \
+            z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window,
+                                                   window_length=window_length, nurbs_pts_number=3000,
+                                                   phys_coordinates=True, verbose=verbose, all_slices=False)
+            centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv,
+                                    y_centerline_deriv, z_centerline_deriv)
 
         # average centerline coordinates over slices of the image
         x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr, x_centerline_deriv_rescorr, \
@@ -73,17 +69,23 @@ def compute_csa(segmentation, algo_fitting='hanning', type_window='hanning', win
         axis_X, axis_Y, axis_Z = im_seg.get_directions()
 
     else:
-        # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
-        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = \
-            smooth_centerline(fname_seg, algo_fitting=algo_fitting, type_window=type_window,
-                              window_length=window_length,
-                              nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
+        if centerline is None:
+            # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
+            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, \
+            z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window,
+                                                   window_length=window_length, nurbs_pts_number=3000,
+                                                   phys_coordinates=False, verbose=verbose, all_slices=True)
+        else:
+            x_centerline_fit, y_centerline_fit, z_centerline = np.asarray(centerline.points, dtype=np.double).T
+            x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = \
+                np.asarray(centerline.derivatives, dtype=np.double).T
 
         # correct centerline fitted coordinates according to the data resolution
         x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr, \
         x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr = \
-            x_centerline_fit * px, y_centerline_fit * py, z_centerline * pz, \
-            x_centerline_deriv * px, y_centerline_deriv * py, z_centerline_deriv * pz
+            np.asarray(x_centerline_fit) * px, np.asarray(y_centerline_fit) * py, np.asarray(z_centerline) * pz, \
+            np.asarray(x_centerline_deriv) * px, np.asarray(y_centerline_deriv) * py, \
+            np.asarray(z_centerline_deriv) * pz
 
         axis_Z = [0.0, 0.0, 1.0]
 
@@ -91,41 +93,38 @@ def compute_csa(segmentation, algo_fitting='hanning', type_window='hanning', win
     sct.printv('\nCompute CSA...', verbose)
 
     # Initialize 1d array with nan. Each element corresponds to a slice.
-    csa = np.full_like(np.empty(nz), np.nan, dtype=np.double)
-    angles = np.full_like(np.empty(nz), np.nan, dtype=np.double)
-
-    for iz in range(min_z_index, max_z_index + 1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities),
-            # display a warning but do not crash
-            try:
-                # normalize the tangent vector to the centerline (i.e. its derivative)
-                tangent_vect = normalize(np.array(
-                    [x_centerline_deriv_rescorr[iz - min_z_index], y_centerline_deriv_rescorr[iz - min_z_index],
-                     z_centerline_deriv_rescorr[iz - min_z_index]]))
-
-            except IndexError:
-                sct.printv(
-                    'WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the '
-                    'problematic slices. Please check it, especially at the extremities.',
-                    type='warning')
-
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.vdot(tangent_vect, axis_Z))
-        else:
-            angle = 0.0
-
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
+    csa = np.full(nz, np.nan, dtype=np.double)
+    angles = np.full(nz, np.nan, dtype=np.double)
+
+    slices = slice(min_z_index, max_z_index + 1)
+
+    if angle_correction:
+        # tangent vectors to the centerline (i.e. its derivative), one column per slice
+        tangent_vect = np.array([x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr],
+                                dtype=np.double)
+        index = np.arange(max_z_index - min_z_index + 1)
+        # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities),
+        # display a warning but do not crash: slices without centerline reuse the last available tangent vector
+        if index[-1] >= tangent_vect.shape[1]:
+            sct.printv(
+                'WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the '
+                'problematic slices. Please check it, especially at the extremities.',
+                type='warning')
+            index = np.minimum(index, tangent_vect.shape[1] - 1)
+        # normalize the tangent vectors
+        tangent_vect = tangent_vect[:, index]
+        tangent_vect /= np.linalg.norm(tangent_vect, axis=0)
+        # compute the angle between the normal vector of the plane and the vector z
+        angle = np.arccos(np.dot(np.asarray(axis_Z, dtype=np.double), tangent_vect))
+    else:
+        angle = np.zeros(max_z_index - min_z_index + 1)
 
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz] = number_voxels * px * py * np.cos(angle)
-        angles[iz] = math.degrees(angle)
+    # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
+    number_voxels = np.sum(data_seg[:, :, slices], axis=(0, 1))
 
-    # Remove temporary files
-    if remove_temp_files:
-        sct.printv('\nRemove temporary files...')
-        sct.rmtree(path_tmp)
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    csa[slices] = number_voxels * px * py * np.cos(angle)
+    angles[slices] = np.degrees(angle)
 
     # prepare output
     metrics = {'csa': Metric(data=csa, label='CSA [mm^2]'),
@@ -10,7 +10,14 @@ import logging
 import warnings
 import datetime
 import io
-from string import Template
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 warnings.filterwarnings("ignore")
 
@@ -20,6 +27,8 @@ import skimage
 import skimage.io
 import skimage.exposure
 
+import PIL.Image
+
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.colorbar as colorbar
@@ -30,6 +39,11 @@ import sct_utils as sct
 
 logger = logging.getLogger("sct.{}".format(__file__))
 
+# results of a QC folder, loaded by its index.html (see append_result()), and their format in older versions
+QC_RESULTS = 'qc_results.js'
+QC_RESULTS_LEGACY = 'qc_results.json'
+_RESULT_FORMAT = 'sct_data.push({});\n'
+
 
 class QcImage(object):
     """
@@ -63,6 +77,8 @@ class QcImage(object):
                      "#7d0434", "#fb1849", "#14aab4",
                      "#a22abd", "#d58240", "#ac2aff"]
     _seg_colormap = plt.cm.autumn
+    # actions which are rendered with numpy, with the colormap given by the method _<action>_colormap()
+    _colormap_actions = ('listed_seg', 'template', 'no_seg_seg', 'sequential_seg')
 
     def __init__(self, qc_report, interpolation, action_list, stretch_contrast=True):
         """
@@ -89,20 +105,21 @@ class QcImage(object):
     """
 
     def listed_seg(self, mask):
+        self._imshow(*self._listed_seg_colormap(mask), alpha=1)
+
+    def _listed_seg_colormap(self, mask):
         img = np.rint(np.ma.masked_where(mask < 1, mask))
-        fig = plt.imshow(img,
-                         cmap=color.ListedColormap(self._labels_color),
-                         norm=color.Normalize(vmin=0, vmax=len(self._labels_color)),
-                         interpolation=self.interpolation,
-                         alpha=1,
-                         aspect=float(self.aspect_mask))
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return (img,
+                color.ListedColormap(self._labels_color),
+                color.Normalize(vmin=0, vmax=len(self._labels_color)))
 
     def template(self, mask):
         """
         Show template statistical atlas
         """
+        self._imshow(*self._template_colormap(mask))
+
+    def _template_colormap(self, mask):
         values = mask
         values[values < 0.5] = 0
         color_white = color.colorConverter.to_rgba('white', alpha=0.0)
@@ -110,30 +127,30 @@ class QcImage(object):
         color_cyan = color.colorConverter.to_rgba('cyan', alpha=0.8)
         cmap = color.LinearSegmentedColormap.from_list('cmap_atlas',
                                                        [color_white, color_blue, color_cyan], N=256)
-
-        fig = plt.imshow(values,
-                         cmap=cmap,
-                         interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
-
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return values, cmap, color.Normalize()
 
     def no_seg_seg(self, mask):
+        self._imshow(*self._no_seg_seg_colormap(mask))
+
+    def _no_seg_seg_colormap(self, mask):
         values = np.ma.masked_equal(np.rint(mask), 0)
-        fig = plt.imshow(values,
-                         cmap=plt.cm.gray,
-                         interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return values, plt.cm.gray, color.Normalize()
 
     def sequential_seg(self, mask):
+        self._imshow(*self._sequential_seg_colormap(mask))
+
+    def _sequential_seg_colormap(self, mask):
         values = np.ma.masked_equal(np.rint(mask), 0)
+        return values, self._seg_colormap, color.Normalize()
+
+    def _imshow(self, values, cmap, norm, alpha=None):
+        """Show the values of a mask in the current matplotlib figure. An empty Normalize() scales to the values"""
         fig = plt.imshow(values,
-                         cmap=self._seg_colormap,
+                         cmap=cmap,
+                         norm=norm,
                          interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
+                         alpha=alpha,
+                         aspect=float(self.aspect_mask))
         fig.axes.get_xaxis().set_visible(False)
         fig.axes.get_yaxis().set_visible(False)
 
@@ -176,53 +193,136 @@ class QcImage(object):
 
             img, mask = func(sct_slice, *args)
 
-            if self._stretch_contrast:
-                def equalized(a):
-                    """
-                    Perform histogram equalization using CLAHE
-
-                    Notes:
-
-                    - Image value range is preserved
-                    - Workaround for adapthist artifact by padding (#1664)
-                    """
-                    min_, max_ = a.min(), a.max()
-                    b = (np.float32(a) - min_) / (max_ - min_)
-                    b[b >= 1] = 1  # 1+eps numerical error may happen (#1691)
-
-                    h, w = b.shape
-                    h1 = (h + (8 - 1)) // 8 * 8
-                    w1 = (w + (8 - 1)) // 8 * 8
-                    if h != h1 or w != w1:
-                        b1 = np.zeros((h1, w1), dtype=b.dtype)
-                        b1[:h, :w] = b
-                        b = b1
-                    c = skimage.exposure.equalize_adapthist(b, kernel_size=(8, 8))
-                    if h != h1 or w != w1:
-                        c = c[:h, :w]
-                    return np.array(c * (max_ - min_) + min_, dtype=a.dtype)
-                img = equalized(img)
+            # the built-in actions are rendered with numpy, the other ones (e.g. custom hooks drawing on the
+            # current figure) need matplotlib
+            if all(action.__name__ in self._colormap_actions for action in self.action_list):
+                self._render(img, mask, aspect_img)
+            else:
+                self._render_matplotlib(img, mask, aspect_img)
 
-            plt.figure()
-            fig = plt.imshow(img, cmap=plt.cm.gray, interpolation=self.interpolation, aspect=float(aspect_img))
-            fig.axes.get_xaxis().set_visible(False)
-            fig.axes.get_yaxis().set_visible(False)
-            self._save(self.qc_report.qc_params.abs_bkg_img_path(), dpi=self.qc_report.qc_params.dpi)
+            self.qc_report.update_description_file(img.shape)
+
+        return wrapped_f
+
+    @staticmethod
+    def _equalized(a):
+        """
+        Perform histogram equalization using CLAHE
 
+        Notes:
+
+        - Image value range is preserved
+        - Workaround for adapthist artifact by padding (#1664)
+        """
+        min_, max_ = a.min(), a.max()
+        b = (np.float32(a) - min_) / (max_ - min_)
+        b[b >= 1] = 1  # 1+eps numerical error may happen (#1691)
+
+        h, w = b.shape
+        h1 = (h + (8 - 1)) // 8 * 8
+        w1 = (w + (8 - 1)) // 8 * 8
+        if h != h1 or w != w1:
+            b1 = np.zeros((h1, w1), dtype=b.dtype)
+            b1[:h, :w] = b
+            b = b1
+        c = skimage.exposure.equalize_adapthist(b, kernel_size=(8, 8))
+        if h != h1 or w != w1:
+            c = c[:h, :w]
+        return np.array(c * (max_ - min_) + min_, dtype=a.dtype)
+
+    def _render(self, img, mask, aspect_img):
+        """
+        Render the background and the overlay of the built-in actions without matplotlib figure: the colormaps are
+        applied on the arrays, which are resampled to their displayed size and written straight to PNG files. The
+        background and the overlay are rendered in parallel.
+
+        :param img: 2D array: background
+        :param mask: 2D array: mask shown by the actions
+        :param aspect_img: float: aspect ratio (height/width) of the pixels of the background
+        """
+        # output pixels per input pixel (in width), so that the resolution matches the one of the matplotlib figures
+        zoom = self.qc_report.qc_params.dpi / 100.
+
+        def render_background():
+            bkg = self._equalized(img) if self._stretch_contrast else img
+            rgba = plt.cm.gray(color.Normalize()(bkg), bytes=True)
+            self._save_rgba(self.qc_report.qc_params.abs_bkg_img_path(), self._resampled(rgba, aspect_img, zoom))
+
+        def render_overlay():
+            # as with the matplotlib figures, each action overwrites the overlay of the previous one: only the last
+            # one is shown
+            overlay, values = None, mask
             for action in self.action_list:
                 logger.debug('Action List %s', action.__name__)
-                plt.clf()
-                plt.figure()
                 if self._stretch_contrast and action.__name__ in ("no_seg_seg",):
-                    print("Mask type %s" % mask.dtype)
-                    mask = equalized(mask)
-                action(self, mask)
-                self._save(self.qc_report.qc_params.abs_overlay_img_path(), dpi=self.qc_report.qc_params.dpi)
-            plt.close()
+                    logger.debug('Mask type %s', values.dtype)
+                    values = self._equalized(values)
+                overlay = getattr(self, '_{}_colormap'.format(action.__name__))(values)
+            if overlay is not None:
+                values_action, cmap, norm = overlay
+                self._save_rgba(self.qc_report.qc_params.abs_overlay_img_path(),
+                                self._resampled(cmap(norm(values_action), bytes=True), self.aspect_mask, zoom))
+
+        pool = ThreadPool(2)
+        try:
+            results = [pool.apply_async(render) for render in (render_background, render_overlay)]
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def _render_matplotlib(self, img, mask, aspect_img):
+        """
+        Render the background and the overlay of the actions in matplotlib figures, see _render() for the parameters
+        """
+        if self._stretch_contrast:
+            img = self._equalized(img)
 
-            self.qc_report.update_description_file(img.shape)
+        plt.figure()
+        fig = plt.imshow(img, cmap=plt.cm.gray, interpolation=self.interpolation, aspect=float(aspect_img))
+        fig.axes.get_xaxis().set_visible(False)
+        fig.axes.get_yaxis().set_visible(False)
+        self._save(self.qc_report.qc_params.abs_bkg_img_path(), dpi=self.qc_report.qc_params.dpi)
 
-        return wrapped_f
+        for action in self.action_list:
+            logger.debug('Action List %s', action.__name__)
+            plt.clf()
+            plt.figure()
+            if self._stretch_contrast and action.__name__ in ("no_seg_seg",):
+                logger.debug('Mask type %s', mask.dtype)
+                mask = self._equalized(mask)
+            action(self, mask)
+            self._save(self.qc_report.qc_params.abs_overlay_img_path(), dpi=self.qc_report.qc_params.dpi)
+        plt.close()
+
+    @staticmethod
+    def _resampled(rgba, aspect, zoom):
+        """
+        Nearest-neighbour resampling of an image to its displayed size
+
+        :param rgba: array of shape (h, w, 4)
+        :param aspect: float: aspect ratio (height/width) of the pixels
+        :param zoom: float: output pixels per input pixel in width
+        :return: array of shape (~h * aspect * zoom, ~w * zoom, 4)
+        """
+        h, w = rgba.shape[:2]
+        h_out, w_out = max(1, int(round(h * aspect * zoom))), max(1, int(round(w * zoom)))
+        rows = np.minimum(((np.arange(h_out) + 0.5) * h / h_out).astype(int), h - 1)
+        cols = np.minimum(((np.arange(w_out) + 0.5) * w / w_out).astype(int), w - 1)
+        return rgba[np.ix_(rows, cols)]
+
+    @staticmethod
+    def _save_rgba(img_path, rgba, compress_level=1):
+        """
+        Save a RGBA image into a .png file.
+        :param img_path: str: path of the image
+        :param rgba: uint8 array of shape (h, w, 4)
+        :param compress_level: int: zlib compression level (0-9). The upsampled images compress well even at low levels,
+                               which are much faster
+        """
+        logger.debug('Save image %s', img_path)
+        PIL.Image.fromarray(rgba, 'RGBA').save(img_path, format='png', compress_level=compress_level)
 
     def _save(self, img_path, format='png', bbox_inches='tight', pad_inches=0.00, dpi=300):
         """
@@ -278,7 +378,7 @@ class Params(object):
         self.dpi = dpi
         self.root_folder = dest_folder
         self.mod_date = datetime.datetime.strftime(datetime.datetime.now(), '%Y_%m_%d_%H%M%S')
-        self.qc_results = os.path.join(dest_folder, 'qc_results.json')
+        self.qc_results = os.path.join(dest_folder, QC_RESULTS)
         self.bkg_img_path = os.path.join(subject, contrast, command, self.mod_date, 'bkg_img.png')
         self.overlay_img_path = os.path.join(subject, contrast, command, self.mod_date, 'overlay_img.png')
 
@@ -328,7 +428,8 @@ class QcReport(object):
                 raise err
 
     def update_description_file(self, dimension):
-        """Create the description file with a JSON structure
+        """Append the description of the QC entry to the results of the QC folder (see append_result()), and write
+        index.html and its assets if they are missing
 
         :param: dimension 2-tuple, the dimension of the image frame (w, h)
         """
@@ -349,23 +450,16 @@ class QcReport(object):
             'moddate': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         logger.debug('Description file: %s', self.qc_params.qc_results)
-        results = []
-        if os.path.isfile(self.qc_params.qc_results):
-            results = json.load(open(self.qc_params.qc_results, 'r'))
-        results.append(output)
-        json.dump(results, open(self.qc_params.qc_results, "w"), indent=2)
-        self._update_html_assets(results)
-
-    def _update_html_assets(self, json_data):
+        created = append_result(self.qc_params.root_folder, output)
+        # index.html loads the results when it is opened, so that it does not change with the entries
+        if created or not os.path.isfile(os.path.join(self.qc_params.root_folder, 'index.html')):
+            self._update_html_assets()
+
+    def _update_html_assets(self):
         """Update the html file and assets"""
         assets_path = os.path.join(os.path.dirname(__file__), 'assets')
         dest_path = self.qc_params.root_folder
 
-        with io.open(os.path.join(assets_path, 'index.html')) as template_index:
-            template = Template(template_index.read())
-            output = template.substitute(sct_json_data=json.dumps(json_data))
-            io.open(os.path.join(dest_path, 'index.html'), 'w').write(output)
-
         for path in ['css', 'js', 'imgs', 'fonts']:
             src_path = os.path.join(assets_path, '_assets', path)
             dest_full_path = os.path.join(dest_path, '_assets', path)
@@ -376,6 +470,65 @@ class QcReport(object):
                     sct.copy(os.path.join(src_path, file_),
                              dest_full_path)
 
+        # written last and renamed, so that other processes never see a partial index.html
+        fd, path_tmp = tempfile.mkstemp(prefix='.index', suffix='.html', dir=dest_path)
+        os.close(fd)
+        shutil.copyfile(os.path.join(assets_path, 'index.html'), path_tmp)
+        os.chmod(path_tmp, 0o644)
+        os.rename(path_tmp, os.path.join(dest_path, 'index.html'))
+
+
+def append_result(path_qc, result):
+    """
+    Append the description of a QC entry to the results of a QC folder (file QC_RESULTS, a script adding the
+    entries to the sct_data list shown by index.html, one line per entry).
+
+    The results are only appended to, under an exclusive file lock, so that the processes writing to the same QC
+    folder (e.g. sct_pipeline running subjects in parallel) do not lose entries, and so that writing an entry costs the
+    same whatever the number of entries. The results of QC folders created by older versions (QC_RESULTS_LEGACY) are
+    converted when the first entry is appended.
+
+    :param path_qc: str: QC folder
+    :param result: dict: description of the entry
+    :return: bool: True if the results were created (or converted) by this entry
+    """
+    fname = os.path.join(path_qc, QC_RESULTS)
+    fname_legacy = os.path.join(path_qc, QC_RESULTS_LEGACY)
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        created = os.fstat(fd).st_size == 0
+        results = [result]
+        if created and os.path.isfile(fname_legacy):
+            with io.open(fname_legacy, 'r') as f:
+                results = json.load(f) + results
+        data = ''.join(_RESULT_FORMAT.format(json.dumps(x)) for x in results).encode('utf-8')
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        # also releases the lock
+        os.close(fd)
+    return created
+
+
+def load_results(path_qc):
+    """
+    :param path_qc: str: QC folder
+    :return: list of the descriptions (dict) of the QC entries of the folder, see append_result()
+    """
+    fname = os.path.join(path_qc, QC_RESULTS)
+    if not os.path.isfile(fname):
+        fname_legacy = os.path.join(path_qc, QC_RESULTS_LEGACY)
+        if os.path.isfile(fname_legacy):
+            with io.open(fname_legacy, 'r') as f:
+                return json.load(f)
+        return []
+    prefix, suffix = _RESULT_FORMAT.split('{}')
+    with io.open(fname, 'r') as f:
+        # a line being appended by another process may be incomplete
+        return [json.loads(line[len(prefix):-len(suffix)]) for line in f if line.endswith(suffix)]
+
 
 def add_entry(src, process, args, path_qc, plane, background=None, foreground=None,
               qcslice=None,
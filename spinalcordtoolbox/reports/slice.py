@@ -10,7 +10,6 @@ import logging
 import math
 
 import numpy as np
-from scipy import ndimage
 
 from .. import image as msct_image
 
@@ -48,6 +47,10 @@ class Slice(object):
     def axial_slice(data, i):
         return data[i, :, :]
 
+    @staticmethod
+    def axial_slices(data):
+        return data
+
     @staticmethod
     def axial_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -62,6 +65,10 @@ class Slice(object):
     def sagittal_slice(data, i):
         return data[:, :, int(i)]
 
+    @staticmethod
+    def sagittal_slices(data):
+        return np.moveaxis(data, 2, 0)
+
     @staticmethod
     def sagittal_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -76,6 +83,10 @@ class Slice(object):
     def coronal_slice(data, i):
         return data[:, i, :]
 
+    @staticmethod
+    def coronal_slices(data):
+        return np.moveaxis(data, 1, 0)
+
     @staticmethod
     def coronal_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -124,6 +135,32 @@ class Slice(object):
 
         return matrix[start_row:end_row, start_col:end_col]
 
+    @staticmethod
+    def crop_all(slices, centers_x, centers_y, width, height):
+        """Crops all the slices at once, around their respective centers, as crop() does for one slice
+
+        The parts of the crop areas which are outside of the slices are filled with zeros.
+
+        :param slices: 3D array, of shape (number of slices, nx, ny)
+        :param centers_x: The centers of the crop areas in the x axis (one per slice)
+        :param centers_y: The centers of the crop areas in the y axis (one per slice)
+        :param width: The width from the center
+        :param height: The height from the center
+        :returns: array of cropped slices, of shape (number of slices, width * 2, height * 2)
+        """
+        nb_slices, nx, ny = slices.shape
+        width = min(width, nx // 2)
+        height = min(height, ny // 2)
+
+        rows = np.maximum(np.asarray(centers_x, dtype=int), width)[:, None] - width + np.arange(width * 2)
+        cols = np.maximum(np.asarray(centers_y, dtype=int), height)[:, None] - height + np.arange(height * 2)
+        inside = (rows < nx)[:, :, None] & (cols < ny)[:, None, :]
+
+        patches = slices[np.arange(nb_slices)[:, None, None],
+                         np.minimum(rows, nx - 1)[:, :, None],
+                         np.minimum(cols, ny - 1)[:, None, :]]
+        return np.where(inside, patches, 0)
+
     @staticmethod
     def add_slice(matrix, i, column, size, patch):
         """Adds a slice to the canvas containing all the slices
@@ -178,6 +215,15 @@ class Slice(object):
         """
         return
 
+    @abc.abstractmethod
+    def get_slices(self, data):
+        """Abstract method to obtain all the slices of a 3d matrix
+
+        :param data: volume
+        :return: 3D array (view of data), whose first axis is the slice position
+        """
+        return
+
     @abc.abstractmethod
     def get_dim(self, image):
         """Abstract method to obtain the depth of the 3d matrix.
@@ -194,12 +240,12 @@ class Slice(object):
         :returns: centers of mass in the x and y axis (tuple of numpy.ndarray of int)
             .
         """
-        axial_dim = self.axial_dim(image)
-        centers_x = np.zeros(axial_dim)
-        centers_y = np.zeros(axial_dim)
-        for i in range(axial_dim):
-            aslice = self.axial_slice(image.data, i)
-            centers_x[i], centers_y[i] = ndimage.measurements.center_of_mass(aslice)
+        data = np.asarray(self.axial_slices(image.data), dtype=np.float64)
+        total = data.sum(axis=(1, 2))
+        # slices without signal have a NaN center, as with scipy.ndimage.measurements.center_of_mass
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centers_x = data.sum(axis=2).dot(np.arange(data.shape[1])) / total
+            centers_y = data.sum(axis=1).dot(np.arange(data.shape[2])) / total
         try:
             Slice.nan_fill(centers_x)
             Slice.nan_fill(centers_y)
@@ -225,7 +271,7 @@ class Slice(object):
         if nb_column == 0:
             nb_column = 600 // (size * 2)
 
-        nb_row = math.ceil(dim // nb_column) + 1
+        nb_row = int(math.ceil(dim // nb_column) + 1)
 
         # Compute the matrix size of the final mosaic image
         matrix_sz = (int(size * 2 * nb_row), int(size * 2 * nb_column))
@@ -236,12 +282,12 @@ class Slice(object):
 
         matrices = list()
         for image in self._images:
-            matrix = np.zeros(matrix_sz)
-            for i in range(dim):
-                x = int(centers_x[i])
-                y = int(centers_y[i])
-                # crop slice around center of mass and add slice to the matrix layout
-                self.add_slice(matrix, i, nb_column, size, self.crop(self.get_slice(image.data, i), x, y, size, size))
+            # crop all the slices around their center of mass, and lay the patches out on a grid of
+            # nb_row x nb_column cells of size*2 x size*2 pixels (the patches are smaller when the slices are)
+            patches = self.crop_all(self.get_slices(image.data)[:dim], centers_x[:dim], centers_y[:dim], size, size)
+            cells = np.zeros((nb_row * nb_column, size * 2, size * 2))
+            cells[:dim, :patches.shape[1], :patches.shape[2]] = patches
+            matrix = cells.reshape(nb_row, nb_column, size * 2, size * 2).transpose(0, 2, 1, 3).reshape(matrix_sz)
 
             matrices.append(matrix)
 
@@ -284,6 +330,9 @@ class Axial(Slice):
     def get_slice(self, data, i):
         return self.axial_slice(data, i)
 
+    def get_slices(self, data):
+        return self.axial_slices(data)
+
     def get_dim(self, image):
         return self.axial_dim(image)
 
@@ -309,6 +358,9 @@ class Sagittal(Slice):
     def get_slice(self, data, i):
         return self.sagittal_slice(data, i)
 
+    def get_slices(self, data):
+        return self.sagittal_slices(data)
+
     def get_dim(self, image):
         return self.sagittal_dim(image)
 
@@ -336,6 +388,9 @@ class Coronal(Slice):
     def get_slice(self, data, i):
         return self.coronal_slice(data, i)
 
+    def get_slices(self, data):
+        return self.coronal_slices(data)
+
     def get_dim(self, image):
         return self.coronal_dim(image)
 
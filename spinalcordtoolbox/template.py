@@ -4,10 +4,111 @@
 
 from __future__ import absolute_import
 
+import io, hashlib, weakref
+from collections import OrderedDict
+
 import numpy as np
 
 from sct_utils import log
 
+# Number of vertebral labeling indexes kept in memory by get_vert_level_index()
+VERT_LEVEL_INDEX_CACHE_SIZE = 8
+_vert_level_index_cache = OrderedDict()
+# VertLevelIndex of each Image passed to get_slices_from_vertebral_levels() and get_vertebral_level_from_slice()
+_image_index_cache = weakref.WeakKeyDictionary()
+
+
+class VertLevelIndex(object):
+    """
+    Index of the vertebral level of each slice of a vertebral labeling image, and of the slices of each level.
+    The level of a slice is the average of its non-null and finite values, rounded to the closest integer.
+    Important: This class assumes that the 3rd dimension is Z.
+    """
+    def __init__(self, im_vertlevel):
+        """
+        :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
+        """
+        data = np.asarray(im_vertlevel.data)
+        data = data.reshape(-1, data.shape[-1])
+        mask = np.isfinite(data) & (data != 0)
+        count = mask.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean_per_slice = np.where(mask, data, 0).sum(axis=0) / count
+        # Vertebral level of each slice (None for slices without label)
+        self.level_per_slice = [int(np.round(self.mean_per_slice[iz])) if count[iz] else None
+                                for iz in range(data.shape[-1])]
+        # Slices of each vertebral level
+        self.slices_per_level = {}
+        for iz, level in enumerate(self.level_per_slice):
+            if level is not None:
+                self.slices_per_level.setdefault(level, []).append(iz)
+
+    def get_slices(self, level):
+        """
+        :param level: int: vertebral level
+        :return: list of int: slices
+        """
+        return list(self.slices_per_level.get(level, []))
+
+    def get_level(self, idx_slice):
+        """
+        :param idx_slice: int: slice (z)
+        :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
+        """
+        return self.level_per_slice[idx_slice]
+
+
+def get_vert_level_index(vert_level):
+    """
+    Get the VertLevelIndex of a vertebral labeling. Indexes are memoized by content, so that the labeling is only
+    scanned once when it is used several times (e.g. for each metric or label).
+    :param vert_level: Vertebral labeling. Could be either a VertLevelIndex, an Image or a file name. Images and files
+    are reoriented to RPI.
+    :return: VertLevelIndex
+    """
+    if isinstance(vert_level, VertLevelIndex):
+        return vert_level
+    from spinalcordtoolbox.image import Image
+    h = hashlib.md5()
+    if isinstance(vert_level, Image):
+        im_vertlevel = vert_level.copy().change_orientation('RPI')
+        data = np.ascontiguousarray(im_vertlevel.data)
+        h.update(str((data.shape, data.dtype.str)).encode())
+        h.update(data.view(np.uint8).reshape(-1))
+    else:
+        im_vertlevel = None
+        with io.open(vert_level, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    key = h.hexdigest()
+
+    if key in _vert_level_index_cache:
+        log.debug('Vertebral labeling index found in cache: %s', key)
+        index = _vert_level_index_cache.pop(key)
+    else:
+        if im_vertlevel is None:
+            im_vertlevel = Image(vert_level).change_orientation('RPI')
+        index = VertLevelIndex(im_vertlevel)
+    _vert_level_index_cache[key] = index
+    while len(_vert_level_index_cache) > VERT_LEVEL_INDEX_CACHE_SIZE:
+        _vert_level_index_cache.popitem(last=False)
+    return index
+
+
+def _get_image_index(im_vertlevel):
+    """
+    Get the VertLevelIndex of an image, computed the first time it is requested for this image. The index is computed
+    again if the data array of the image is replaced, but not if it is modified in-place.
+    :param im_vertlevel: image object of vertebral labeling
+    :return: VertLevelIndex
+    """
+    data, index = _image_index_cache.get(im_vertlevel, (None, None))
+    if data is not im_vertlevel.data:
+        index = VertLevelIndex(im_vertlevel)
+        _image_index_cache[im_vertlevel] = (im_vertlevel.data, index)
+    return index
+
+
 def get_slices_from_vertebral_levels(im_vertlevel, level):
     """
     Find the slices of the corresponding vertebral level.
@@ -16,21 +117,7 @@ def get_slices_from_vertebral_levels(im_vertlevel, level):
     :param level: int: vertebral level
     :return: list of int: slices
     """
-    data_vertlevel = im_vertlevel.data
-    slices = []
-    # loop across z
-    for iz in range(data_vertlevel.shape[-1]):
-        # fetch non-null and finite values
-        data_vertlevel_nonzero = data_vertlevel[..., iz].flatten()[np.nonzero(data_vertlevel[..., iz].flatten())]
-        data_vertlevel_nonzero_finite = [i for i in data_vertlevel_nonzero if np.isfinite(i)]
-        # avoid empty slice
-        if not data_vertlevel_nonzero_finite == []:
-            # average non-null values and round to closest
-            average_value = int(np.round(np.mean(data_vertlevel_nonzero_finite)))
-            # if that matches the desired level, append it to slice list
-            if average_value == level:
-                slices.append(iz)
-    return slices
+    return _get_image_index(im_vertlevel).get_slices(level)
 
 
 def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
@@ -41,15 +128,7 @@ def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
     :param idx_slice: int: slice (z)
     :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
     """
-    data_vertlevel = im_vertlevel.data
-    # average non-null values and round to closest
-    try:
-        # find indices of non-null values
-        indx, indy = np.where(data_vertlevel[:, :, idx_slice])
-        vert_level = int(np.round(np.mean(data_vertlevel[indx, indy, idx_slice])))
-    except ValueError as e:
-        # slice is empty (no indx found). Do nothing.
-        log.debug('Empty slice: z=%s (%s)', idx_slice, e)
-        vert_level = None
+    vert_level = _get_image_index(im_vertlevel).get_level(idx_slice)
+    if vert_level is None:
+        log.debug('Empty slice: z=%s', idx_slice)
     return vert_level
-
@@ -178,6 +178,72 @@ def test_extract_metric(dummy_data_and_labels):
     assert agg_metric[agg_metric.keys()[0]]['MAX()'] == 41.0
 
 
+def extract_metric_per_group(data, labels, label_struc, id_label, indiv_labels_ids, method, slicegroups):
+    """Estimation slicegroup by slicegroup with the func_* functions, as done by extract_metric() before
+    extract_metrics(). Values for which the estimation fails are set to None."""
+    funcs = {'wa': aggregate_slicewise.func_wa, 'bin': aggregate_slicewise.func_bin,
+             'ml': aggregate_slicewise.func_ml, 'map': aggregate_slicewise.func_map,
+             'max': aggregate_slicewise.func_max}
+    ids = [label_struc[id_label].id]
+    map_clusters = None
+    if method in ['ml', 'map']:
+        ids += aggregate_slicewise.diff_between_list_or_int(indiv_labels_ids, label_struc[id_label].id)
+        map_clusters = [label_struc[i].map_cluster for i in ids]
+    mask = Metric(data=labels[..., ids], label=label_struc[id_label].name)
+    group_funcs = ((method.upper(), funcs[method]),)
+    if method != 'max':
+        group_funcs += (('STD', aggregate_slicewise.func_std),)
+    agg_metric = dict((slicegroup, {}) for slicegroup in slicegroups)
+    for slicegroup in slicegroups:
+        for name, func in group_funcs:
+            try:
+                agg_metric[slicegroup].update(aggregate_slicewise.aggregate_per_slice_or_level(
+                    data, mask=mask, slices=list(slicegroup), perslice=False, group_funcs=((name, func),),
+                    map_clusters=map_clusters)[slicegroup])
+            except Exception:
+                agg_metric[slicegroup]['{}({})'.format(name, data.label)] = None
+    return agg_metric
+
+
+# noinspection 801,PyShadowingNames
+@pytest.mark.parametrize('method', ['wa', 'bin', 'ml', 'map', 'max'])
+def test_extract_metrics(dummy_data_and_labels, method):
+    """Test batched estimation across several metrics and labels, against the former estimation per slicegroup."""
+    data, labels, label_struc = dummy_data_and_labels
+    data_nan = data.data.copy()
+    data_nan[3] = np.nan
+    metrics = [Metric(data=data.data, label='m1'), Metric(data=data.data * 2 + 3, label='m2'),
+               Metric(data=data_nan, label='m3')]
+    for perslice, slicegroups in [(False, [(0, 1, 2, 3, 4)]), (True, [(z,) for z in range(5)])]:
+        agg_metrics = aggregate_slicewise.extract_metrics(metrics, labels=labels, label_struc=label_struc,
+                                                          ids_label=[0, 1, 2], indiv_labels_ids=[0, 1, 2],
+                                                          perslice=perslice, method=method)
+        for id_label in [0, 1, 2]:
+            assert sorted(agg_metrics[id_label].keys()) == slicegroups
+            for metric in metrics:
+                expected = extract_metric_per_group(Metric(data=metric.data.copy(), label=metric.label), labels,
+                                                    label_struc, id_label, [0, 1, 2], method, slicegroups)
+                for slicegroup in slicegroups:
+                    result = agg_metrics[id_label][slicegroup]
+                    for key, value in expected[slicegroup].items():
+                        if value is None:
+                            # e.g. weights summing to zero: the error message is reported instead of the value
+                            assert isinstance(result[key], str)
+                        elif isinstance(value, str):
+                            assert result[key] == value
+                        else:
+                            # STD is computed from the sums of squares: round-off error where it is close to 0
+                            assert result[key] == pytest.approx(value, abs=1e-5), (key, slicegroup, id_label)
+    # a few values worked out by hand
+    agg_metrics = aggregate_slicewise.extract_metrics(metrics, labels=labels, label_struc=label_struc,
+                                                      ids_label=[0, 1], perslice=True, method='wa')
+    assert agg_metrics[0][(3,)]['WA(m1)'] == 39.0
+    assert agg_metrics[0][(2,)]['WA(m2)'] == 63.0
+    assert agg_metrics[0][(0,)]['WA(m2)'] == "Weights sum to zero, can't be normalized"
+    assert agg_metrics[1][(0,)]['WA(m2)'] == 41.0
+    assert agg_metrics[0][(3,)]['WA(m3)'] == "Weights sum to zero, can't be normalized"
+
+
 # noinspection 801,PyShadowingNames
 def test_extract_metric_2d(dummy_data_and_labels_2d):
     """Test different estimation methods."""
@@ -249,3 +315,40 @@ def test_save_as_csv_extract_metric(dummy_data_and_labels):
         spamreader = csv.reader(csvfile, delimiter=',')
         spamreader.next()  # skip header
         assert spamreader.next()[1:-1] == [sct.__version__, '', '0:4', 'label_0', '2.5', '38.0']
+
+
+# noinspection 801,PyShadowingNames
+def test_vert_level_index(dummy_vert_level):
+    """Test indexing of vertebral labeling"""
+    from spinalcordtoolbox.template import VertLevelIndex, get_vert_level_index
+    vert_level_index = VertLevelIndex(dummy_vert_level)
+    assert vert_level_index.get_slices(3) == [2, 3]
+    assert vert_level_index.get_slices(7) == []
+    assert vert_level_index.get_level(8) == 6
+    assert vert_level_index.level_per_slice == [2, 2, 3, 3, 4, 4, 5, 5, 6]
+    # index is memoized by content
+    assert get_vert_level_index(dummy_vert_level) is get_vert_level_index(dummy_vert_level.copy())
+
+
+# noinspection 801,PyShadowingNames
+def test_vertebral_level_lookups(dummy_vert_level, monkeypatch):
+    """Test that the slice and level lookups only index each image once"""
+    from spinalcordtoolbox import template
+    indexed = []
+
+    class VertLevelIndex(template.VertLevelIndex):
+        def __init__(self, im_vertlevel):
+            indexed.append(im_vertlevel)
+            super(VertLevelIndex, self).__init__(im_vertlevel)
+    monkeypatch.setattr(template, 'VertLevelIndex', VertLevelIndex)
+
+    im_vert_level = dummy_vert_level.copy()
+    assert [template.get_vertebral_level_from_slice(im_vert_level, iz) for iz in range(9)] == \
+           [2, 2, 3, 3, 4, 4, 5, 5, 6]
+    assert [template.get_slices_from_vertebral_levels(im_vert_level, level) for level in [2, 3, 7]] == \
+           [[0, 1], [2, 3], []]
+    assert indexed == [im_vert_level]
+    # the index is computed again when the data of the image is replaced
+    im_vert_level.data = np.where(im_vert_level.data == 6, 5, im_vert_level.data)
+    assert template.get_vertebral_level_from_slice(im_vert_level, 8) == 5
+    assert len(indexed) == 2
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_analyze_texture
+
+from __future__ import print_function, absolute_import, division
+
+import pytest
+import numpy as np
+
+try:
+    from skimage.feature import greycomatrix, greycoprops
+except ImportError:  # renamed in scikit-image 0.19
+    from skimage.feature import graycomatrix as greycomatrix, graycoprops as greycoprops
+
+import sct_analyze_texture
+
+
+FEATURES = ['contrast', 'dissimilarity', 'homogeneity', 'energy', 'correlation', 'ASM']
+
+
+def compute_texture_slice_skimage(im_z, seg_z, distance, metric_lst, symmetric=True):
+    """Voxel by voxel computation with skimage, as done by sct_analyze_texture before compute_texture_slice()"""
+    dct_metric = dict((m, np.zeros(im_z.shape, dtype=np.float64)) for m in metric_lst)
+    for xx in range(distance, im_z.shape[0] - distance):
+        for yy in range(distance, im_z.shape[1] - distance):
+            if not seg_z[xx - distance: xx + distance + 1, yy - distance: yy + distance + 1].all():
+                continue
+            glcm_window = im_z[xx - distance: xx + distance + 1, yy - distance: yy + distance + 1].astype(np.uint8)
+            dct_glcm = {}
+            for a in set(m.split('_')[2] for m in metric_lst):
+                dct_glcm[a] = greycomatrix(glcm_window, [distance], [np.radians(int(a))], symmetric=symmetric,
+                                           normed=True)
+            for m in metric_lst:
+                dct_metric[m][xx, yy] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
+    return dct_metric
+
+
+@pytest.mark.parametrize('distance', [1, 2])
+@pytest.mark.parametrize('symmetric', [True, False])
+def test_compute_texture_slice(distance, symmetric):
+    rng = np.random.RandomState(0)
+    im_z = rng.randint(0, 256, size=(10, 9)).astype(np.float64)
+    # few grey levels, so that the (i, j) pairs are repeated, and a flat area for the special case of correlation
+    im_z[:5] = im_z[:5] // 64
+    im_z[6:, :6] = 7
+    if not symmetric:
+        # not constant along the columns: see compute_texture_slice() for the correlation of constant neighbours
+        im_z[6:, :6] += np.arange(6)
+    seg_z = np.ones(im_z.shape, dtype=bool)
+    seg_z[0, :] = seg_z[4, 4] = False
+    metric_lst = [feature + '_' + str(distance) + '_' + angle for feature in FEATURES for angle in ['0', '45', '90', '135']]
+
+    dct_metric = sct_analyze_texture.compute_texture_slice(im_z, seg_z, distance, metric_lst, symmetric=symmetric)
+    dct_metric_skimage = compute_texture_slice_skimage(im_z, seg_z, distance, metric_lst, symmetric=symmetric)
+    for m in metric_lst:
+        assert np.allclose(dct_metric[m], dct_metric_skimage[m]), m
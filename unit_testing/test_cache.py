@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.cache
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import time
+
+import pytest
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.cache import CacheStore, cache_key, file_digest
+import sct_straighten_spinalcord
+
+
+@pytest.fixture()
+def dummy_images(tmpdir):
+    """Save the same image twice, with different names and compression, and a different image."""
+    data = np.zeros((10, 10, 5), dtype=np.uint8)
+    data[4:6, 4:6, :] = 1
+    fnames = [str(tmpdir.join(f)) for f in ['seg.nii.gz', 'seg_copy.nii', 'seg_other.nii.gz']]
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fnames[0])
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fnames[1])
+    data[0, 0, 0] = 1
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fnames[2])
+    return fnames
+
+
+def test_cache_key(dummy_images):
+    fname, fname_copy, fname_other = dummy_images
+    key = cache_key(input_images=[fname], input_params={'algo_fitting': 'nurbs'})
+    assert cache_key(input_images=[fname_copy], input_params={'algo_fitting': 'nurbs'}) == key
+    assert cache_key(input_images=[fname_other], input_params={'algo_fitting': 'nurbs'}) != key
+    assert cache_key(input_images=[fname], input_params={'algo_fitting': 'hanning'}) != key
+    # only the geometry is taken into account
+    assert cache_key(input_geometries=[fname]) == cache_key(input_geometries=[fname_other])
+    assert cache_key(input_geometries=[fname]) == cache_key(input_geometries=[Image(fname)])
+
+
+def test_straightening_cache_key(dummy_images, monkeypatch):
+    fname, fname_copy, fname_other = dummy_images
+    key = sct_straighten_spinalcord.straightening_cache_key(fname, fname_other)
+    assert sct_straighten_spinalcord.straightening_cache_key(fname_copy, fname) == key
+    assert sct_straighten_spinalcord.straightening_cache_key(fname, fname, algo_fitting='hanning') != key
+    # results of other versions of the straightening are not reused
+    monkeypatch.setattr(sct_straighten_spinalcord, 'STRAIGHTENING_CACHE_VERSION', 0)
+    assert sct_straighten_spinalcord.straightening_cache_key(fname, fname) != key
+
+
+def test_cache_key_files(tmpdir):
+    fname_a, fname_b = str(tmpdir.join('a.txt')), str(tmpdir.join('b.txt'))
+    tmpdir.join('a.txt').write('1 0 0')
+    tmpdir.join('b.txt').write('1 0 0')
+    assert file_digest(fname_a) == file_digest(fname_b)
+    key = cache_key(input_files=[fname_a, fname_b])
+    assert cache_key(input_files=[fname_a]) != key
+    # modified files are hashed again
+    tmpdir.join('b.txt').write('0 1 0 0')
+    assert cache_key(input_files=[fname_a, fname_b]) != key
+
+
+def test_cache_store(tmpdir):
+    store = CacheStore('test', path=str(tmpdir.join('cache')), max_size=1)
+    path_in, path_out = tmpdir.mkdir('in'), tmpdir.mkdir('out')
+    path_in.join('a.txt').write('a')
+    assert not store.get('key', ['a.txt'], path_out=str(path_out))
+    store.put('key', ['a.txt'], path_in=str(path_in))
+    assert store.get('key', ['a.txt'], path_out=str(path_out))
+    assert path_out.join('a.txt').read() == 'a'
+    # all files must be in the entry
+    assert not store.get('key', ['a.txt', 'b.txt'], path_out=str(path_out))
+
+
+def test_cache_store_eviction(tmpdir):
+    # each entry is 400 kB, the store can only contain two of them
+    store = CacheStore('test', path=str(tmpdir.join('cache')), max_size=1)
+    path_in = tmpdir.mkdir('in')
+    path_in.join('a.bin').write(b'0' * 400 * 1024, mode='wb')
+    for i, key in enumerate(['key1', 'key2']):
+        store.put(key, ['a.bin'], path_in=str(path_in))
+        os.utime(os.path.join(store.path, key), (time.time() - 100 + i, time.time() - 100 + i))
+    # use key1, so that key2 is the least recently used entry
+    assert store.get('key1', ['a.bin'], path_out=str(tmpdir))
+    store.put('key3', ['a.bin'], path_in=str(path_in))
+    assert sorted(entry[0] for entry in store.entries()) == ['key1', 'key3']
+    assert not [f for f in os.listdir(store.path) if f.startswith('.')]
+
+
+def test_cache_store_disabled(tmpdir):
+    store = CacheStore('test', path=str(tmpdir.join('cache')), max_size=0)
+    tmpdir.join('a.txt').write('a')
+    store.put('key', ['a.txt'], path_in=str(tmpdir))
+    assert not store.get('key', ['a.txt'], path_out=str(tmpdir))
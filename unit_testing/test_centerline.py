@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_types.Centerline
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from msct_types import Centerline
+
+
+def dummy_centerline(z):
+    x, y = 2 * np.sin(z / 10.), np.cos(z / 20.)
+    return Centerline(x, y, z, np.cos(z / 10.) / 5., - np.sin(z / 20.) / 20., np.ones_like(z))
+
+
+def test_centerline_length():
+    z = np.linspace(0, 40, 201)
+    centerline = dummy_centerline(z)
+    distances = np.linalg.norm(np.diff(centerline.points, axis=0), axis=1)
+    assert np.isclose(centerline.length, distances.sum())
+    assert np.allclose(centerline.incremental_length, np.concatenate(([0], np.cumsum(distances))))
+    assert np.allclose(centerline.incremental_length_inverse[-1], centerline.length)
+
+
+def test_centerline_coordinate_systems():
+    z = np.linspace(0, 40, 201)
+    centerline = dummy_centerline(z)
+    # orthonormal frames, whose z axis is the normalized derivative
+    identity = np.einsum('nij,nik->njk', centerline.matrices, centerline.matrices)
+    assert np.allclose(identity, np.eye(3))
+    assert np.allclose(centerline.matrices[:, :, 2], centerline.derivatives)
+    assert np.allclose(np.linalg.norm(centerline.derivatives, axis=1), 1)
+    # the points are on their planes
+    assert np.allclose(centerline.get_distances_from_planes(centerline.points, np.arange(len(z))), 0)
+    index, plane_params, distance = centerline.get_nearest_plane(centerline.points[10] + 0.01 * centerline.derivatives[10])
+    assert index == 10 and np.isclose(distance, 0.01)
+    assert np.allclose(plane_params, centerline.get_plan_parameters(10))
+    coord = centerline.points[50] + 2 * centerline.matrices[50, :, 0]
+    assert np.allclose(centerline.get_in_plane_coordinates(coord, 50), [2, 0, 0])
+
+
+def test_centerline_average_coordinates_over_slices():
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape((10, 10, 50))
+    hdr.set_sform(np.diag([1, 1, 1, 1]))
+    hdr.set_qform(np.diag([1, 1, 1, 1]))
+    im = Image(np.zeros((10, 10, 50)), hdr=hdr)
+    # slices 1 and 2 are missing
+    z = np.array([0., 0.2, 3., 3.1, 4.])
+    x, y, z_mean, xd, yd, zd = dummy_centerline(z).average_coordinates_over_slices(im)
+    assert np.allclose(z_mean, [0.1, 0.2 / 3 + 3 * 2 / 3, 0.2 / 6 + 3 * 5 / 6, 3.05, 4.])
+    assert len(x) == len(zd) == 5
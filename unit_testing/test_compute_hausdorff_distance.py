@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_compute_hausdorff_distance
+
+from __future__ import print_function, absolute_import, division
+
+import pytest
+import numpy as np
+
+from sct_compute_hausdorff_distance import Thinning, HausdorffDistance, relative_hausdorff_dist, bin_data, non_zero_coord
+
+
+def relative_hausdorff_dist_pairwise(dat1, dat2):
+    """Point by point computation, as done by sct_compute_hausdorff_distance before relative_hausdorff_dist()"""
+    h = np.zeros(dat1.shape)
+    nz_coord_1 = non_zero_coord(dat1)
+    nz_coord_2 = non_zero_coord(dat2)
+    if len(nz_coord_1) != 0 and len(nz_coord_2) != 0:
+        for x1, y1 in nz_coord_1:
+            h[x1, y1] = min(np.linalg.norm(np.asarray([x1, y1]) - np.asarray([x2, y2])) for x2, y2 in nz_coord_2)
+    return h
+
+
+def zhang_suen_pointwise(image):
+    """Point by point Zhang-Suen thinning of a 2d image, as done by sct_compute_hausdorff_distance before the
+    vectorization of Thinning.zhang_suen()"""
+    def get_neighbours(x, y, image):
+        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
+        return [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],
+                image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]
+
+    def transitions(neighbours):
+        n = neighbours + neighbours[0:1]
+        return sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))
+
+    image_thinned = image.copy()
+    pass_list = [1, len(image_thinned) - 1]
+    changing1 = changing2 = 1
+    while changing1 or changing2:
+        changing1 = []
+        for x, y in non_zero_coord(image_thinned):
+            if x not in pass_list and y not in pass_list:
+                P2, P3, P4, P5, P6, P7, P8, P9 = n = get_neighbours(x, y, image_thinned)
+                if 2 <= sum(n) <= 6 and P2 * P4 * P6 == 0 and P4 * P6 * P8 == 0 and transitions(n) == 1:
+                    changing1.append((x, y))
+        for x, y in changing1:
+            image_thinned[x][y] = 0
+        changing2 = []
+        for x, y in non_zero_coord(image_thinned):
+            if x not in pass_list and y not in pass_list:
+                P2, P3, P4, P5, P6, P7, P8, P9 = n = get_neighbours(x, y, image_thinned)
+                if 2 <= sum(n) <= 6 and P2 * P4 * P8 == 0 and P2 * P6 * P8 == 0 and transitions(n) == 1:
+                    changing2.append((x, y))
+        for x, y in changing2:
+            image_thinned[x][y] = 0
+    return image_thinned
+
+
+def dummy_masks(shape, seed=0):
+    """Two random binary masks made of blobs, with an empty slice in each of them"""
+    rng = np.random.RandomState(seed)
+    masks = []
+    for i in range(2):
+        mask = np.zeros(shape, dtype=int)
+        for z in range(shape[0]):
+            for _ in range(3):
+                x, y = rng.randint(2, shape[1] - 6), rng.randint(2, shape[2] - 6)
+                mask[z, x:x + rng.randint(1, 5), y:y + rng.randint(1, 5)] = 1
+        mask[i] = 0
+        masks.append(mask)
+    return masks
+
+
+def test_relative_hausdorff_dist():
+    data1, data2 = dummy_masks((4, 16, 12))
+    # stack of 2d slices
+    expected = [relative_hausdorff_dist_pairwise(slice1, slice2) for slice1, slice2 in zip(data1, data2)]
+    assert np.allclose(relative_hausdorff_dist(data1, data2), expected)
+    # single 2d slice
+    assert np.allclose(relative_hausdorff_dist(data1[2], data2[2]), expected[2])
+
+
+def test_hausdorff_distance_slicewise():
+    data1, data2 = dummy_masks((4, 16, 12), seed=1)
+    for z, hdist in enumerate(HausdorffDistance.slicewise(data1, data2, v=0)):
+        hdist_2d = HausdorffDistance(data1[z], data2[z], v=0)
+        assert np.allclose(hdist.min_distances_1, relative_hausdorff_dist_pairwise(data1[z], data2[z]))
+        assert np.allclose(hdist.min_distances_2, relative_hausdorff_dist_pairwise(data2[z], data1[z]))
+        assert (hdist.h1, hdist.h2, hdist.H) == pytest.approx((hdist_2d.h1, hdist_2d.h2, hdist_2d.H))
+
+
+def test_zhang_suen():
+    data = sum(dummy_masks((3, 14, 14), seed=2))
+    data[:, 4:10, 3:11] = 1
+    data = bin_data(data)
+    # the image is only used by __init__, the thinning itself works on arrays
+    thinning = Thinning.__new__(Thinning)
+    expected = [zhang_suen_pointwise(im_slice) for im_slice in data]
+    assert not np.array_equal(data, expected)
+    assert np.array_equal(thinning.zhang_suen(data), expected)
+    assert np.array_equal(thinning.zhang_suen(data[0]), expected[0])
+    # the input is left untouched
+    assert data[:, 4:10, 3:11].all()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_deepseg_sc
+
+from __future__ import print_function, absolute_import, division
+
+import os
+
+import pytest
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+
+pytest.importorskip('keras')
+import sct_deepseg_sc
+
+
+class VoxelwiseModel(object):
+    """Model segmenting the bright voxels of each slice."""
+    def predict(self, batch, batch_size=None):
+        vmin = batch.min(axis=(1, 2, 3), keepdims=True)
+        vmax = batch.max(axis=(1, 2, 3), keepdims=True)
+        return (batch - vmin) / np.maximum(vmax - vmin, 1e-6)
+
+
+def fake_image(x, y):
+    data = np.random.RandomState(0).rand(80, 80, 6).astype(np.float32) * 10
+    data[x:x + 12, y:y + 12, :] = 100
+    return Image(data, hdr=nibabel.Nifti1Image(data, np.diag([0.5, 0.5, 1, 1])).header)
+
+
+def find_centerline(algo, image_fname, **kwargs):
+    im_ctr = Image(image_fname)
+    data = np.zeros(im_ctr.data.shape)
+    for zz in range(data.shape[2]):
+        x, y = np.argwhere(im_ctr.data[:, :, zz] > 50).mean(axis=0).astype(int)
+        data[x, y, zz] = 1
+    im_ctr.data = data
+    fname_ctr = image_fname.replace('.nii', '_ctr.nii')
+    im_ctr.save(fname_ctr)
+    return image_fname, fname_ctr
+
+
+def test_deep_segmentation_spinalcord_batch(tmpdir, monkeypatch):
+    # each image is segmented on its own files, and the outputs of an image are not overwritten by the next ones
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(sct_deepseg_sc, 'find_centerline', find_centerline)
+    monkeypatch.setattr(sct_deepseg_sc, 'get_model', lambda key, load: VoxelwiseModel())
+    list_xy = [(20, 24), (50, 40)]
+    outputs = sct_deepseg_sc.deep_segmentation_spinalcord_batch([fake_image(x, y) for x, y in list_xy], 't2',
+                                                                ctr_algo='cnn', kernel_size='2d', verbose=0)
+    assert len(outputs) == 2
+    for (x, y), (im_seg, im_res, im_seg_res) in zip(list_xy, outputs):
+        assert np.array_equal(im_seg.data > 0.5, fake_image(x, y).data > 50)
+        assert np.array_equal(im_seg_res.data > 0.5, fake_image(x, y).change_orientation('RPI').data > 50)
+    assert os.listdir(str(tmpdir)) == []
@@ -674,3 +674,37 @@ def test_sequences(fake_3dimage_sct):
      .save(path_b, mutable=True)
     assert img.absolutepath is not None
     assert img.absolutepath == os.path.abspath(path_b)
+
+
+def test_mmap(fake_3dimage_sct):
+    """
+    Test lazy, memory-mapped loading of uncompressed images
+    """
+
+    path_tmp = sct.tmp_create(basename="test_mmap")
+    path_src = os.path.join(path_tmp, "src.nii")
+    fake_3dimage_sct.save(path_src)
+
+    img = msct_image.Image(path_src, mmap=True)
+    # header-only accesses don't read the data
+    assert img.dim[:3] == fake_3dimage_sct.data.shape
+    assert img._data is None
+    assert isinstance(img.data, np.memmap)
+    assert (img.data == fake_3dimage_sct.data).all()
+
+    # orientation changes and slicers are views on the memory map
+    img_rpi = msct_image.change_orientation(img, "RPI")
+    assert msct_image._get_memmap_filename(img_rpi.data) == img.data.filename
+    for slice2d_new, slice2d_old in msct_image.SlicerMany((img, fake_3dimage_sct), msct_image.Slicer, orientation="ASR"):
+        assert (slice2d_new == slice2d_old).all()
+
+    # the memory map is copy-on-write: in-memory changes don't alter the file
+    img.data[0, 0, 0] = -1
+    assert msct_image.Image(path_src).data[0, 0, 0] == fake_3dimage_sct.data[0, 0, 0]
+
+    # saving over the file backing the memory map is safe
+    img.save(path_src)
+    assert img.data[0, 0, 0] == -1
+    assert msct_image.Image(path_src).data[0, 0, 0] == -1
+
+    sct.rmtree(path_tmp)
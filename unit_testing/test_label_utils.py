@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_label_utils
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+from msct_types import Coordinate
+import sct_label_utils
+
+
+def fake_labels(values):
+    data = np.zeros((10, 12, 20), dtype=np.uint8)
+    for i, value in enumerate(values):
+        data[5, 6, 2 + 4 * i] = value
+    return Image(data, hdr=nibabel.Nifti1Image(data, np.eye(4)).header)
+
+
+def test_process_labels(tmpdir):
+    # the Image-level entry point gives the same result as the command line
+    im_label, im_ref = fake_labels([1, 2, 3, 4]), fake_labels([0, 2, 0, 4])
+    fname_label, fname_ref = str(tmpdir.join('label.nii.gz')), str(tmpdir.join('ref.nii.gz'))
+    Image(im_label).save(fname_label)
+    Image(im_ref).save(fname_ref)
+    for args, im_out in [
+     (['-add', '-1'], sct_label_utils.process_labels(im_label, 'add', value=-1)),
+     (['-remove', fname_ref], sct_label_utils.process_labels(im_label, 'remove', im_ref=im_ref)),
+     (['-create', '1,2,3,7:4,5,6,8'],
+      sct_label_utils.process_labels(im_label, 'create', coordinates=[Coordinate([1, 2, 3, 7]),
+                                                                      Coordinate([4, 5, 6, 8])])),
+     ]:
+        fname_out = str(tmpdir.join('out.nii.gz'))
+        sct_label_utils.main(args=['-i', fname_label, '-o', fname_out, '-v', '0'] + args)
+        assert np.array_equal(Image(fname_out).data, im_out.data), args
+    # the input labels are not modified
+    assert np.array_equal(im_label.data, fake_labels([1, 2, 3, 4]).data)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_label_vertebrae
+
+from __future__ import print_function, absolute_import, division
+
+import os
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+import sct_label_vertebrae
+
+
+class NoCache(object):
+    def get(self, key, fnames):
+        return False
+
+    def put(self, key, fnames):
+        pass
+
+
+def test_qc_args(tmpdir, monkeypatch):
+    # the QC report records the command line of sct_label_vertebrae, not the one of the straightening
+    data = np.zeros((10, 12, 20), dtype=np.float32)
+    data[4:6, 5:7, :] = 1
+    fname_in, fname_seg = str(tmpdir.join('t2.nii.gz')), str(tmpdir.join('t2_seg.nii.gz'))
+    for fname in (fname_in, fname_seg):
+        Image(data, hdr=nibabel.Nifti1Image(data, np.eye(4)).header).save(fname)
+
+    # skip the processing, which is not what is tested here
+    def straighten(args):
+        for fname in ('data_straight.nii', 'warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz',
+                      'straight_ref.nii.gz'):
+            Image('data.nii').save(fname)
+
+    def vertebral_detection(*args, **kwargs):
+        Image('segmentation.nii.gz').save('segmentation_straight_labeled.nii.gz')
+
+    qc_args = []
+    sct_straighten_spinalcord = sct_label_vertebrae.sct_straighten_spinalcord
+    monkeypatch.setattr(sct_straighten_spinalcord, 'get_straightening_cache', lambda: NoCache())
+    monkeypatch.setattr(sct_straighten_spinalcord, 'main', straighten)
+    monkeypatch.setattr(sct_label_vertebrae, 'create_label_z', lambda fname_seg, z, value, fname_labelz:
+                        Image(fname_seg).save(fname_labelz))
+    monkeypatch.setattr(sct_label_vertebrae.sct_maths, 'dilate_image', lambda im, radius: im)
+    monkeypatch.setattr(sct_label_vertebrae, 'resample_file', lambda fname, fname_out, *args, **kwargs:
+                        Image(fname).save(fname_out))
+    monkeypatch.setattr(sct_label_vertebrae.sct_apply_transfo, 'apply_transfo', lambda im_src, im_dest, *args, **kwargs:
+                        Image(np.zeros(im_dest.data.shape), hdr=im_dest.hdr.copy()))
+    monkeypatch.setattr(sct_label_vertebrae, 'get_z_and_disc_values_from_label', lambda im: [10, 2])
+    monkeypatch.setattr(sct_label_vertebrae, 'vertebral_detection', vertebral_detection)
+    monkeypatch.setattr(sct_label_vertebrae, 'clean_labeled_segmentation', lambda *args: None)
+    monkeypatch.setattr(sct_label_vertebrae, 'label_discs', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sct_label_vertebrae.sct, 'generate_output_file', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sct_label_vertebrae.sct, 'display_viewer_syntax', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sct_label_vertebrae, 'generate_qc', lambda fn_in, fn_labeled, args, path_qc:
+                        qc_args.append(args))
+
+    args = ['-i', fname_in, '-s', fname_seg, '-c', 't2', '-t', str(tmpdir), '-initz', '10,3',
+            '-ofolder', str(tmpdir.join('out')), '-qc', str(tmpdir.join('qc')), '-v', '0']
+    curdir = os.getcwd()
+    try:
+        sct_label_vertebrae.main(args=list(args))
+    finally:
+        os.chdir(curdir)
+    assert qc_args == [args]
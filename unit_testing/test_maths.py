@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_maths
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+import sct_maths
+
+
+def fake_image():
+    data = np.random.RandomState(0).rand(12, 14, 16).astype(np.float32)
+    data[4:8, 5:9, 6:10] += 1
+    return Image(data, hdr=nibabel.Nifti1Image(data, np.diag([0.5, 0.5, 2, 1])).header)
+
+
+def test_image_entry_points(tmpdir):
+    # the Image-level functions give the same result as the command line
+    im_in = fake_image()
+    fname_in = str(tmpdir.join('in.nii.gz'))
+    Image(im_in).save(fname_in)
+    for args, im_out in [
+     (['-thr', '1'], sct_maths.threshold_image(im_in, 1)),
+     (['-bin', '1.2'], sct_maths.binarise_image(im_in, 1.2)),
+     (['-smooth', '1,1,3'], sct_maths.smooth_image(im_in, [1, 1, 3])),
+     (['-mul', fname_in], sct_maths.multiply_images(im_in, im_in)),
+     ]:
+        fname_out = str(tmpdir.join('out.nii.gz'))
+        sct_maths.main(args=['-i', fname_in, '-o', fname_out, '-v', '0'] + args)
+        assert np.allclose(Image(fname_out).data, im_out.data), args
+    # the input image is not modified
+    assert np.array_equal(im_in.data, fake_image().data)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.model_registry
+
+from __future__ import print_function, absolute_import, division
+
+from spinalcordtoolbox.model_registry import ModelRegistry
+
+
+class DummyModel(object):
+    def __init__(self, nb_params):
+        self.nb_params = nb_params
+
+    def count_params(self):
+        return self.nb_params
+
+
+def test_model_registry_reuse():
+    registry = ModelRegistry(max_memory=1)
+    loaded = []
+
+    def loader():
+        loaded.append(1)
+        return DummyModel(10)
+
+    model = registry.get(('model', 't2'), loader)
+    assert registry.get(('model', 't2'), loader) is model
+    assert len(loaded) == 1
+    assert registry.memory == 40
+
+
+def test_model_registry_eviction():
+    # each model uses 400 kB, the registry can only contain two of them
+    registry = ModelRegistry(max_memory=1)
+    for key in ['model1', 'model2']:
+        registry.get(key, lambda: DummyModel(100 * 1024))
+    # use model1, so that model2 is the least recently used model
+    registry.get('model1', lambda: None)
+    registry.get('model3', lambda: DummyModel(100 * 1024))
+    assert list(registry.models) == ['model1', 'model3']
+
+
+def test_model_registry_disabled():
+    registry = ModelRegistry(max_memory=0)
+    assert registry.get('model', lambda: DummyModel(1)) is not registry.get('model', lambda: DummyModel(1))
+    assert not registry.models
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the GM segmentation model (msct_multiatlas_seg)
+
+from __future__ import print_function, absolute_import, division
+
+import gzip
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from msct_gmseg_utils import Slice
+from msct_multiatlas_seg import MODEL_DESCRIPTION_FILE, MODEL_PICKLE_FILES, Model, PCAModel, Param, convert_model
+
+
+class SklearnPCA(object):
+    # attributes of sklearn.decomposition.PCA used by the legacy models
+    def __init__(self, components_, mean_):
+        self.components_, self.mean_, self.whiten = components_, mean_, False
+
+
+def test_model_save_load(tmpdir):
+    rng = np.random.RandomState(0)
+    model = Model(param=Param())
+    model.param.verbose = 0
+    model.slices = [Slice(slice_id=i, im=rng.rand(6, 6), im_m=rng.rand(6, 6), level=i / 2. + 0.5,
+                          gm_seg_m=[rng.rand(6, 6) > 0.5 for _ in range(1 + i % 3)], wm_seg_m=[rng.rand(6, 6) > 0.5])
+                    for i in range(10)]
+    model.mean_image = np.mean([dic_slice.im for dic_slice in model.slices], axis=0)
+    model.intensities = pd.DataFrame({'GM': pd.Series([1., 2.], index=[1, 0]), 'WM': pd.Series([3., 4.], index=[1, 0]),
+                                      'MIN': pd.Series([0., 0.], index=[1, 0]), 'MAX': pd.Series([5., 6.], index=[1, 0])})
+    model.fitted_model = PCAModel(rng.rand(3, 36), rng.rand(36), rng.rand(3))
+    model.fitted_data = rng.rand(10, 3)
+    model.save_model(str(tmpdir))
+
+    model_loaded = Model(param=model.param)
+    model_loaded.param_model.path_model_to_load = str(tmpdir)
+    model_loaded.load_model()
+    assert model_loaded.param_model.method == 'pca'
+    assert len(model_loaded.slices) == 10
+    for dic_slice, dic_slice_loaded in zip(model.slices, model_loaded.slices):
+        assert dic_slice_loaded.level == dic_slice.level
+        assert np.allclose(dic_slice_loaded.im_M, dic_slice.im_M)
+        assert len(dic_slice_loaded.gm_seg_M) == len(dic_slice.gm_seg_M)
+        assert np.array_equal(dic_slice_loaded.gm_seg_M[-1], dic_slice.gm_seg_M[-1])
+        assert np.array_equal(dic_slice_loaded.wm_seg_M[0], dic_slice.wm_seg_M[0])
+    assert np.array_equal(model_loaded.mean_image, model.mean_image)
+    assert np.array_equal(model_loaded.fitted_data, model.fitted_data)
+    assert model_loaded.intensities['WM'][0] == 4.
+    data = rng.rand(2, 36)
+    assert np.allclose(model_loaded.fitted_model.transform(data), model.fitted_model.transform(data))
+
+
+def test_convert_model(tmpdir):
+    rng = np.random.RandomState(0)
+    path_model = str(tmpdir.join('gm_model'))
+    os.mkdir(path_model)
+    slices = [Slice(slice_id=i, im=rng.rand(6, 6), im_m=rng.rand(6, 6), level=i + 1,
+                    gm_seg_m=[rng.rand(6, 6) > 0.5], wm_seg_m=[rng.rand(6, 6) > 0.5]) for i in range(4)]
+    intensities = pd.DataFrame({'GM': pd.Series([1., 2.], index=[1, 0]), 'WM': pd.Series([3., 4.], index=[1, 0])})
+    for key, obj in [('slices', slices), ('intensity', intensities), ('model', SklearnPCA(rng.rand(2, 36), rng.rand(36))),
+                     ('data', rng.rand(4, 2))]:
+        pickle.dump(obj, gzip.open(os.path.join(path_model, MODEL_PICKLE_FILES[key]), 'wb'), protocol=2)
+    fnames_legacy = sorted(os.listdir(path_model))
+
+    def load():
+        model = Model(param=Param())
+        model.param.verbose = 0
+        model.param_model.path_model_to_load = path_model
+        model.load_model()
+        return model
+
+    # loading a legacy model does not modify the model folder
+    model_legacy = load()
+    assert sorted(os.listdir(path_model)) == fnames_legacy
+
+    assert convert_model(path_model, verbose=0)
+    assert os.path.isfile(os.path.join(path_model, MODEL_DESCRIPTION_FILE))
+    assert set(fnames_legacy) < set(os.listdir(path_model))
+    assert sorted(os.listdir(str(tmpdir))) == ['gm_model', 'gm_model.lock']
+    assert not convert_model(path_model, verbose=0)
+
+    model = load()
+    assert [dic_slice.level for dic_slice in model.slices] == [1, 2, 3, 4]
+    assert np.array_equal(model.mean_image, model_legacy.mean_image)
+    assert np.array_equal(model.fitted_data, model_legacy.fitted_data)
+    data = rng.rand(2, 36)
+    assert np.allclose(model.fitted_model.transform(data), model_legacy.fitted_model.transform(data))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_nurbs
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+
+from msct_nurbs import NURBS, basis_functions
+
+
+def test_basis_functions():
+    knots = [0, 0, 0, 0, 0.3, 0.5, 0.5, 0.8, 1, 1, 1, 1]
+    params = np.linspace(0, 1, 101)
+    basis, basis_deriv = basis_functions(knots, 4, params)
+    assert basis.shape == (101, 8)
+    # partition of unity, including at the end of the curve
+    assert np.allclose(basis.sum(axis=1), 1)
+    assert np.allclose(basis[[0, -1]][:, [0, -1]], np.eye(2))
+    # the derivatives are scaled by order / degree
+    numerical_deriv = np.gradient(basis, params, axis=0)
+    assert np.allclose(basis_deriv[10:20], numerical_deriv[10:20] * 4 / 3, atol=0.1)
+
+
+def test_nurbs_fit():
+    z = np.arange(50, dtype=float)
+    x, y = 5 * np.sin(z / 20.), 0.1 * z
+    nurbs = NURBS(3, 3000, [[x[i], y[i], z[i]] for i in range(len(z))], False, None, verbose=0)
+    x_fit, y_fit, z_fit = nurbs.getCourbe3D()
+    assert np.allclose(z_fit, z)
+    assert np.allclose(x_fit, x, atol=0.1) and np.allclose(y_fit, y, atol=0.1)
+    x_deriv, y_deriv, z_deriv = nurbs.getCourbe3D_deriv()
+    assert np.allclose(x_deriv / z_deriv, np.cos(z / 20.) / 4., atol=0.05)
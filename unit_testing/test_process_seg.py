@@ -104,6 +104,23 @@ def test_compute_csa_ellipse(dummy_segmentation):
     assert np.mean(metrics['angle'].data[30:70]) == pytest.approx(0.0, rel=0.01)
 
 
+# noinspection 801,PyShadowingNames
+def test_compute_csa_centerline(dummy_segmentation):
+    """Test that a precomputed centerline gives the same CSA as the one fitted internally"""
+    from sct_straighten_spinalcord import smooth_centerline
+    from msct_types import Centerline
+    im_seg = dummy_segmentation(shape='rectangle', angle=15, a=50.0, b=30.0)
+    centerline = Centerline(*smooth_centerline(im_seg.copy(), algo_fitting='hanning', type_window='hanning',
+                                               window_length=3, nurbs_pts_number=3000, phys_coordinates=True,
+                                               all_slices=False))
+    metrics = process_seg.compute_csa(im_seg, algo_fitting='hanning', type_window='hanning', window_length=3,
+                                      angle_correction=True, use_phys_coord=True, verbose=0)
+    metrics_centerline = process_seg.compute_csa(im_seg, angle_correction=True, use_phys_coord=True,
+                                                 centerline=centerline, verbose=0)
+    np.testing.assert_allclose(metrics_centerline['csa'].data, metrics['csa'].data, rtol=1e-5)
+    np.testing.assert_allclose(metrics_centerline['angle'].data, metrics['angle'].data, rtol=1e-5)
+
+
 # noinspection 801,PyShadowingNames
 def test_compute_shape_noangle(dummy_segmentation):
     """Test computation of cross-sectional area from input segmentation."""
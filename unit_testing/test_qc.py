@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.reports (QC mosaics and rendering)
+
+from __future__ import print_function, absolute_import, division
+
+import os, json
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
+import skimage.io
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.reports import qc, slice as qcslice
+
+
+def dummy_images():
+    shape = (20, 30, 40)
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_sform(np.diag([1, 1, 1, 1]))
+    hdr.set_qform(np.diag([1, 1, 1, 1]))
+    data = np.random.RandomState(0).rand(*shape)
+    seg = np.zeros(shape)
+    seg[:, 10:14, 30:36] = 1
+    seg[:, 11:13, 32:34] = 2
+    return Image(data, hdr=hdr), Image(seg, hdr=hdr.copy())
+
+
+def test_mosaic():
+    axial = qcslice.Axial(dummy_images())
+    size = 4
+    matrices = axial.mosaic(nb_column=6, size=size)
+    dim = axial.get_dim(axial._images[0])
+    # each slice is cropped around the center of mass of the segmentation, and laid out row by row
+    centers_x, centers_y = axial.get_center()
+    for image, matrix in zip(axial._images, matrices):
+        assert matrix.shape == ((dim // 6 + 1) * size * 2, 6 * size * 2)
+        for i in range(dim):
+            patch = qcslice.Slice.crop(axial.get_slice(image.data, i), int(centers_x[i]), int(centers_y[i]), size, size)
+            row, col = (i // 6) * size * 2, (i % 6) * size * 2
+            assert np.array_equal(matrix[row:row + size * 2, col:col + size * 2], patch)
+    assert set(np.unique(matrices[1])) == {0, 1, 2}
+
+
+def render(tmpdir, *operations):
+    path_qc = str(tmpdir.join('_'.join(operation.__name__ for operation in operations)))
+    qc.add_entry(src=str(tmpdir.join('sub', 't2', 't2.nii.gz')), process='sct_test', args='', path_qc=path_qc,
+                 plane='Axial', qcslice=qcslice.Axial(dummy_images()), qcslice_operations=list(operations),
+                 qcslice_layout=lambda x: x.mosaic(size=4))
+    path_img, = os.listdir(os.path.join(path_qc, 'sub', 't2', 'sct_test'))
+    path_img = os.path.join(path_qc, 'sub', 't2', 'sct_test', path_img)
+    return [skimage.io.imread(os.path.join(path_img, fname)) for fname in ('bkg_img.png', 'overlay_img.png')]
+
+
+def test_add_entry(tmpdir):
+    # built-in actions are rendered with numpy, at dpi / 100 pixels per voxel
+    bkg, overlay = render(tmpdir, qc.QcImage.listed_seg)
+    results = qc.load_results(str(tmpdir.join('listed_seg')))
+    assert len(results) == 1 and results[0]['command'] == 'sct_test'
+    assert os.path.isfile(str(tmpdir.join('listed_seg', 'index.html')))
+    assert bkg.shape == overlay.shape == (8 * 3, 600 * 3, 4)
+    colors = np.unique(overlay.reshape(-1, 4), axis=0)
+    assert np.array_equal(colors, [[0, 0, 0, 0], [80, 255, 48, 255], [255, 0, 0, 255]])
+
+    # with several actions, only the overlay of the last one is kept (the one of template is semi-transparent)
+    bkg, overlay = render(tmpdir, qc.QcImage.template)
+    bkg_last, overlay_last = render(tmpdir, qc.QcImage.listed_seg, qc.QcImage.template)
+    assert np.array_equal(bkg_last, bkg)
+    assert np.array_equal(overlay_last, overlay)
+
+    # custom actions are drawn with matplotlib
+    def custom_seg(self, mask):
+        self.listed_seg(mask)
+    bkg, overlay = render(tmpdir, custom_seg)
+    assert bkg.shape == overlay.shape
+
+
+def test_append_result(tmpdir):
+    path_qc = str(tmpdir)
+    # results of older versions are converted
+    with open(os.path.join(path_qc, qc.QC_RESULTS_LEGACY), 'w') as f:
+        json.dump([{'subject': 'legacy'}], f)
+    assert qc.append_result(path_qc, {'subject': 0})
+    assert not qc.append_result(path_qc, {'subject': 1})
+
+    # entries appended concurrently are not lost
+    pool = ThreadPool(8)
+    pool.map(lambda i: qc.append_result(path_qc, {'subject': i, 'args': '-a "b"\n'}), range(2, 100))
+    pool.close()
+    results = qc.load_results(path_qc)
+    assert results[0]['subject'] == 'legacy'
+    assert sorted(result['subject'] for result in results[1:]) == list(range(100))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_segment_graymatter
+
+from __future__ import print_function, absolute_import, division
+
+import pytest
+import numpy as np
+
+from msct_gmseg_utils import Slice, average_gm_wm
+from msct_multiatlas_seg import Model, Param
+from sct_segment_graymatter import SegmentGM
+
+
+def dummy_segment_gm(nb_target=3):
+    """SegmentGM with a model of 6 slices, without the temporary folder created by the constructor"""
+    rng = np.random.RandomState(0)
+    segment_gm = SegmentGM.__new__(SegmentGM)
+    segment_gm.param = Param()
+    segment_gm.param.verbose = 0
+    segment_gm.model = Model(param=segment_gm.param)
+    segment_gm.model.slices = [Slice(slice_id=i, gm_seg_m=[rng.rand(5, 5) - 0.2 for _ in range(1 + i % 3)],
+                                     wm_seg_m=[rng.rand(5, 5)]) for i in range(6)]
+    segment_gm.target_im = [Slice(slice_id=i, im=rng.rand(5, 5)) for i in range(nb_target)]
+    return segment_gm
+
+
+def test_label_fusion():
+    segment_gm = dummy_segment_gm()
+    selected = np.array([[True, False, True, True, False, False],
+                         [False, False, False, False, False, True],
+                         [True, True, True, True, True, True]])
+    segment_gm.label_fusion(selected)
+    for target_slice in segment_gm.target_im:
+        # average of the selected slices, as computed slice by slice before the batched label fusion
+        data_mean_gm, _ = average_gm_wm([segment_gm.model.slices[j] for j in np.flatnonzero(selected[target_slice.id])])
+        data_mean_gm[data_mean_gm < 0] = 0
+        assert np.allclose(target_slice.gm_seg_M, data_mean_gm)
+
+
+def test_label_fusion_no_selection():
+    # a target slice without any similar model slice can't be segmented
+    segment_gm = dummy_segment_gm()
+    selected = np.ones((3, 6), dtype=bool)
+    selected[1] = False
+    with pytest.raises(RuntimeError):
+        segment_gm.label_fusion(selected)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.deepseg_sc.sliding_window
+
+from __future__ import print_function, absolute_import, division
+
+import pytest
+import numpy as np
+
+from spinalcordtoolbox.deepseg_sc.sliding_window import predict_sliding_window
+
+
+class VoxelwiseModel(object):
+    """Model whose prediction of a voxel only depends on the voxel, so that the blended prediction is known."""
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch, batch_size=None):
+        assert batch.shape[1] == 1
+        self.batch_sizes.append(len(batch))
+        return 1 / (1 + np.exp(-batch))
+
+
+@pytest.mark.parametrize('step', [None, (4, 4, 3)])
+@pytest.mark.parametrize('weighting', ['uniform', 'gaussian'])
+def test_predict_sliding_window(step, weighting):
+    data = np.random.RandomState(0).rand(8, 8, 20) + 1
+    model = VoxelwiseModel()
+    pred = predict_sliding_window(model, data, (8, 8, 6), step=step, batch_size=2, weighting=weighting)
+    assert pred.shape == data.shape
+    assert np.allclose(pred, 1 / (1 + np.exp(-data)), atol=1e-6)
+    assert max(model.batch_sizes) == 2
+
+
+def test_predict_sliding_window_skip_empty():
+    data = np.zeros((8, 8, 18))
+    data[:, :, 6:12] = 1
+    model = VoxelwiseModel()
+    pred = predict_sliding_window(model, data, (8, 8, 6), preprocess=lambda x: x * 2)
+    assert model.batch_sizes == [1]
+    assert np.allclose(pred[:, :, 6:12], 1 / (1 + np.exp(-2)))
+    assert not np.any(pred[:, :, :6]) and not np.any(pred[:, :, 12:])
@@ -446,3 +446,116 @@ def test_transfo_skip_pix2phys():
 
 
 
+
+
+def test_apply_transfo(tmpdir):
+    # same shift of +1,+1,+1 (in LPI) as test_transfo_skip_pix2phys(), resampled in-process
+    img_src = fake_3dimage_sct()
+
+    shape = tuple(list(img_src.data.shape) + [1,3])
+    data = np.ones(shape, order="F")
+    data[...,2] *= -1
+    path_warp = str(tmpdir.join("warp-field111.nii"))
+    img_warp = fake_image_sct_custom(data)
+    img_warp.header.set_intent('vector', (), '')
+    img_warp.save(path_warp)
+
+    img_dst = sct_apply_transfo.apply_transfo(img_src, img_src, [path_warp], interp='linear')
+
+    assert img_dst.data.shape == img_src.data.shape
+    assert img_dst.data.dtype == np.float32
+    assert np.allclose(img_dst.data[0,:,:], 0)
+    assert np.allclose(img_dst.data[:,0,:], 0)
+    assert np.allclose(img_dst.data[:,:,0], 0)
+    assert np.allclose(img_src.data[:-1,:-1,:-1], img_dst.data[1:,1:,1:])
+
+
+def test_label_warper_mmap(tmpdir, monkeypatch):
+    # the warping field is composed onto the destination grid in a temporary folder, which is removed before the
+    # field is used: it must be read in memory, even in the lazy mode
+    import sct_concat_transfo
+    import sct_warp_template
+    monkeypatch.setattr(msct_image, 'MMAP_DEFAULT', True)
+
+    path_src = str(tmpdir.join("src.nii"))
+    img_src = fake_3dimage_sct().save(path_src)
+
+    # shift of +1,+1,+1 (in LPI), on a grid which is not the destination one
+    path_warp = str(tmpdir.join("warp.nii"))
+    img_warp = fake_image_sct_custom(np.zeros((5, 5, 5, 1, 3), order="F"))
+    img_warp.header.set_intent('vector', (), '')
+    img_warp.save(path_warp)
+
+    def compose_warps(fname_warp_list_invert, fname_dest, fname_out, dimensionality='3', verbose=1):
+        assert fname_warp_list_invert == [path_warp]
+        data = np.ones(tuple(list(img_src.data.shape) + [1, 3]), order="F")
+        data[..., 2] *= -1
+        img_composed = fake_image_sct_custom(data)
+        img_composed.header.set_intent('vector', (), '')
+        img_composed.save(fname_out)
+        return fname_out
+    monkeypatch.setattr(sct_concat_transfo, 'compose_warps', compose_warps)
+
+    warper = sct_warp_template.LabelWarper(path_src, path_warp, jobs=2, verbose=0)
+    list_fname_out = [str(tmpdir.join("dst_{}.nii".format(interp))) for interp in ('linear', 'nn')]
+    warper.warp([path_src, path_src], list_fname_out, ['linear', 'nn'])
+
+    for fname_out in list_fname_out:
+        data_dst = np.asarray(msct_image.Image(fname_out).data)
+        assert data_dst.shape == img_src.data.shape
+        assert np.allclose(data_dst[0,:,:], 0)
+        assert np.allclose(data_dst[:,0,:], 0)
+        assert np.allclose(data_dst[:,:,0], 0)
+        assert np.allclose(img_src.data[:-1,:-1,:-1], data_dst[1:,1:,1:])
+
+
+def fake_shift111_warp(shape, path_warp):
+    """Save a warping field shifting images by +1,+1,+1 (in LPI), see test_transfo_skip_pix2phys()"""
+    data = np.ones(tuple(list(shape) + [1,3]), order="F")
+    data[...,2] *= -1
+    img_warp = fake_image_sct_custom(data)
+    img_warp.header.set_intent('vector', (), '')
+    img_warp.save(path_warp)
+    return path_warp
+
+
+def test_apply_transfo_nn(tmpdir):
+    # labels keep their data type with nearest neighbour interpolation
+    img_src = fake_3dimage_sct()
+    path_warp = fake_shift111_warp(img_src.data.shape, str(tmpdir.join("warp-field111.nii")))
+    img_label = msct_image.Image(np.asarray(img_src.data, dtype=np.int32), hdr=img_src.hdr.copy())
+    img_mask = msct_image.Image(img_src.data > 150000, hdr=img_src.hdr.copy())
+
+    img_dst = sct_apply_transfo.apply_transfo(img_label, img_src, [path_warp], interp='nn')
+    assert img_dst.data.dtype == np.int32
+    assert np.array_equal(img_label.data[:-1,:-1,:-1], img_dst.data[1:,1:,1:])
+
+    img_dst = sct_apply_transfo.apply_transfo(img_mask, img_src, [path_warp], interp='nn')
+    assert img_dst.data.dtype == np.uint8
+    assert np.array_equal(img_mask.data[:-1,:-1,:-1], img_dst.data[1:,1:,1:])
+    img_dst.save(str(tmpdir.join("mask_dst.nii")))
+
+    # same for each volume of 4D images
+    data_4d = np.stack([img_label.data, img_label.data * 2], axis=3)
+    img_label_4d = msct_image.Image(data_4d, hdr=img_src.hdr.copy())
+    img_label_4d.hdr.set_data_shape(data_4d.shape)
+    img_dst = sct_apply_transfo.apply_transfo(img_label_4d, img_src, [path_warp], interp='nn', jobs=2)
+    assert img_dst.data.dtype == np.int32
+    assert np.array_equal(data_4d[:-1,:-1,:-1], img_dst.data[1:,1:,1:])
+
+
+def test_apply_transfo_mmap(tmpdir, monkeypatch):
+    # the transformations are composed in a temporary folder, which is removed before the composed field is used: it
+    # must be read in memory, even in the lazy mode
+    import sct_concat_transfo
+    monkeypatch.setattr(msct_image, 'MMAP_DEFAULT', True)
+    img_src = fake_3dimage_sct()
+    path_warp = str(tmpdir.join("warp.txt"))
+
+    def compose_warps(fname_warp_list_invert, fname_dest, fname_out, dimensionality='3', verbose=1):
+        assert fname_warp_list_invert == [path_warp]
+        return fake_shift111_warp(img_src.data.shape, fname_out)
+    monkeypatch.setattr(sct_concat_transfo, 'compose_warps', compose_warps)
+
+    img_dst = sct_apply_transfo.apply_transfo(img_src, img_src, [path_warp], interp='linear')
+    assert np.allclose(img_src.data[:-1,:-1,:-1], img_dst.data[1:,1:,1:])